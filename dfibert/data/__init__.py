@@ -8,23 +8,42 @@ to work directly with the data.
 """
 from __future__ import annotations
 
+import contextlib
+import contextvars
+import hashlib
+import json
 import os
+import shutil
+import time
 import warnings
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Optional
 
 import dipy.reconst.dti as dti
-import nibabel as nb
 import numpy as np
+import torch
 from dipy.core.gradients import gradient_table, GradientTable
 from dipy.denoise.localpca import localpca
-from dipy.denoise.pca_noise_estimate import pca_noise_estimate
 from dipy.io import read_bvals_bvecs
 from dipy.segment.mask import median_otsu
+from scipy.ndimage import binary_dilation, gaussian_filter, uniform_filter1d
+from scipy.special import iv
 from nibabel.affines import apply_affine
-from scipy.interpolate import RegularGridInterpolator
 
+from dfibert.data._bundle import create_array, read_bundle, write_array, write_bundle, write_header
+from dfibert.data._loading import load_volume, get_file_identity
+from dfibert.data._sharing import MappedArray, get_mapped_array, get_shared_memory_path
+from dfibert.data.cache import DataContainerCache
 from dfibert.data.exceptions import PointOutsideOfDWIError
+from dfibert.data.interpolation import TrilinearInterpolator, from_bricks, to_bricks
 from dfibert.data.postprocessing import PostprocessingOption
+from dfibert.data.profiling import PreprocessingProfiler
+
+# set while a single step is profiled, so the step doesn't apply its parents again, see `DataPreprocessor._apply`
+_parents_applied = contextvars.ContextVar("parents_applied", default=False)
+# set by `DataPreprocessor.preprocess(inplace=True)`, the steps may then reuse the buffers of the given arrays
+_inplace = contextvars.ContextVar("inplace", default=False)
 
 
 class DataPreprocessor(object):
@@ -38,23 +57,92 @@ class DataPreprocessor(object):
             An optional previous DataPreprocessor we want to continue from
         """
         self._parent = parent
+        self.id = "DataPreprocessor" if parent is None else parent.id
+        # True if the DWI is stored in the packed or bricked layout after this step
+        self._changes_layout = parent is not None and parent._changes_layout
+        if self._changes_layout and not self._supports_dwi_layouts:
+            raise ValueError("{} can't follow pack_to_mask or brick, those have to be the last steps"
+                             .format(type(self).__name__))
+        if parent is not None and parent._is_last_step:
+            raise ValueError("{} can't follow quantize, it has to be the last step".format(type(self).__name__))
+
+    # True if the step gives the same result on any subset of the DWI volumes, see `_get_volume_selection`
+    _commutes_with_volume_selection = False
+    # True if the step can process DWI data in the packed or bricked layout
+    _supports_dwi_layouts = False
+    # True if the step treats every voxel on its own, so it can be applied slab by slab, see `preprocess_to`
+    _voxel_local = False
+    # True if no other step can follow this one, e.g. because it quantizes the DWI
+    _is_last_step = False
 
     def _preprocess(self, data_container: DataContainer) -> DataContainer:
-        if self._parent is None:
+        if self._parent is None or _parents_applied.get():
             return data_container
         else:
             return self._parent._preprocess(data_container)
 
-    def preprocess(self, data_container: DataContainer) -> DataContainer:
+    def _apply(self, data_container: DataContainer, profiler: Optional[PreprocessingProfiler] = None) -> DataContainer:
+        """
+        Applies all steps to the given DataContainer, recording every step with the given profiler.
+        """
+        if profiler is None:
+            return self._preprocess(data_container)
+        if self._parent is None:
+            return data_container
+        data_container = self._parent._apply(data_container, profiler)
+        token = _parents_applied.set(True)
+        try:
+            with profiler.record(self.id[len(self._parent.id):].lstrip("-")) as event:
+                data_container = self._preprocess(data_container)
+                event["bytes"] = data_container.nbytes
+        finally:
+            _parents_applied.reset(token)
+        return data_container
+
+    def _get_steps(self):
+        steps = []
+        step = self
+        while step._parent is not None:
+            steps.append(step)
+            step = step._parent
+        return steps[::-1]
+
+    def _get_volume_selection(self, bvals: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean mask of the DWI volumes which have to be loaded for this chain.
+
+        Volume crops are pushed down into the loading, as long as they are only preceded by steps
+        treating all volumes independently. Steps using all volumes (e.g. denoise or fa_estimate) end the search.
+        """
+        selection = np.ones(len(bvals), dtype=bool)
+        for step in self._get_steps():
+            if isinstance(step, _DataCropper):
+                selection[selection] = step._get_volume_mask(bvals[selection])
+            elif not step._commutes_with_volume_selection:
+                break
+        return selection
+
+    def preprocess(self, data_container: DataContainer, inplace: bool = False,
+                   profiler: Optional[PreprocessingProfiler] = None) -> DataContainer:
         """
         Returns a preprocessed DataContainer created by taking the given one and applying the given steps.
         Because data_containers are treated as immutable, the given data_container (and its numpy arrays)
-        won't be modified.
+        won't be modified, unless `inplace` is set.
+
+        No arrays are copied upfront. Instead, the steps receive read-only views
+        and only allocate the arrays they change. If `inplace` is True, the steps are allowed to
+        overwrite the (writeable) arrays of the given data_container: normalize runs on the existing DWI buffer,
+        crop compacts the kept volumes in it and copies them into an array of their size, so the full-sized
+        buffer is freed together with the given data_container.
 
         Parameters
         ----------
         data_container
             The given data_container
+        inplace
+            If True, the arrays of the given data_container may be modified by the steps.
+        profiler
+            An optional PreprocessingProfiler recording the time and memory of every step
 
         Returns
         -------
@@ -63,26 +151,119 @@ class DataPreprocessor(object):
         """
 
         dc = data_container
-        data_container = DataContainer(dc.bvals.copy(), dc.bvecs.copy(), dc.gtab.copy(), dc.t1.copy(), dc.dwi.copy(), dc.aff.copy(),
-                                       dc.binary_mask.copy(), dc.b0.copy(), None if dc.fa is None else dc.fa.copy())
-        return self._preprocess(data_container)
+        if not inplace:
+            data_container = dc._replace(bvals=_read_only(dc.bvals), bvecs=_read_only(dc.bvecs), t1=_read_only(dc.t1),
+                                         dwi=_read_only(dc.dwi), aff=_read_only(dc.aff),
+                                         binary_mask=_read_only(dc.binary_mask), b0=_read_only(dc.b0),
+                                         fa=_read_only(dc.fa), evals=_read_only(dc.evals), evecs=_read_only(dc.evecs))
+            return self._apply(data_container, profiler)
+        token = _inplace.set(True)
+        try:
+            return self._apply(data_container, profiler)
+        finally:
+            _inplace.reset(token)
+
+    def preprocess_to(self, data_container: DataContainer, path: str, slab_size: int = 8,
+                      metadata: Optional[dict] = None,
+                      profiler: Optional[PreprocessingProfiler] = None) -> DataContainer:
+        """
+        Preprocesses the given DataContainer out of core, slab by slab, into a DataContainer bundle
+        in the given directory (see `DataContainer.save`) and returns the opened bundle.
+
+        Every slab of `slab_size` x-slices is read from the given DataContainer (e.g. memory-mapped volumes of
+        a lazily loaded dataset), passed through all steps and written into the memory-mapped output files.
+        Therefore, only a few slabs have to be held in memory, even if the DWI is larger than the RAM.
+        This requires all steps to treat every voxel on its own, which holds for normalize, crop and fa_estimate.
+
+        Parameters
+        ----------
+        data_container
+            The DataContainer to preprocess, it isn't modified
+        path
+            The directory the preprocessed DataContainer is written to
+        slab_size
+            The number of x-slices processed at once
+        metadata
+            Optional JSON-serializable data stored in the header
+        profiler
+            An optional PreprocessingProfiler recording the time and memory of every step per slab
+
+        Returns
+        -------
+        DataContainer
+            The preprocessed DataContainer, memory-mapped from the written files
+        """
+        self._check_streamable()
+        dc = data_container
+        os.makedirs(path, exist_ok=True)
+        names = ("dwi", "binary_mask", "b0", "fa", "evals", "evecs")
+        outputs = None
+        descriptions = {}
+        slab = dc
+        for start in range(0, dc.shape[0], slab_size):
+            volumes = {name: getattr(dc, name) for name in names}
+            # copies of the slabs, so the steps can work in place on them
+            volumes = {name: None if volume is None else np.array(volume[start:start + slab_size])
+                       for name, volume in volumes.items()}
+            slab = self._apply(dc._replace(t1=None, **volumes), profiler)
+            if outputs is None:
+                outputs = {}
+                for name in names:
+                    volume = getattr(slab, name)
+                    if volume is not None:
+                        outputs[name], descriptions[name] = create_array(
+                            os.path.join(path, name + ".raw"), volume.dtype, (dc.shape[0], *volume.shape[1:]))
+            for name, output in outputs.items():
+                output[start:start + slab_size] = getattr(slab, name)
+        for output in (outputs or {}).values():
+            if isinstance(output, np.memmap):
+                output.flush()
+        del outputs
+        if dc.t1 is not None:
+            descriptions["t1"] = write_array(os.path.join(path, "t1.raw"), dc.t1)
+        header = {"bvals": np.asarray(slab.bvals).tolist(), "bvecs": np.asarray(slab.bvecs).tolist(),
+                  "affine": np.asarray(dc.aff).tolist(), "dwi_scale": dc.dwi_scale,
+                  "feature_dtype": dc.feature_dtype.str, "metadata": metadata or {}}
+        write_header(path, header, descriptions)
+        return DataContainer.open(path)
+
+    def _check_streamable(self):
+        """
+        Raises a ValueError if one of the steps can't be applied slab by slab, see `preprocess_to`.
+        """
+        steps = [step for step in self._get_steps() if not step._voxel_local]
+        if steps:
+            raise ValueError("{} can't be applied slab by slab, only normalize, crop and fa_estimate can be streamed"
+                             .format(", ".join(type(step).__name__ for step in steps)))
 
-    def denoise(self, smooth=3, patch_radius=3) -> DataPreprocessor:
+    def denoise(self, smooth=3, patch_radius=3, tile_size=32, workers=1) -> DataPreprocessor:
         """
         Denoises the data using Local PCA with empirical thresholds
 
+        The volume is denoised in overlapping spatial tiles, so the temporary arrays of Local PCA
+        are bounded by the tile size. Every tile is extended by a halo of `2 * patch_radius` voxels,
+        which contains all patches contributing to the voxels of the tile, therefore the stitched result
+        equals the result of denoising the whole volume at once. The noise estimate of dipy's
+        `pca_noise_estimate` is computed in slabs of `tile_size` voxels along the x axis, extended by the
+        radius of its Gaussian filter (`4 * smooth` voxels) on both sides. So besides the denoised volume,
+        the memory is bounded by the tile size and the smoothing radius instead of the size of the volume.
+
         Parameters
         ----------
         smooth
             the voxel radius used by the Gaussian filter for the noise estimate
         patch_radius
             the voxel radius used by the Local PCA algorithm to denoise
+        tile_size
+            the edge length of the tiles in voxels, without the halo
+        workers
+            the number of processes denoising tiles in parallel
         Returns
         -------
         DataPreprocessor
             A new DataPreprocessor, incorporating the previous steps plus the new denoise
         """
-        return _DataDenoiser(self, smooth, patch_radius)
+        return _DataDenoiser(self, smooth, patch_radius, tile_size, workers)
 
     def normalize(self) -> DataPreprocessor:
         """
@@ -118,18 +299,122 @@ class DataPreprocessor(object):
         """
         return _DataCropper(self, b_value, max_deviation, b0_threshold)
 
-    def fa_estimate(self):
+    def crop_to_mask(self, margin=2) -> DataPreprocessor:
+        """
+        Crops all volumes spatially to the bounding box of the brain mask.
+
+        The translation of the bounding box is folded into the affine,
+        so `to_ijk` and `to_ras` stay correct for the cropped volumes.
+
+        Parameters
+        ----------
+        margin
+            the number of voxels kept around the bounding box on every side, if available
+        Returns
+        -------
+        DataPreprocessor
+            A new DataPreprocessor, incorporating the previous steps plus the new crop_to_mask
+        """
+        return _DataMaskCropper(self, margin)
+
+    def pack_to_mask(self, margin=1) -> DataPreprocessor:
+        """
+        Stores only the DWI values of the voxels inside of the brain mask.
+
+        The DWI becomes a packed array of the shape (N + 1, C) holding the N mask voxels, row 0 holds zeros.
+        The int32 volume `DataContainer.dwi_index` maps every voxel to its row, voxels outside of the mask
+        to row 0. The interpolation gathers the corner voxels through the index, so voxels outside of the mask
+        are treated as zero. Postprocessed volumes are stored in the same layout.
+
+        The mask is dilated by `margin` voxels before packing. With the default margin of 1,
+        all corners of points inside of the mask are packed, so their interpolated values are unchanged.
+
+        This should be the last step (it can only be followed by quantize), `DataContainer.get_dwi`
+        returns the dense DWI for other tools.
+
+        Parameters
+        ----------
+        margin
+            the number of voxels the brain mask is dilated by
+        Returns
+        -------
+        DataPreprocessor
+            A new DataPreprocessor, incorporating the previous steps plus the new pack_to_mask
+        """
+        return _DataMaskPacker(self, margin)
+
+    def brick(self, brick_size=8) -> DataPreprocessor:
+        """
+        Stores the DWI in bricks of `brick_size`^3 voxels with contiguous channels, see `interpolation.to_bricks`.
+
+        The corner voxels of neighbouring points are close in memory, which can reduce cache misses
+        of the interpolation if the DWI has few channels. The DWI gets the shape (X', Y', Z', B, B, B, C),
+        postprocessed volumes are stored in the same layout.
+
+        This should be the last step (it can only be followed by quantize), `DataContainer.get_dwi`
+        returns the dense DWI for other tools.
+
+        Parameters
+        ----------
+        brick_size
+            the edge length of the bricks in voxels
+        Returns
+        -------
+        DataPreprocessor
+            A new DataPreprocessor, incorporating the previous steps plus the new brick
+        """
+        return _DataBricker(self, brick_size)
+
+    def quantize(self, dtype="float16", features: bool = True) -> DataPreprocessor:
+        """
+        Stores the DWI data with 16 bit precision to halve its memory footprint and bandwidth.
+
+        With `float16`, the DWI is stored as half precision floats. With `uint16`, the DWI is divided by
+        `DataContainer.dwi_scale` and rounded to unsigned integers, which is more accurate for
+        normalized data in [0, 1]. The interpolation only upcasts the gathered corner voxels,
+        so results are returned in single precision.
+
+        This has to be the last step, because following steps would see the quantized DWI values.
+
+        Parameters
+        ----------
+        dtype
+            the storage dtype of the DWI, `float16` or `uint16`
+        features
+            if True, the postprocessed volumes of `get_postprocessed_volume` are stored with 16 bits as well,
+            as float16 or as int16 scaled by `DataContainer.get_feature_scale`
+        Returns
+        -------
+        DataPreprocessor
+            A new DataPreprocessor, incorporating the previous steps plus the new quantize
+        """
+        return _DataQuantizer(self, dtype, features)
+
+    def fa_estimate(self, workers: int = 1, slabs_per_worker: int = 4):
         """
         Does the FA estimation at the current position in the pipeline
 
+        The DTI model is fitted slab by slab along the x axis, the slabs are balanced by their number of
+        brain mask voxels. Besides the FA, the eigenvalues and eigenvectors of the tensor fit are
+        stored in the DataContainer, see `DataContainer.get_tensor_fit`.
+
+        Parameters
+        ----------
+        workers
+            The number of processes fitting the slabs in parallel
+        slabs_per_worker
+            The number of slabs per worker, more slabs balance the load better
         Returns
         -------
         DataPreprocessor
             A new DataPreprocessor, incorporating the previous steps plus the new fa estimate
         """
-        return _DataFAEstimator(self)
+        return _DataFAEstimator(self, workers, slabs_per_worker)
 
-    def get_hcp(self, path: str, b0_threshold: float = 10.0) -> DataContainer:
+    def get_hcp(self, path: str, b0_threshold: float = 10.0, lazy: bool = False,
+                lazy_cache_path: Optional[str] = None, cache: Optional[DataContainerCache] = None,
+                load_t1: bool = True, load_workers: int = 4, streaming: bool = False,
+                slab_size: int = 8, profiler: Optional[PreprocessingProfiler] = None) -> DataContainer:
         """
         Loads a HCP Dataset and preprocesses it, returning a DataContainer
 
@@ -139,6 +424,31 @@ class DataPreprocessor(object):
             The path of the HCP Dataset
         b0_threshold
             The threshold for the b0 image
+        lazy
+            If True, the DWI, T1 and mask are kept as read-only memory-mapped arrays,
+            which are only read from disk as soon as they are accessed.
+            Gzipped images are converted once into an uncompressed cache for this.
+        lazy_cache_path
+            The folder converted images are cached in, by default `~/.cache/dfibert`. Conversions of older
+            versions of an image are removed, see `dfibert.data._loading.load_volume`.
+        cache
+            An optional DataContainerCache. If it contains the result of this preprocessing chain
+            for the given dataset, the cached result is memory-mapped instead of recomputing it.
+        load_t1
+            If False, the T1 image is not loaded and `DataContainer.t1` is None.
+        load_workers
+            The number of threads reading the DWI image. All files are loaded concurrently,
+            the time spent per file is reported in `DataContainer.load_times`.
+        streaming
+            If True, the images are loaded lazily and preprocessed slab by slab into the cache
+            (by default a `DataContainerCache` in `~/.cache/dfibert/preprocessed`), see `preprocess_to`.
+            The peak memory then only depends on `slab_size`, not on the size of the DWI.
+            Only normalize, crop and fa_estimate can be streamed.
+        slab_size
+            The number of x-slices preprocessed at once if streaming
+        profiler
+            An optional PreprocessingProfiler recording the time and memory of every file load
+            and every preprocessing step, see `dfibert.data.profiling`
         Returns
         -------
         DataContainer
@@ -147,9 +457,13 @@ class DataPreprocessor(object):
 
         file_mapping = {'bvals': 'bvals', 'bvecs': 'bvecs', 'img': 'data.nii.gz',
                         't1': 'T1w_acpc_dc_restore_1.25.nii.gz', 'mask': 'nodif_brain_mask.nii.gz'}
-        return self._get_from_file_mapping(path, file_mapping, b0_threshold)
+        return self._get_from_file_mapping(path, file_mapping, b0_threshold, lazy, lazy_cache_path, cache,
+                                           load_t1, load_workers, streaming, slab_size, profiler)
 
-    def get_ismrm(self, path: str, b0_threshold: float = 10.0) -> DataContainer:
+    def get_ismrm(self, path: str, b0_threshold: float = 10.0, lazy: bool = False,
+                  lazy_cache_path: Optional[str] = None, cache: Optional[DataContainerCache] = None,
+                  load_t1: bool = True, load_workers: int = 4, streaming: bool = False,
+                  slab_size: int = 8, profiler: Optional[PreprocessingProfiler] = None) -> DataContainer:
         """
         Loads a ISMRM Dataset and preprocesses it, returning a DataContainer
 
@@ -159,6 +473,31 @@ class DataPreprocessor(object):
             The path of the ISMRM Dataset
         b0_threshold
             The threshold for the b0 image
+        lazy
+            If True, the DWI and T1 are kept as read-only memory-mapped arrays,
+            which are only read from disk as soon as they are accessed.
+            Gzipped images are converted once into an uncompressed cache for this.
+        lazy_cache_path
+            The folder converted images are cached in, by default `~/.cache/dfibert`. Conversions of older
+            versions of an image are removed, see `dfibert.data._loading.load_volume`.
+        cache
+            An optional DataContainerCache. If it contains the result of this preprocessing chain
+            for the given dataset, the cached result is memory-mapped instead of recomputing it.
+        load_t1
+            If False, the T1 image is not loaded and `DataContainer.t1` is None.
+        load_workers
+            The number of threads reading the DWI image. All files are loaded concurrently,
+            the time spent per file is reported in `DataContainer.load_times`.
+        streaming
+            If True, the images are loaded lazily and preprocessed slab by slab into the cache
+            (by default a `DataContainerCache` in `~/.cache/dfibert/preprocessed`), see `preprocess_to`.
+            The peak memory then only depends on `slab_size`, not on the size of the DWI.
+            Only normalize, crop and fa_estimate can be streamed.
+        slab_size
+            The number of x-slices preprocessed at once if streaming
+        profiler
+            An optional PreprocessingProfiler recording the time and memory of every file load
+            and every preprocessing step, see `dfibert.data.profiling`
         Returns
         -------
         DataContainer
@@ -166,61 +505,247 @@ class DataPreprocessor(object):
         """
         file_mapping = {'bvals': 'Diffusion.bvals', 'bvecs': 'Diffusion.bvecs',
                         'img': 'Diffusion.nii.gz', 't1': 'T1.nii.gz'}
-        return self._get_from_file_mapping(path, file_mapping, b0_threshold)
-
-    def _get_from_file_mapping(self, path, file_mapping: dict, b0_threshold: float = 10.0):
-
-        path_mapping = {key: os.path.join(path, file_mapping[key]) for key in file_mapping}
-        bvals, bvecs = read_bvals_bvecs(path_mapping['bvals'],
-                                        path_mapping['bvecs'])
+        return self._get_from_file_mapping(path, file_mapping, b0_threshold, lazy, lazy_cache_path, cache,
+                                           load_t1, load_workers, streaming, slab_size, profiler)
 
-        # img, t1, gradient table, affine and dwi
-        img = nb.load(path_mapping['img'])
-        t1 = nb.load(path_mapping['t1']).get_data()
+    def _get_cache_key(self, path_mapping: dict, b0_threshold: float, load_t1: bool = True) -> str:
+        identity = {"preprocessor": self.id, "b0_threshold": b0_threshold,
+                    "files": {key: get_file_identity(path_mapping[key]) for key in path_mapping}}
+        if not load_t1:
+            identity["load_t1"] = False
+        return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
 
-        dwi = img.get_data().astype("float32")
+    def _get_from_file_mapping(self, path, file_mapping: dict, b0_threshold: float = 10.0, lazy: bool = False,
+                               lazy_cache_path: Optional[str] = None, cache: Optional[DataContainerCache] = None,
+                               load_t1: bool = True, load_workers: int = 4, streaming: bool = False,
+                               slab_size: int = 8, profiler: Optional[PreprocessingProfiler] = None):
 
-        aff = img.affine
-
-        # binary mask
-        if 'mask' in path_mapping:
-            binary_mask = nb.load(path_mapping['mask']).get_data()
-        else:
-            _, binary_mask = median_otsu(dwi[..., 0], 2, 1)
+        path_mapping = {key: os.path.join(path, file_mapping[key]) for key in file_mapping}
+        if streaming:
+            # checked before anything is loaded or converted
+            self._check_streamable()
+            # the images are read slab by slab from their memory maps, the result is written into the cache
+            lazy = True
+            cache = cache if cache is not None else DataContainerCache()
+        if cache is not None:
+            cache_key = self._get_cache_key(path_mapping, b0_threshold, load_t1)
+            with _record(profiler, 'cache', "load") as event:
+                data_container = cache.get(cache_key)
+                event["bytes"] = _get_nbytes(data_container)
+            if data_container is not None:
+                return data_container
+
+        load_times = {}
+
+        def timed(key, function, *args, **kwargs):
+            with _record(profiler, key, "preprocess" if key == 'preprocessing' else "load") as event:
+                start = time.perf_counter()
+                result = function(*args, **kwargs)
+                load_times[key] = time.perf_counter() - start
+                event["bytes"] = _get_nbytes(result)
+            return result
+
+        bvals, bvecs = timed('bvals', read_bvals_bvecs, path_mapping['bvals'],
+                             path_mapping['bvecs'])
+
+        # only volumes kept by the crop steps are read, plus the b0 volumes
+        selection = self._get_volume_selection(bvals) | (bvals < b0_threshold)
+        if 'mask' not in path_mapping:
+            selection[0] = True
+        volumes = None if np.all(selection) else np.flatnonzero(selection)
+        bvals, bvecs = bvals[selection], bvecs[selection]
+
+        # img, t1, gradient table, affine and dwi - the files are independent, so they are loaded concurrently
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            dwi_future = executor.submit(timed, 'img', load_volume, path_mapping['img'], dtype="float32", lazy=lazy,
+                                         cache_path=lazy_cache_path, volumes=volumes, workers=load_workers)
+            t1_future = executor.submit(timed, 't1', load_volume, path_mapping['t1'], lazy=lazy,
+                                        cache_path=lazy_cache_path) if load_t1 else None
+            mask_future = executor.submit(timed, 'mask', load_volume, path_mapping['mask'], lazy=lazy,
+                                          cache_path=lazy_cache_path) if 'mask' in path_mapping else None
+            dwi, aff = dwi_future.result()
+            t1 = t1_future.result()[0] if t1_future is not None else None
+
+            # binary mask
+            if mask_future is not None:
+                binary_mask, _ = mask_future.result()
+            else:
+                _, binary_mask = median_otsu(dwi[..., 0], 2, 1)
 
         # calculating b0
-        b0 = dwi[..., bvals < b0_threshold].mean(axis=-1)
+        with _record(profiler, 'b0', "preprocess") as event:
+            if lazy:
+                b0 = _mean_volumes(dwi, np.flatnonzero(bvals < b0_threshold), slab_size)
+            else:
+                b0 = dwi[..., bvals < b0_threshold].mean(axis=-1)
+            event["bytes"] = b0.nbytes
 
         # Do not generate fa yet
         fa = None
         gtab = gradient_table(bvals, bvecs)
         data_container = DataContainer(bvals, bvecs, gtab, t1, dwi, aff, binary_mask, b0, fa)
-        return self._preprocess(data_container)
+        if streaming:
+            # write returns the entry opened before the eviction, so it can't be evicted in between
+            data_container = timed('preprocessing', cache.write, cache_key,
+                                   lambda entry_path, metadata: self.preprocess_to(data_container, entry_path,
+                                                                                   slab_size, metadata, profiler),
+                                   source=path)
+            data_container.load_times = load_times
+            return data_container
+        data_container = timed('preprocessing', self._apply, data_container, profiler)
+        data_container.load_times = load_times
+        if cache is not None:
+            cache.put(cache_key, data_container, source=path)
+        return data_container
 
 
 class _DataCropper(DataPreprocessor):
+    _voxel_local = True
+
     def __init__(self, parent, b_value, max_deviation, b0_threshold):
         super().__init__(parent)
         self.b_value = b_value
         self.max_deviation = max_deviation
         self.b0_threshold = b0_threshold
+        self.id = self.id + "-crop-b{}-deviation{}-b0threshold{}".format(b_value, max_deviation, b0_threshold)
 
     def _preprocess(self, data_container: DataContainer) -> DataContainer:
         dc = \
             super()._preprocess(data_container)
 
-        mask = (np.abs(dc.bvals - self.b_value) < self.max_deviation) | (dc.bvals < self.b0_threshold)
+        mask = self._get_volume_mask(dc.bvals)
 
-        dwi = dc.dwi[..., mask]
+        dwi = dc.dwi
+        if np.all(mask):
+            pass
+        elif _inplace.get() and dwi.flags.writeable and (dwi.flags.c_contiguous or dwi.flags.f_contiguous):
+            # copied, so the cropped DWI doesn't keep the full-sized buffer alive
+            dwi = _select_volumes_inplace(dwi, np.flatnonzero(mask)).copy()
+        else:
+            dwi = dwi[..., mask]
         bvals = dc.bvals[mask]
         bvecs = dc.bvecs[mask]
         gtab = gradient_table(bvals, bvecs)
-        return DataContainer(bvals, bvecs, gtab, dc.t1, dwi, dc.aff, dc.binary_mask, dc.b0, dc.fa)
+        return dc._replace(bvals=bvals, bvecs=bvecs, gtab=gtab, dwi=dwi)
+
+    def _get_volume_mask(self, bvals: np.ndarray) -> np.ndarray:
+        return (np.abs(bvals - self.b_value) < self.max_deviation) | (bvals < self.b0_threshold)
+
+
+class _DataMaskCropper(DataPreprocessor):
+    _commutes_with_volume_selection = True
+
+    def __init__(self, parent, margin):
+        super().__init__(parent)
+        self.margin = margin
+        self.id = self.id + "-crop_to_mask-margin{}".format(margin)
+
+    def _preprocess(self, data_container: DataContainer) -> DataContainer:
+        dc = \
+            super()._preprocess(data_container)
+
+        shape = dc.dwi.shape[:3]
+        nonzero = np.nonzero(dc.binary_mask)
+        if len(nonzero[0]) == 0:
+            return dc
+        lower = [max(int(axis.min()) - self.margin, 0) for axis in nonzero]
+        upper = [min(int(axis.max()) + 1 + self.margin, size) for axis, size in zip(nonzero, shape)]
+        box = tuple(slice(start, stop) for start, stop in zip(lower, upper))
+
+        def crop(volume):
+            # copied, so the full-sized volumes can be freed and the cropped ones are contiguous again
+            return np.ascontiguousarray(volume[box]) if volume is not None else None
+
+        translation = np.eye(4)
+        translation[:3, 3] = lower
+        # volumes of other resolutions (e.g. a T1 image) are kept as they are
+        t1 = crop(dc.t1) if dc.t1 is not None and dc.t1.shape[:3] == shape else dc.t1
+        return dc._replace(t1=t1, dwi=crop(dc.dwi), aff=dc.aff @ translation, binary_mask=crop(dc.binary_mask),
+                           b0=crop(dc.b0), fa=crop(dc.fa), evals=crop(dc.evals), evecs=crop(dc.evecs))
+
+
+class _DataMaskPacker(DataPreprocessor):
+    def __init__(self, parent, margin):
+        super().__init__(parent)
+        self.margin = margin
+        self._changes_layout = True
+        self.id = self.id + "-pack_to_mask-margin{}".format(margin)
+
+    def _preprocess(self, data_container: DataContainer) -> DataContainer:
+        dc = \
+            super()._preprocess(data_container)
+
+        mask = dc.binary_mask > 0
+        if self.margin > 0:
+            mask = binary_dilation(mask, structure=np.ones((3, 3, 3), dtype=bool), iterations=self.margin)
+        dwi_index = np.zeros(mask.shape, dtype=np.int32)
+        dwi_index[mask] = np.arange(1, np.count_nonzero(mask) + 1, dtype=np.int32)
+        packed = np.empty((np.count_nonzero(mask) + 1, dc.dwi.shape[-1]), dtype=dc.dwi.dtype)
+        packed[0] = 0
+        # gathered slab by slab, so a memory-mapped DWI is never read at once
+        row = 1
+        for start in range(0, mask.shape[0], 4):
+            slab = np.asarray(dc.dwi[start:start + 4])[mask[start:start + 4]]
+            packed[row:row + len(slab)] = slab
+            row += len(slab)
+        return dc._replace(dwi=packed, dwi_index=dwi_index)
+
+
+class _DataBricker(DataPreprocessor):
+    def __init__(self, parent, brick_size):
+        super().__init__(parent)
+        self.brick_size = brick_size
+        self._changes_layout = True
+        self.id = self.id + "-brick-size{}".format(brick_size)
+
+    def _preprocess(self, data_container: DataContainer) -> DataContainer:
+        dc = \
+            super()._preprocess(data_container)
+        return dc._replace(dwi=to_bricks(dc.dwi, self.brick_size))
+
+
+class _DataQuantizer(DataPreprocessor):
+    _supports_dwi_layouts = True
+    _is_last_step = True
+
+    def __init__(self, parent, dtype, features):
+        super().__init__(parent)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float16, np.uint16):
+            raise ValueError("DWI data can only be quantized to float16 or uint16, not {}".format(self.dtype))
+        self.features = features
+        self.id = self.id + "-quantize-{}-features{}".format(self.dtype.name, features)
+
+    def _preprocess(self, data_container: DataContainer) -> DataContainer:
+        dc = \
+            super()._preprocess(data_container)
+
+        # the DWI is quantized in its stored (dense or packed) layout
+        dwi = dc._dequantize(dc.dwi)
+        dwi_scale = None
+        if self.dtype == np.uint16:
+            dwi_scale = float(max(np.max(dwi), np.finfo(np.float32).tiny)) / np.iinfo(np.uint16).max
+            quantized = np.empty(dwi.shape, dtype=np.uint16)
+            # slab by slab, so no full-sized temporary is needed
+            for start in range(0, dwi.shape[0], 4):
+                slab = np.clip(dwi[start:start + 4] / dwi_scale, 0, np.iinfo(np.uint16).max)
+                quantized[start:start + 4] = np.rint(slab)
+        else:
+            quantized = dwi.astype(np.float16)
+        feature_dtype = dc.feature_dtype
+        if self.features:
+            # postprocessed volumes can be negative, they are stored as signed integers instead of uint16
+            feature_dtype = np.float16 if self.dtype == np.float16 else np.int16
+        return dc._replace(dwi=quantized, dwi_scale=dwi_scale, feature_dtype=feature_dtype)
 
 
 class _DataNormalizer(DataPreprocessor):
+    _commutes_with_volume_selection = True
+    _voxel_local = True
+
     def __init__(self, parent):
         super().__init__(parent)
+        self.id = self.id + "-normalize"
 
     def _preprocess(self, data_container: DataContainer) -> DataContainer:
         dc = \
@@ -228,52 +753,301 @@ class _DataNormalizer(DataPreprocessor):
 
         b0 = dc.b0[..., None]
         dwi = dc.dwi
-        nb_erroneous_voxels = np.sum(dc.dwi > b0)
-        if nb_erroneous_voxels != 0:
-            dwi = np.minimum(dwi, b0)
+        # the normalized DWI is written into the given one, if we are allowed to
+        out = dwi if dwi.flags.writeable and dwi.dtype == np.result_type(dwi, b0) else None
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            dwi = dwi / b0
-            dwi[np.logical_not(np.isfinite(dwi))] = 0.
+            # erroneous voxels with values larger than the b0 value are clipped
+            dwi = np.minimum(dwi, b0, out=out)
+            np.divide(dwi, b0, out=dwi)
+            invalid = np.isfinite(dwi)
+            np.logical_not(invalid, out=invalid)
+            np.copyto(dwi, 0., where=invalid)
 
-        return DataContainer(dc.bvals, dc.bvecs, dc.gtab, dc.t1, dwi, dc.aff, dc.binary_mask, dc.b0, dc.fa)
+        return dc._replace(dwi=dwi)
 
 
 class _DataDenoiser(DataPreprocessor):
-    def __init__(self, parent, smooth, patch_radius):
+    def __init__(self, parent, smooth, patch_radius, tile_size, workers):
         super().__init__(parent)
         self.smooth = smooth
         self.patch_radius = patch_radius
+        self.tile_size = tile_size
+        self.workers = workers
+        # tiling doesn't change the result, so it is not part of the id
+        self.id = self.id + "-denoise-smooth{}-radius{}".format(smooth, patch_radius)
 
     def _preprocess(self, data_container: DataContainer) -> DataContainer:
         dc = super()._preprocess(data_container)
-        sigma = pca_noise_estimate(dc.dwi, dc.gtab, correct_bias=True,
-                                   smooth=self.smooth)
-        dwi = localpca(dc.dwi, sigma=sigma,
-                       patch_radius=self.patch_radius)
-        return DataContainer(dc.bvals, dc.bvecs, dc.gtab, dc.t1, dwi, dc.aff, dc.binary_mask, dc.b0, dc.fa)
+        sigma = _estimate_noise(dc.dwi, dc.gtab, self.smooth, self.tile_size)
+        # the output can't be written in place, the halos of later tiles still need the noisy data
+        dwi = np.empty(dc.dwi.shape, dtype=dc.dwi.dtype)
+        tiles = _get_tiles(dc.dwi.shape[:3], self.tile_size, 2 * self.patch_radius)
+        arguments = [(dc.dwi[outer], sigma[outer], self.patch_radius, inner) for outer, inner, _ in tiles]
+        if self.workers > 1 and len(tiles) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for (_, _, target), denoised in zip(tiles, executor.map(_denoise_tile, *zip(*arguments))):
+                    dwi[target] = denoised
+        else:
+            for (_, _, target), argument in zip(tiles, arguments):
+                dwi[target] = _denoise_tile(*argument)
+        return dc._replace(dwi=dwi)
+
+
+def _denoise_tile(dwi: np.ndarray, sigma: np.ndarray, patch_radius: int, inner: tuple) -> np.ndarray:
+    """
+    Denoises the given tile including its halo, returning the denoised voxels without the halo.
+    """
+    return localpca(np.asarray(dwi), sigma=sigma, patch_radius=patch_radius)[inner]
+
+
+def _estimate_noise(dwi: np.ndarray, gtab: GradientTable, smooth: float, slab_size: int,
+                    patch_radius: int = 1) -> np.ndarray:
+    """
+    Returns the local noise standard deviation of `pca_noise_estimate(dwi, gtab, patch_radius, correct_bias=True,
+    smooth=smooth)`, computed in slabs of `slab_size` voxels along the x axis.
+
+    The PCA over all voxels is accumulated slab by slab. Everything else only depends on the neighbourhood
+    of a voxel (the patches and the Gaussian filter), so every slab is computed with a halo.
+    The result equals the one of dipy up to the rounding of the PCA.
+    """
+    # MUBE for multiple b0 volumes, otherwise SIBE on the diffusion weighted volumes
+    volumes = gtab.b0s_mask if np.count_nonzero(gtab.b0s_mask) > 1 else ~gtab.b0s_mask
+    shape = dwi.shape[:3]
+    slabs = [(start, min(start + slab_size, shape[0])) for start in range(0, shape[0], slab_size)]
+
+    def read(start, stop):
+        return dwi[start:stop][..., volumes].astype(np.float64)
+
+    mean = sum(read(start, stop).reshape(-1, np.count_nonzero(volumes)).sum(axis=0) for start, stop in slabs)
+    mean = mean / np.prod(shape)
+    covariance = 0
+    for start, stop in slabs:
+        samples = read(start, stop).reshape(-1, len(mean))
+        samples -= mean
+        covariance = covariance + samples.T @ samples
+    # the component with the smallest variance is considered noise
+    component = np.linalg.eigh(covariance)[1][:, 0]
+
+    def box_sum(values, axes):
+        for axis in axes:
+            values = uniform_filter1d(values, 2 * patch_radius + 1, axis=axis, mode='constant') \
+                * (2 * patch_radius + 1)
+        return values
+
+    # the patch centres are the voxels whose patch is inside of the volume
+    centres = []
+    for size in shape:
+        centre = np.zeros(size)
+        centre[patch_radius:size - patch_radius] = 1
+        centres.append(centre)
+    counts = [box_sum(centre, [0]) for centre in centres]
+    norm = (2 * patch_radius + 1) ** 3
+    smooth_radius = 0 if smooth is None else int(4.0 * smooth + 0.5)
+
+    sigma = np.empty(shape)
+    for start, stop in slabs:
+        # the Gaussian filter needs the variance around the slab, which needs the patches around that
+        smooth_start, smooth_stop = max(start - smooth_radius, 0), min(stop + smooth_radius, shape[0])
+        read_start = max(smooth_start - 2 * patch_radius, 0)
+        read_stop = min(smooth_stop + 2 * patch_radius, shape[0])
+        data = read(read_start, read_stop)
+        noise = data @ component - mean @ component
+        is_centre = centres[0][read_start:read_stop, None, None] * centres[1][None, :, None] \
+            * centres[2][None, None, :]
+        count = counts[0][read_start:read_stop, None, None] * counts[1][None, :, None] * counts[2][None, None, :]
+        # every voxel gets the mean squared deviation from the means of the patches containing it
+        patch_mean = box_sum(noise, (0, 1, 2)) / norm * is_centre
+        signal_mean = box_sum(data.mean(axis=-1), (0, 1, 2)) / norm * is_centre
+        core = slice(smooth_start - read_start, smooth_stop - read_start)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_of_means = (box_sum(patch_mean, (0, 1, 2)) / count)[core]
+            variance = (noise[core] - mean_of_means) ** 2 \
+                + (box_sum(patch_mean ** 2, (0, 1, 2)) / count)[core] - mean_of_means ** 2
+            signal_mean = (box_sum(signal_mean, (0, 1, 2)) / count)[core]
+
+            # correction of the bias due to Rician noise
+            snr = np.zeros_like(variance)
+            positive = variance > 0
+            snr[positive] = signal_mean[positive] / np.sqrt(variance[positive])
+            snr_sq = snr ** 2
+            with np.errstate(over='ignore'):
+                xi = 2 + snr_sq - np.pi / 8 * np.exp(-snr_sq / 2) \
+                    * ((2 + snr_sq) * iv(0, snr_sq / 4) + snr_sq * iv(1, snr_sq / 4)) ** 2
+            xi[snr > 37.4] = 1
+            variance = variance / xi
+        variance[np.isnan(variance)] = 0
+        if smooth is not None:
+            variance = gaussian_filter(variance, smooth)
+        sigma[start:stop] = np.sqrt(variance[start - smooth_start:stop - smooth_start])
+    return sigma
+
+
+def _get_tiles(shape: tuple, tile_size: int, halo: int):
+    """
+    Splits a volume of the given shape into tiles. Returns (outer, inner, target) index tuples for every tile:
+    `outer` selects the tile with its halo from the volume, `inner` selects the tile without the halo
+    from the outer tile and `target` selects the tile without the halo from the volume.
+    """
+    tiles = []
+    ranges = [range(0, size, tile_size) for size in shape]
+    for starts in np.ndindex(*[len(axis_range) for axis_range in ranges]):
+        outer, inner, target = [], [], []
+        for axis_range, index, size in zip(ranges, starts, shape):
+            start = axis_range[index]
+            stop = min(start + tile_size, size)
+            outer_start, outer_stop = max(start - halo, 0), min(stop + halo, size)
+            outer.append(slice(outer_start, outer_stop))
+            inner.append(slice(start - outer_start, stop - outer_start))
+            target.append(slice(start, stop))
+        tiles.append((tuple(outer), tuple(inner), tuple(target)))
+    return tiles
 
 
 class _DataFAEstimator(DataPreprocessor):
-    def __init__(self, parent):
+    _voxel_local = True
+
+    def __init__(self, parent, workers, slabs_per_worker):
         super().__init__(parent)
+        self.workers = workers
+        self.slabs_per_worker = slabs_per_worker
+        # the number of workers doesn't change the result, so it is not part of the id
+        self.id = self.id + "-fa_estimate"
 
     def _preprocess(self, data_container: DataContainer) -> DataContainer:
         dc = \
             super()._preprocess(data_container)
 
         # calculating fractional anisotropy (fa)
-        dti_model = dti.TensorModel(dc.gtab, fit_method='LS')
-        dti_fit = dti_model.fit(dc.dwi, mask=dc.binary_mask)
-        fa = dti_fit.fa
-        return DataContainer(dc.bvals, dc.bvecs, dc.gtab, dc.t1, dc.dwi, dc.aff, dc.binary_mask, dc.b0, fa)
+        evals = np.zeros(dc.dwi.shape[:3] + (3,), dtype=np.float32)
+        evecs = np.zeros(dc.dwi.shape[:3] + (3, 3), dtype=np.float32)
+        slabs = _get_balanced_slabs(dc.binary_mask, self.workers * self.slabs_per_worker)
+        arguments = [(dc.gtab, dc.dwi[start:stop], dc.binary_mask[start:stop]) for start, stop in slabs]
+        if self.workers > 1 and len(slabs) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(_fit_tensor, *zip(*arguments))
+                for (start, stop), (slab_evals, slab_evecs) in zip(slabs, results):
+                    evals[start:stop], evecs[start:stop] = slab_evals, slab_evecs
+        else:
+            for (start, stop), argument in zip(slabs, arguments):
+                evals[start:stop], evecs[start:stop] = _fit_tensor(*argument)
+        fa = dti.fractional_anisotropy(evals.astype(np.float64))
+        return dc._replace(fa=fa, evals=evals, evecs=evecs)
+
+
+def _fit_tensor(gtab: GradientTable, dwi: np.ndarray, mask: np.ndarray):
+    """
+    Fits the DTI model to the given slab, returning its eigenvalues and eigenvectors in single precision.
+    """
+    dti_fit = dti.TensorModel(gtab, fit_method='LS').fit(np.asarray(dwi), mask=mask)
+    return dti_fit.evals.astype(np.float32), dti_fit.evecs.astype(np.float32)
+
+
+def _get_balanced_slabs(mask: np.ndarray, no_slabs: int):
+    """
+    Splits the x range of the given mask into at most `no_slabs` (start, stop) slabs
+    containing about the same number of mask voxels. Slices without mask voxels at the borders are skipped.
+    """
+    counts = np.count_nonzero(mask.reshape(mask.shape[0], -1), axis=1)
+    nonzero = np.flatnonzero(counts)
+    if len(nonzero) == 0:
+        return []
+    cumulative = np.cumsum(counts)
+    targets = cumulative[-1] * np.arange(1, no_slabs) / no_slabs
+    bounds = np.unique(np.concatenate(([nonzero[0]], np.searchsorted(cumulative, targets) + 1, [nonzero[-1] + 1])))
+    bounds = bounds[(bounds >= nonzero[0]) & (bounds <= nonzero[-1] + 1)]
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def _record(profiler: Optional[PreprocessingProfiler], name: str, category: str):
+    # a dummy event is yielded if profiling is disabled
+    return profiler.record(name, category) if profiler is not None else contextlib.nullcontext({})
+
+
+def _get_nbytes(result) -> Optional[int]:
+    """
+    Returns the number of bytes of the arrays (or DataContainers) in the given result of a loading function.
+    """
+    if isinstance(result, (DataContainer, np.ndarray)):
+        return result.nbytes
+    if isinstance(result, tuple):
+        return sum(_get_nbytes(item) or 0 for item in result)
+    return None
+
+
+def _mean_volumes(dwi: np.ndarray, volumes: np.ndarray, slab_size: int) -> np.ndarray:
+    """
+    Returns the mean of the given volumes of the DWI, computed slab by slab along the x axis,
+    so a memory-mapped DWI is never read as a whole.
+    """
+    b0 = np.empty(dwi.shape[:3], dtype=np.result_type(dwi.dtype, np.float32))
+    for start in range(0, dwi.shape[0], slab_size):
+        b0[start:start + slab_size] = dwi[start:start + slab_size][..., volumes].mean(axis=-1)
+    return b0
+
+
+def _read_only(array: Optional[np.ndarray]) -> Optional[np.ndarray]:
+    if array is None:
+        return None
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def _select_volumes_inplace(dwi: np.ndarray, indices: np.ndarray, block_size: int = 4096) -> np.ndarray:
+    """
+    Compacts the volumes with the given (ascending) indices to the front of the given contiguous DWI buffer.
+
+    Returns a contiguous view on the start of the buffer. In C order, blocks of voxels are gathered before they
+    are written, and the compacted block never reaches beyond the voxels already read, so no data is overwritten
+    before use. In Fortran order, every volume is a contiguous block which is moved forward.
+    """
+    if not dwi.flags.c_contiguous:
+        for target_index, source_index in enumerate(indices):
+            if target_index != source_index:
+                dwi[..., target_index] = dwi[..., source_index]
+        return dwi[..., :len(indices)]
+
+    no_voxels = int(np.prod(dwi.shape[:-1]))
+    source = dwi.reshape(no_voxels, dwi.shape[-1])
+    target = dwi.reshape(-1)[:no_voxels * len(indices)].reshape(no_voxels, len(indices))
+    for start in range(0, no_voxels, block_size):
+        target[start:start + block_size] = source[start:start + block_size, indices]
+    return target.reshape((*dwi.shape[:-1], len(indices)))
+
+
+def _get_grid_offsets(points: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Checks whether the given (..., A, B, C, 3) IJK points are made of axis-aligned grids,
+    which are identical except of their origin and have an integer voxel spacing.
+
+    Returns
+    -------
+    np.ndarray
+        The (A, B, C, 3) integer offsets of the grid points relative to the origin,
+        or None if the points aren't made of such grids.
+    """
+    if points.ndim < 4 or points.shape[-4:-1] == (1, 1, 1):
+        return None
+    grids = points.reshape(-1, *points.shape[-4:])
+    offsets = grids - grids[:, :1, :1, :1]
+    grid_offsets = np.round(offsets[0])
+    if not np.allclose(offsets, grid_offsets, rtol=0, atol=1e-6):
+        return None
+    axis_offsets = np.stack(np.meshgrid(grid_offsets[:, 0, 0, 0], grid_offsets[0, :, 0, 1],
+                                        grid_offsets[0, 0, :, 2], indexing='ij'), axis=-1)
+    if not np.array_equal(axis_offsets, grid_offsets):
+        return None
+    return grid_offsets.astype(int)
 
 
 class DataContainer(object):
 
     def __init__(self, bvals: np.ndarray, bvecs: np.ndarray, gtab: GradientTable, t1: np.ndarray,
                  dwi: np.ndarray, aff: np.ndarray, binary_mask: np.ndarray, b0: np.ndarray,
-                 fa: Optional[np.ndarray]):
+                 fa: Optional[np.ndarray], evals: Optional[np.ndarray] = None, evecs: Optional[np.ndarray] = None,
+                 dwi_scale: Optional[float] = None, feature_dtype=np.float32,
+                 dwi_index: Optional[np.ndarray] = None):
         self.bvals = bvals
         self.bvecs = bvecs
         self.t1 = t1
@@ -282,12 +1056,243 @@ class DataContainer(object):
         self.binary_mask = binary_mask
         self.b0 = b0
         self.fa = fa
+        self.evals = evals
+        self.evecs = evecs
+        # the factor of quantized DWI values, see DataPreprocessor.quantize
+        self.dwi_scale = dwi_scale
+        # the dtype of the postprocessed volumes
+        self.feature_dtype = np.dtype(feature_dtype)
+        # the rows of the packed DWI of every voxel, see DataPreprocessor.pack_to_mask
+        self.dwi_index = dwi_index
         self.gtab = gtab
-        x_range = np.arange(dwi.shape[0])
-        y_range = np.arange(dwi.shape[1])
-        z_range = np.arange(dwi.shape[2])
-        self.fa_interpolator = RegularGridInterpolator((x_range, y_range, z_range), fa) if fa is not None else None
-        self.interpolator = RegularGridInterpolator((x_range, y_range, z_range), dwi)
+        self._interpolator = None
+        self._fa_interpolator = None
+        # if True, linear postprocessing options are applied once per voxel instead of once per query
+        self.precompute_postprocessing = True
+        self._feature_volumes = {}
+        self._feature_scales = {}
+        self._feature_interpolators = {}
+        self._tracking_masks = {}
+        self._tracking_mask_interpolators = {}
+        # the seconds spent loading every file, filled by get_hcp and get_ismrm
+        self.load_times = {}
+
+    def _replace(self, **kwargs) -> DataContainer:
+        """
+        Returns a new DataContainer sharing all arrays with this one, except the given ones.
+
+        Parameters
+        ----------
+        kwargs
+            The constructor arguments to replace
+
+        Returns
+        -------
+        DataContainer
+            The new DataContainer
+        """
+        arguments = dict(bvals=self.bvals, bvecs=self.bvecs, gtab=self.gtab, t1=self.t1, dwi=self.dwi,
+                         aff=self.aff, binary_mask=self.binary_mask, b0=self.b0, fa=self.fa,
+                         evals=self.evals, evecs=self.evecs, dwi_scale=self.dwi_scale,
+                         feature_dtype=self.feature_dtype, dwi_index=self.dwi_index)
+        arguments.update(kwargs)
+        return DataContainer(**arguments)
+
+    @property
+    def interpolator(self) -> TrilinearInterpolator:
+        """The interpolator of the DWI volume, created on first use."""
+        if self._interpolator is None or self._interpolator.values is not self.dwi:
+            self._interpolator = self._create_interpolator(self.dwi, self.dwi_scale)
+        return self._interpolator
+
+    def _create_interpolator(self, values: np.ndarray, scale: Optional[float]) -> TrilinearInterpolator:
+        # volumes in the layout of the DWI, e.g. postprocessed volumes
+        return TrilinearInterpolator(values, scale=scale, index=self.dwi_index,
+                                     grid_shape=self.shape if self.bricked else None)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The number of bytes of all volumes of the DataContainer, including the postprocessed volumes
+        and the tracking masks. Memory-mapped volumes are counted as well, they occupy the page cache when used.
+
+        Views are counted with the array owning their buffer, which they keep alive, and every buffer is counted once.
+        """
+        arrays = [self.t1, self.dwi, self.dwi_index, self.binary_mask, self.b0, self.fa, self.evals, self.evecs,
+                  *self._feature_volumes.values(), *self._tracking_masks.values()]
+        owners = {}
+        for array in arrays:
+            if array is None:
+                continue
+            while isinstance(array.base, np.ndarray):
+                array = array.base
+            owners[id(array)] = array.nbytes
+        return sum(owners.values())
+
+    @property
+    def bricked(self) -> bool:
+        """True if the DWI is stored in bricks, see `DataPreprocessor.brick`."""
+        return self.dwi.ndim == 7
+
+    @property
+    def shape(self) -> tuple:
+        """The spatial shape (X, Y, Z) of the DWI volume, independent of its layout."""
+        if self.dwi_index is not None:
+            return tuple(self.dwi_index.shape)
+        return tuple(self.binary_mask.shape if self.bricked else self.dwi.shape[:3])
+
+    def get_dwi(self, index=Ellipsis) -> np.ndarray:
+        """
+        Returns the (selected) dense DWI values in single precision,
+        undoing the quantization and the packing of the DWI if needed.
+
+        Parameters
+        ----------
+        index
+            An optional index into the dense DWI volume, e.g. a slab
+        Returns
+        -------
+        np.ndarray
+            The DWI values.
+        """
+        if self.dwi_index is not None:
+            return self._dequantize(np.take(self.dwi, self.dwi_index[index], axis=0))
+        if self.bricked:
+            return self._dequantize(from_bricks(self.dwi, self.shape)[index])
+        return self._dequantize(self.dwi[index])
+
+    def _dequantize(self, dwi: np.ndarray) -> np.ndarray:
+        dwi = np.asarray(dwi, dtype=np.float32)
+        if self.dwi_scale is not None:
+            dwi = dwi * np.float32(self.dwi_scale)
+        return dwi
+
+    @property
+    def fa_interpolator(self) -> Optional[TrilinearInterpolator]:
+        """The interpolator of the FA volume, created on first use. None if there is no FA volume."""
+        if self.fa is None:
+            return None
+        if self._fa_interpolator is None or self._fa_interpolator.values is not self.fa:
+            self._fa_interpolator = TrilinearInterpolator(self.fa)
+        return self._fa_interpolator
+
+    def save(self, path: str, metadata: Optional[dict] = None):
+        """
+        Saves the DataContainer into the given directory.
+
+        The directory contains every volume as raw little-endian array in C order and a `header.json`
+        with the bvals, bvecs, affine and the names, dtypes and shapes of the volumes.
+        Postprocessed volumes computed with `get_postprocessed_volume` are saved as well.
+
+        Parameters
+        ----------
+        path
+            The directory to save the DataContainer in
+        metadata
+            Optional JSON-serializable data stored in the header
+        """
+        header = {"bvals": np.asarray(self.bvals).tolist(), "bvecs": np.asarray(self.bvecs).tolist(),
+                  "affine": np.asarray(self.aff).tolist(), "dwi_scale": self.dwi_scale,
+                  "feature_dtype": self.feature_dtype.str, "feature_scales": self._feature_scales,
+                  "metadata": metadata or {}}
+        arrays = {"dwi": self.dwi, "dwi_index": self.dwi_index, "t1": self.t1, "binary_mask": self.binary_mask,
+                  "b0": self.b0, "fa": self.fa, "evals": self.evals, "evecs": self.evecs}
+        write_bundle(path, header, arrays, self._feature_volumes)
+
+    @classmethod
+    def open(cls, path: str) -> DataContainer:
+        """
+        Opens a DataContainer saved with `save`.
+
+        Only the header is read, the volumes are memory-mapped read-only, so voxels are read
+        from disk as soon as they are accessed. The interpolators are created on first use.
+
+        Parameters
+        ----------
+        path
+            The directory the DataContainer was saved in
+
+        Returns
+        -------
+        DataContainer
+            The opened DataContainer
+        """
+        header, arrays, features = read_bundle(path)
+        bvals = np.array(header["bvals"])
+        bvecs = np.array(header["bvecs"]).reshape(-1, 3)
+        data_container = cls(bvals, bvecs, gradient_table(bvals, bvecs), arrays.get("t1"), arrays["dwi"],
+                             np.array(header["affine"]), arrays["binary_mask"], arrays["b0"], arrays.get("fa"),
+                             arrays.get("evals"), arrays.get("evecs"), header.get("dwi_scale"),
+                             header.get("feature_dtype", np.float32), arrays.get("dwi_index"))
+        data_container._feature_volumes = features
+        data_container._feature_scales = header.get("feature_scales", {})
+        return data_container
+
+    def share_memory(self, path: Optional[str] = None) -> DataContainer:
+        """
+        Returns a copy of the DataContainer whose volumes are memory-mapped from files in shared memory
+        (a temporary directory in `/dev/shm`, removed as soon as the copy is garbage collected).
+
+        Memory-mapped volumes are pickled as lightweight handles of their files, so every process unpickling
+        the copy, e.g. the workers of a `torch.utils.data.DataLoader`, maps the same pages
+        instead of receiving a private copy of the DWI. Postprocessed volumes should be computed with
+        `get_postprocessed_volume` before, otherwise every worker computes its own.
+
+        Parameters
+        ----------
+        path
+            An optional directory to store the volumes in instead, see `save`. It isn't removed automatically.
+
+        Returns
+        -------
+        DataContainer
+            The copy of the DataContainer
+        """
+        temporary = path is None
+        path = get_shared_memory_path() if temporary else path
+        self.save(path)
+        shared = DataContainer.open(path)
+        shared.precompute_postprocessing = self.precompute_postprocessing
+        if temporary:
+            weakref.finalize(shared, shutil.rmtree, path, True)
+        return shared
+
+    def __getstate__(self):
+        # memory-mapped volumes are pickled as handles of their files, interpolators are created again on use
+        state = self.__dict__.copy()
+        for key, value in state.items():
+            if isinstance(value, np.ndarray):
+                state[key] = get_mapped_array(value) or value
+            elif key in ("_feature_volumes", "_tracking_masks"):
+                state[key] = {name: get_mapped_array(volume) or volume for name, volume in value.items()}
+        state.update(_interpolator=None, _fa_interpolator=None, _feature_interpolators={},
+                     _tracking_mask_interpolators={})
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            if isinstance(value, MappedArray):
+                state[key] = value.open()
+            elif key in ("_feature_volumes", "_tracking_masks"):
+                state[key] = {name: volume.open() if isinstance(volume, MappedArray) else volume
+                              for name, volume in value.items()}
+        self.__dict__.update(state)
+
+    def get_tensor_fit(self) -> dti.TensorFit:
+        """
+        Returns the DTI tensor fit calculated by the `fa_estimate` preprocessing step.
+
+        Use it instead of fitting the DTI model again, e.g. for the eigenvectors or the ODF of the tensors.
+
+        Returns
+        -------
+        dti.TensorFit
+            The tensor fit of the DWI data, with zero tensors outside of the brain mask.
+        """
+        if self.evals is None or self.evecs is None:
+            raise ValueError("The DataContainer contains no tensor fit, add fa_estimate to the preprocessing steps.")
+        model_params = np.concatenate((self.evals, self.evecs.reshape(self.evecs.shape[:3] + (9,))), axis=-1)
+        return dti.TensorFit(dti.TensorModel(self.gtab, fit_method='LS'), model_params)
 
     def to_ijk(self, points: np.ndarray) -> np.ndarray:
         """
@@ -329,6 +1334,87 @@ class DataContainer(object):
         """
         return apply_affine(self.aff, points)
 
+    def get_postprocessed_volume(self, postprocessing: PostprocessingOption, path: Optional[str] = None,
+                                 slab_size: int = 4) -> np.ndarray:
+        """
+        Returns the DWI volume with the given postprocessing applied to every voxel.
+
+        The volume is computed once per postprocessing option, later calls return the same array.
+        For linear postprocessing options, `get_interpolated_dwi` interpolates directly in this volume.
+
+        Parameters
+        ----------
+        postprocessing
+            The postprocessing option, e.g. SphericalHarmonics or Resample100
+        path
+            An optional `.npy` file the volume is cached in. If the file exists, it is memory-mapped instead
+            of computing the volume. Because the file is identified by its path only, it should be removed
+            as soon as the DWI data or the postprocessing option changes. The scale of quantized volumes
+            is stored next to it, in `path + ".json"`.
+        slab_size
+            The number of x-slices processed at once
+        Returns
+        -------
+        np.ndarray
+            The postprocessed volume of the shape (X, Y, Z, postprocessed size), in `feature_dtype`.
+            Integer volumes have to be multiplied with `get_feature_scale(postprocessing)`.
+            If the DWI is packed (see `DataPreprocessor.pack_to_mask`) or bricked (see `DataPreprocessor.brick`),
+            the volume is stored in the same layout.
+        """
+        if postprocessing.id in self._feature_volumes:
+            return self._feature_volumes[postprocessing.id]
+
+        scale = None
+        if path is not None and os.path.isfile(path):
+            volume = np.load(path, mmap_mode='r')
+            if os.path.isfile(path + ".json"):
+                with open(path + ".json") as scale_file:
+                    scale = json.load(scale_file)["scale"]
+        else:
+            # the stored DWI is processed block by block, a packed DWI in blocks of as many rows as a slab has voxels
+            block_size = slab_size
+            if self.dwi_index is not None:
+                block_size = slab_size * self.shape[1] * self.shape[2]
+            elif self.bricked:
+                block_size = max(1, slab_size // self.dwi.shape[3])
+
+            def process(start):
+                slab = self._dequantize(self.dwi[start:start + block_size])
+                return postprocessing.process(self, None, slab.reshape(-1, slab.shape[-1])) \
+                    .reshape((*slab.shape[:-1], -1))
+
+            first_voxel = (0,) * (self.dwi.ndim - 2) + (slice(0, 1),)
+            no_channels = postprocessing.process(self, None, self._dequantize(self.dwi[first_voxel])).shape[-1]
+            shape = (*self.dwi.shape[:-1], no_channels)
+            slab_starts = range(0, shape[0], block_size)
+            if np.issubdtype(self.feature_dtype, np.integer):
+                # the scale of quantized volumes is determined by a first pass over the volume
+                feature_max = max([np.max(np.abs(process(start)), initial=0) for start in slab_starts], default=0)
+                scale = float(max(feature_max, np.finfo(np.float32).tiny)) / np.iinfo(self.feature_dtype).max
+            if path is not None:
+                volume = np.lib.format.open_memmap(path, mode='w+', dtype=self.feature_dtype, shape=shape)
+            else:
+                volume = np.empty(shape, dtype=self.feature_dtype)
+            for start in slab_starts:
+                features = process(start)
+                volume[start:start + block_size] = features if scale is None else np.rint(features / scale)
+            if path is not None:
+                volume.flush()
+                if scale is not None:
+                    with open(path + ".json", 'w') as scale_file:
+                        json.dump({"scale": scale}, scale_file)
+        if scale is not None:
+            self._feature_scales[postprocessing.id] = scale
+        self._feature_volumes[postprocessing.id] = volume
+        return volume
+
+    def get_feature_scale(self, postprocessing: PostprocessingOption) -> Optional[float]:
+        """
+        Returns the factor of the quantized postprocessed volume of the given option,
+        or None if the volume is not quantized.
+        """
+        return self._feature_scales.get(postprocessing.id)
+
     def get_interpolated_dwi(self, points: np.ndarray, postprocessing: Optional[PostprocessingOption] = None,
                              ignore_outside_points: bool = False) -> np.ndarray:
         """
@@ -338,6 +1424,9 @@ class DataContainer(object):
         only the last dimension will be changed from 3 to the (interpolated) DWI-size accordingly.
 
         If you provide a postprocessing method, the interpolated data is then fed through this postprocessing option.
+        Linear postprocessing options (e.g. SphericalHarmonics and Resample) commute with the interpolation,
+        therefore they are applied once to the whole volume (see `get_postprocessed_volume`) and the
+        postprocessed volume is interpolated instead, unless `precompute_postprocessing` is False.
 
         Parameters
         ----------
@@ -358,15 +1447,31 @@ class DataContainer(object):
 
         points = self.to_ijk(points).reshape(-1, 3)
 
-        is_outside = ((points[:, 0] < 0) + (points[:, 0] >= self.dwi.shape[0]) +  # OR
-                      (points[:, 1] < 0) + (points[:, 1] >= self.dwi.shape[1]) +
-                      (points[:, 2] < 0) + (points[:, 2] >= self.dwi.shape[2])) > 0
+        shape = self.shape
+        is_outside = ((points[:, 0] < 0) + (points[:, 0] > shape[0] - 1) +  # OR
+                      (points[:, 1] < 0) + (points[:, 1] > shape[1] - 1) +
+                      (points[:, 2] < 0) + (points[:, 2] > shape[2] - 1)) > 0
 
         if np.sum(is_outside) > 0 and not ignore_outside_points:
             raise PointOutsideOfDWIError(self, self.to_ras(points), self.to_ras(points[is_outside]))
 
-        points[is_outside, :] = 0
-        result = self.interpolator(points)
+        interpolator = self.interpolator
+        if postprocessing is not None and postprocessing.linear and self.precompute_postprocessing:
+            if postprocessing.id not in self._feature_interpolators:
+                self._feature_interpolators[postprocessing.id] = \
+                    self._create_interpolator(self.get_postprocessed_volume(postprocessing),
+                                              self.get_feature_scale(postprocessing))
+            interpolator = self._feature_interpolators[postprocessing.id]
+            postprocessing = None
+
+        grid_offsets = _get_grid_offsets(points.reshape(new_shape[:-1] + (3,)))
+        if grid_offsets is not None:
+            origins = points.reshape(-1, grid_offsets[..., 0].size, 3)[:, 0]
+            result = interpolator.interpolate_grid(origins, grid_offsets)
+            result = result.reshape(len(points), -1)
+        else:
+            points[is_outside, :] = 0
+            result = interpolator(points)
 
         if postprocessing is not None:
             result = postprocessing.process(self, points, result)
@@ -375,16 +1480,105 @@ class DataContainer(object):
         result = result.reshape(new_shape)
         return result
 
-    def get_fa(self, coordinate):
-        """Retrieves the FA values at a specific position.
+    def _points_to_ijk(self, points, coordinates: str):
+        """
+        Returns the given array or tensor of points in IJK, `coordinates` is either "ijk" or "ras".
+        """
+        if coordinates == "ijk":
+            return points
+        if coordinates != "ras":
+            raise ValueError("coordinates have to be 'ijk' or 'ras', not {}".format(coordinates))
+        if not isinstance(points, torch.Tensor):
+            return self.to_ijk(points)
+        aff = torch.as_tensor(np.linalg.inv(self.aff), dtype=torch.float64, device=points.device)
+        return points.to(torch.float64) @ aff[:3, :3].T + aff[:3, 3]
+
+    def get_fa(self, points, coordinates: str = "ijk", mode: str = "trilinear"):
+        """Retrieves the FA values at the given points.
+
+        All points are sampled at once, on the device of the points if a tensor is given.
 
+        Parameters
+        ----------
+        points
+            An array or tensor of the shape (..., 3)
+        coordinates
+            The coordinate system of the points, "ijk" (image coordinates) or "ras" (RAS+)
+        mode
+            "trilinear" interpolates the FA, "nearest" returns the FA of the nearest voxel
         Returns
         -------
-        ndarray
-            Fractional anisotropy (FA) calculated from cached eigenvalues.
+        np.ndarray or torch.Tensor
+            Fractional anisotropy (FA) of the shape (...), calculated from cached eigenvalues.
+            A single point of the shape (3,) returns an array of the shape (1,), like scipy's interpolators.
         
         See Also
         --------
         generate_fa: The method generating the fa values which are returned here.
         """
-        return self.fa_interpolator(coordinate)
\ No newline at end of file
+        if self.fa is None:
+            raise ValueError("The DataContainer contains no FA, add fa_estimate to the preprocessing steps.")
+        if not isinstance(points, torch.Tensor):
+            points = np.asarray(points)
+        if points.ndim == 1:
+            points = points[None]
+        points = self._points_to_ijk(points, coordinates)
+        if mode == "trilinear":
+            return self.fa_interpolator(points)
+        if mode == "nearest":
+            return self.fa_interpolator.nearest(points)
+        raise ValueError("mode has to be 'trilinear' or 'nearest', not {}".format(mode))
+
+    def get_tracking_mask(self, fa_threshold: float) -> np.ndarray:
+        """
+        Returns the volume of the voxels tracking continues in: inside of the brain mask with an FA of at least
+        `fa_threshold`. The volume is computed once per threshold.
+
+        Parameters
+        ----------
+        fa_threshold
+            The minimal FA of a voxel
+        Returns
+        -------
+        np.ndarray
+            The uint8 volume of the shape (X, Y, Z), 1 where tracking continues and 0 elsewhere.
+        """
+        if fa_threshold not in self._tracking_masks:
+            if self.fa is None:
+                raise ValueError("The DataContainer contains no FA, add fa_estimate to the preprocessing steps.")
+            self._tracking_masks[fa_threshold] = ((self.binary_mask > 0) & (self.fa >= fa_threshold)).astype(np.uint8)
+        return self._tracking_masks[fa_threshold]
+
+    def continue_tracking(self, points, fa_threshold: float, coordinates: str = "ijk"):
+        """
+        Returns whether tracking continues at the given points, i.e. whether their nearest voxel is inside of the
+        brain mask and has an FA of at least `fa_threshold` (see `get_tracking_mask`). Points outside of the
+        volume stop the tracking. The test is a single gather per point, on the device of the points
+        if a tensor is given.
+
+        Parameters
+        ----------
+        points
+            An array or tensor of the shape (..., 3)
+        fa_threshold
+            The minimal FA of a voxel
+        coordinates
+            The coordinate system of the points, "ijk" (image coordinates) or "ras" (RAS+)
+        Returns
+        -------
+        np.ndarray or torch.Tensor
+            The boolean array or tensor of the shape (...), True where tracking continues.
+        """
+        if isinstance(points, torch.Tensor) and points.device.type == "cpu":
+            # numpy has less overhead per call than torch, which matters for single points
+            inside = self.continue_tracking(points.detach().numpy(), fa_threshold, coordinates)
+            return torch.from_numpy(np.asarray(inside))
+        if fa_threshold not in self._tracking_mask_interpolators:
+            self._tracking_mask_interpolators[fa_threshold] = \
+                TrilinearInterpolator(self.get_tracking_mask(fa_threshold), bounds_error=False)
+        points = self._points_to_ijk(points, coordinates)
+        inside = self._tracking_mask_interpolators[fa_threshold].nearest(points) > 0
+        # points rounded to a voxel of the volume, the interpolator clamps all other points to the border
+        upper = np.array(self.fa.shape) if not isinstance(points, torch.Tensor) \
+            else torch.as_tensor(self.fa.shape, device=points.device)
+        return inside & ((points > -0.5) & (points < upper - 0.5)).all(-1)
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""
+Helpers reading and writing the native DataContainer format: a directory of raw little-endian arrays
+described by a JSON header. Opening a bundle only parses the header and memory-maps the arrays.
+"""
+import json
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+HEADER_FILE = "header.json"
+FORMAT_NAME = "dfibert-bundle"
+FORMAT_VERSION = 1
+
+# the maximum number of bytes converted at once while writing an array
+_WRITE_BUFFER_SIZE = 64 * 1024 ** 2
+
+
+def write_array(path: str, array: np.ndarray) -> dict:
+    """
+    Writes the given array as raw little-endian data in C order.
+
+    The array is written in slabs along the first axis, so non-contiguous or memory-mapped arrays
+    are never copied as a whole.
+
+    Parameters
+    ----------
+    path
+        The path of the file to write
+    array
+        The array to write
+
+    Returns
+    -------
+    dict
+        The description of the array (file name, dtype and shape) for the header.
+    """
+    dtype = array.dtype.newbyteorder('<')
+    with open(path, 'wb') as file:
+        if array.ndim == 0:
+            np.asarray(array, dtype=dtype).tofile(file)
+        else:
+            row_size = max(array[:1].nbytes, 1)
+            rows_per_slab = max(1, _WRITE_BUFFER_SIZE // row_size)
+            for start in range(0, array.shape[0], rows_per_slab):
+                np.ascontiguousarray(array[start:start + rows_per_slab], dtype=dtype).tofile(file)
+    return {"file": os.path.basename(path), "dtype": dtype.str, "shape": list(array.shape)}
+
+
+def create_array(path: str, dtype, shape: tuple) -> Tuple[np.ndarray, dict]:
+    """
+    Creates a file for an array of the given dtype and shape, which is filled through the returned memory map.
+
+    Parameters
+    ----------
+    path
+        The path of the file to create
+    dtype
+        The dtype of the array, stored little-endian
+    shape
+        The shape of the array
+
+    Returns
+    -------
+    tuple
+        The (writeable memory map, description for the header) tuple. Empty arrays aren't mapped.
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    description = {"file": os.path.basename(path), "dtype": dtype.str, "shape": list(shape)}
+    if int(np.prod(shape, dtype=int)) == 0:
+        open(path, 'wb').close()
+        return np.empty(shape, dtype=dtype), description
+    return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape)), description
+
+
+def open_array(path: str, description: dict) -> np.ndarray:
+    """
+    Returns the array described by the given header entry as read-only memory map.
+
+    Parameters
+    ----------
+    path
+        The path of the bundle directory
+    description
+        The description of the array written by `write_array`
+
+    Returns
+    -------
+    np.ndarray
+        The memory-mapped array.
+    """
+    dtype = np.dtype(description["dtype"])
+    shape = tuple(description["shape"])
+    if int(np.prod(shape, dtype=int)) == 0:  # empty files can't be mapped
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(os.path.join(path, description["file"]), dtype=dtype, mode='r', shape=shape)
+
+
+def write_bundle(path: str, header: dict, arrays: dict, features: dict):
+    """
+    Writes a bundle into the given directory. The header is written last,
+    so an interrupted write never leaves a bundle which can be opened.
+
+    Parameters
+    ----------
+    path
+        The path of the bundle directory
+    header
+        The JSON-serializable header entries, e.g. bvals, bvecs and affine
+    arrays
+        The named arrays to store, None values are skipped
+    features
+        The postprocessed feature volumes to store, by the id of their postprocessing option
+    """
+    os.makedirs(path, exist_ok=True)
+    descriptions = {name: write_array(os.path.join(path, name + ".raw"), array)
+                    for name, array in arrays.items() if array is not None}
+    feature_descriptions = {feature_id: write_array(os.path.join(path, "feature{}.raw".format(index)), volume)
+                            for index, (feature_id, volume) in enumerate(features.items())}
+    write_header(path, header, descriptions, feature_descriptions)
+
+
+def write_header(path: str, header: dict, arrays: dict, features: Optional[dict] = None):
+    """
+    Writes the header of a bundle whose arrays were already written with `write_array` or `create_array`.
+
+    Parameters
+    ----------
+    path
+        The path of the bundle directory
+    header
+        The JSON-serializable header entries, e.g. bvals, bvecs and affine
+    arrays
+        The descriptions of the named arrays
+    features
+        The descriptions of the postprocessed feature volumes, by the id of their postprocessing option
+    """
+    header = dict(header, format=FORMAT_NAME, version=FORMAT_VERSION, arrays=arrays, features=features or {})
+    with open(os.path.join(path, HEADER_FILE), 'w') as header_file:
+        json.dump(header, header_file)
+
+
+def read_bundle(path: str, header: Optional[dict] = None) -> Tuple[dict, dict, dict]:
+    """
+    Opens the bundle in the given directory.
+
+    Parameters
+    ----------
+    path
+        The path of the bundle directory
+    header
+        The already parsed header, if available
+
+    Returns
+    -------
+    tuple
+        The (header, arrays, features) tuple, the arrays and features are read-only memory maps.
+    """
+    if header is None:
+        header = read_header(path)
+    arrays = {name: open_array(path, description) for name, description in header["arrays"].items()}
+    features = {feature_id: open_array(path, description) for feature_id, description in header["features"].items()}
+    return header, arrays, features
+
+
+def read_header(path: str) -> dict:
+    """
+    Returns the parsed header of the bundle in the given directory.
+
+    Raises a ValueError if the directory contains no bundle of a supported version.
+    """
+    with open(os.path.join(path, HEADER_FILE)) as header_file:
+        header = json.load(header_file)
+    if header.get("format") != FORMAT_NAME or header.get("version") != FORMAT_VERSION:
+        raise ValueError("{} contains no DataContainer bundle of version {}".format(path, FORMAT_VERSION))
+    return header
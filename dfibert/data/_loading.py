@@ -0,0 +1,244 @@
+"""
+Helpers reading NIfTI images from disk, either fully into memory or lazily as memory-mapped arrays.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import nibabel as nb
+import numpy as np
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import apply_read_scaling
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "dfibert")
+
+# the maximum number of bytes buffered while converting an image
+_CONVERSION_BUFFER_SIZE = 256 * 1024 ** 2
+# the number of volumes transposed at once into C order, one y row at a time to stay in the CPU cache
+_TILE_VOLUMES = 16
+
+
+def get_file_identity(path: str) -> dict:
+    """
+    Returns a dict identifying the current version of the given file.
+
+    Parameters
+    ----------
+    path
+        The path of the file
+
+    Returns
+    -------
+    dict
+        The absolute path, the size and the modification time of the file.
+    """
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def _is_compressed(path: str) -> bool:
+    return not path.endswith(".nii")
+
+
+def _get_scaled_dtype(proxy) -> np.dtype:
+    # the dtype of the scaled data, determined without reading the image
+    return apply_read_scaling(np.zeros(1, dtype=proxy.dtype), proxy.slope, proxy.inter).dtype
+
+
+def read_volumes(path: str, dtype=None, out: Optional[np.ndarray] = None,
+                 volumes: Optional[np.ndarray] = None, workers: int = 1) -> np.ndarray:
+    """
+    Reads the image data of a NIfTI file volume by volume.
+
+    The file is read in chunks of volumes, therefore only a few volumes
+    have to be held in memory apart from the output array, even if the image is gzipped.
+    If only some volumes are requested, the others are skipped.
+
+    With multiple workers, the chunks of uncompressed images are read by concurrent threads.
+    A gzipped image can only be decompressed as a single stream, there the conversion of every chunk
+    runs concurrently to the decompression of the next one.
+
+    Parameters
+    ----------
+    path
+        The path of the NIfTI file
+    dtype
+        The dtype of the returned array, by default the dtype of the scaled image data
+    out
+        An optional array of the output shape the volumes are written to, e.g. a memory-mapped file
+    volumes
+        The ascending indices of the volumes to read, by default all volumes
+    workers
+        The number of threads reading and converting chunks
+
+    Returns
+    -------
+    np.ndarray
+        The image data in C order, with the shape (X, Y, Z, len(volumes)) if volumes are given.
+    """
+    proxy = nb.load(path).dataobj
+    shape = proxy.shape
+    disk_dtype = proxy.dtype
+    slope, inter = proxy.slope, proxy.inter
+
+    spatial_shape = shape[:3]
+    no_volumes = int(np.prod(shape[3:], dtype=int))
+    volume_size = int(np.prod(spatial_shape, dtype=int)) * disk_dtype.itemsize
+    volumes_per_chunk = max(1, _CONVERSION_BUFFER_SIZE // max(volume_size * (workers + 1), 1))
+    if volumes is None:
+        indices = np.arange(no_volumes)
+    else:
+        indices = np.asarray(volumes, dtype=int)
+        shape = (*spatial_shape, len(indices))
+    if out is None:
+        out = np.empty(shape, dtype=_get_scaled_dtype(proxy) if dtype is None else dtype)
+    view = out.reshape((*spatial_shape, len(indices)))
+
+    # runs of consecutive volumes are read at once, the gaps between them are skipped
+    runs = np.split(np.arange(len(indices)), np.flatnonzero(np.diff(indices) != 1) + 1)
+    chunks = [(int(run[start]), int(run[min(start + volumes_per_chunk, len(run)) - 1]) + 1)
+              for run in runs for start in range(0, len(run), volumes_per_chunk)]
+
+    def read(fobj, chunk):
+        start, stop = chunk
+        fobj.seek(proxy.offset + int(indices[start]) * volume_size)
+        return np.frombuffer(fobj.read(volume_size * (stop - start)), dtype=disk_dtype)
+
+    def convert(raw, chunk):
+        start, stop = chunk
+        # NIfTI stores the data in Fortran order, so the raw data is indexed by (volume, z, y, x)
+        raw = raw.reshape((stop - start, *spatial_shape[::-1]))
+        # the transposition into C order is done in small tiles, it is slow for the whole chunk at once
+        for volume in range(0, stop - start, _TILE_VOLUMES):
+            tile_volumes = slice(start + volume, min(start + volume + _TILE_VOLUMES, stop))
+            for y in range(spatial_shape[1]):
+                tile = raw[volume:volume + _TILE_VOLUMES, :, y, :]
+                view[:, y, :, tile_volumes] = apply_read_scaling(tile, slope, inter).T
+
+    def read_and_convert(chunk):
+        with ImageOpener(path) as fobj:
+            convert(read(fobj, chunk), chunk)
+
+    if workers > 1 and not _is_compressed(path):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(read_and_convert, chunks))
+    elif workers > 1:
+        with ThreadPoolExecutor(max_workers=1) as executor, ImageOpener(path) as fobj:
+            conversion = None
+            for chunk in chunks:
+                raw = read(fobj, chunk)
+                if conversion is not None:
+                    conversion.result()
+                conversion = executor.submit(convert, raw, chunk)
+            if conversion is not None:
+                conversion.result()
+    else:
+        with ImageOpener(path) as fobj:
+            for chunk in chunks:
+                convert(read(fobj, chunk), chunk)
+    return out
+
+
+def load_volume(path: str, dtype=None, lazy: bool = False, cache_path: Optional[str] = None,
+                volumes: Optional[np.ndarray] = None, workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Loads the image data and affine of a NIfTI file.
+
+    In lazy mode, the returned array is a read-only memory map,
+    so voxels are only read from disk as soon as they are accessed.
+    Uncompressed images are mapped directly if possible, compressed images (or images
+    with a different dtype or scaling) are converted once into an uncompressed `.npy` file
+    inside of the cache folder, which is mapped afterwards. The conversions are keyed by the path,
+    size and modification time of the image; once an image changes, the conversions of its older versions
+    are removed. Conversions of deleted images are kept, delete the `volumes` subfolder of the cache folder
+    to free their space.
+
+    Parameters
+    ----------
+    path
+        The path of the NIfTI file
+    dtype
+        The requested dtype of the image data, by default the dtype of the scaled image data
+    lazy
+        If True, the image data is returned as read-only memory-mapped array.
+    cache_path
+        The folder converted images are stored in, by default `~/.cache/dfibert`
+    volumes
+        The ascending indices of the volumes to load, by default all volumes.
+        Only those volumes are read from disk.
+    workers
+        The number of threads reading the image data, see `read_volumes`
+
+    Returns
+    -------
+    tuple
+        The (data, affine) tuple of the image.
+    """
+    if not lazy:
+        img = nb.load(path)
+        if volumes is None and dtype is None:
+            return np.asanyarray(img.dataobj), img.affine
+        # C order keeps all channels of a voxel contiguous for the interpolation
+        return read_volumes(path, dtype=dtype, volumes=volumes, workers=workers), img.affine
+
+    img = nb.load(path, mmap='r')
+    disk_dtype = img.dataobj.dtype
+    scaled_dtype = _get_scaled_dtype(img.dataobj)
+    if volumes is None and not _is_compressed(path) and scaled_dtype == disk_dtype \
+            and (dtype is None or scaled_dtype == dtype):
+        data = np.asanyarray(img.dataobj)
+        if isinstance(data, np.memmap):
+            return data, img.affine
+
+    cache_path = DEFAULT_CACHE_PATH if cache_path is None else cache_path
+    identity = get_file_identity(path)
+    source = {"path": identity.pop("path"), "dtype": None if dtype is None else np.dtype(dtype).str}
+    if volumes is not None:
+        source["volumes"] = np.asarray(volumes).tolist()
+    # conversions of the same source share the prefix, so older versions can be found once the file changes
+    prefix = _get_hash(source)
+    key = prefix + "-" + _get_hash(identity)
+    converted_path = os.path.join(cache_path, "volumes", key + ".npy")
+
+    if not os.path.isfile(converted_path):
+        os.makedirs(os.path.dirname(converted_path), exist_ok=True)
+        out_dtype = scaled_dtype if dtype is None else np.dtype(dtype)
+        # every process converts into a file of its own, the first finished one is replaced by the others
+        tmp_file, tmp_path = tempfile.mkstemp(prefix=key + ".", suffix=".tmp.npy", dir=os.path.dirname(converted_path))
+        os.close(tmp_file)
+        try:
+            shape = img.shape if volumes is None else (*img.shape[:3], len(volumes))
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=out_dtype, shape=shape)
+            read_volumes(path, out=out, volumes=volumes, workers=workers)
+            out.flush()
+            del out
+            os.replace(tmp_path, converted_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        _remove_stale_conversions(os.path.dirname(converted_path), prefix, converted_path)
+
+    return np.load(converted_path, mmap_mode='r'), img.affine
+
+
+def _get_hash(identity: dict) -> str:
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def _remove_stale_conversions(directory: str, prefix: str, converted_path: str):
+    """
+    Removes the conversions of older versions of a source file, identified by the given prefix.
+    Arrays still mapped from them stay valid, the files are only freed once they are unmapped.
+    """
+    for name in os.listdir(directory):
+        stale_path = os.path.join(directory, name)
+        if name.startswith(prefix + "-") and name.endswith(".npy") and not name.endswith(".tmp.npy") \
+                and stale_path != converted_path:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                # removed by another process at the same time
+                pass
@@ -0,0 +1,64 @@
+"""
+Helpers pickling memory-mapped arrays as lightweight handles instead of their data.
+
+A handle stores the file, the offset, the dtype, the shape and the strides of the array, so that unpickling
+maps the same file again. Processes unpickling handles of the same file therefore share its pages
+(in the page cache, or in shared memory for files in `/dev/shm`) instead of holding private copies.
+"""
+import mmap
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+# the tmpfs of POSIX shared memory on Linux
+SHARED_MEMORY_PATH = "/dev/shm"
+
+
+class MappedArray(object):
+    """
+    A picklable handle of a read-only memory-mapped array.
+    """
+
+    def __init__(self, filename: str, offset: int, dtype: np.dtype, shape: tuple, strides: tuple):
+        self.filename = filename
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        self.strides = strides
+
+    def open(self) -> np.ndarray:
+        """
+        Returns the array mapped read-only from the file.
+        """
+        if int(np.prod(self.shape, dtype=int)) == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+        span = sum((size - 1) * stride for size, stride in zip(self.shape, self.strides)) + self.dtype.itemsize
+        data = np.memmap(self.filename, dtype=np.uint8, mode='r', offset=self.offset, shape=(span,))
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=data, strides=self.strides)
+
+
+def get_mapped_array(array: Optional[np.ndarray]) -> Optional[MappedArray]:
+    """
+    Returns the handle of the given array if it is a view into a memory-mapped file, otherwise None.
+
+    Arrays with negative strides and arrays of anonymous mappings aren't supported, those are pickled as usual.
+    """
+    if not isinstance(array, np.memmap) or getattr(array, "_mmap", None) is None or array.filename is None:
+        return None
+    if any(stride < 0 for stride in array.strides):
+        return None
+    # the mapping starts at the allocation granularity below the offset of the memmap it was created for
+    mapping_start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    mapping_address = np.frombuffer(array._mmap, dtype=np.uint8).ctypes.data
+    offset = mapping_start + array.ctypes.data - mapping_address
+    return MappedArray(os.path.abspath(array.filename), offset, array.dtype, array.shape, array.strides)
+
+
+def get_shared_memory_path() -> str:
+    """
+    Returns a new temporary directory in shared memory if available, otherwise in the default temporary directory.
+    """
+    directory = SHARED_MEMORY_PATH if os.path.isdir(SHARED_MEMORY_PATH) else None
+    return tempfile.mkdtemp(prefix="dfibert-", dir=directory)
@@ -0,0 +1,198 @@
+"""
+The cache submodule persists preprocessed DataContainers on disk,
+so that a preprocessing chain has to be computed only once per dataset.
+
+Entries are content-addressed: their key is a hash of the preprocessing steps
+and the identities (path, size and modification time) of the input files.
+"""
+import os
+import shutil
+import uuid
+import warnings
+from typing import Callable, Optional
+
+from dfibert.data._bundle import HEADER_FILE, read_header
+from dfibert.data._loading import DEFAULT_CACHE_PATH
+
+
+class DataContainerCache(object):
+    def __init__(self, path: Optional[str] = None, max_size: Optional[int] = None):
+        """
+        Creates a cache for preprocessed DataContainers.
+
+        Parameters
+        ----------
+        path
+            The folder the cache is located in, by default `~/.cache/dfibert/preprocessed`
+        max_size
+            The maximum size of the cache in bytes. If exceeded, the least recently used entries are evicted.
+            By default, the cache is unbounded.
+        """
+        self.path = os.path.join(DEFAULT_CACHE_PATH, "preprocessed") if path is None else path
+        self.max_size = max_size
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str):
+        """
+        Returns the cached DataContainer with the given key.
+
+        The arrays of the returned DataContainer are read-only memory maps of the cached files.
+
+        Parameters
+        ----------
+        key
+            The key of the entry
+
+        Returns
+        -------
+        DataContainer
+            The cached DataContainer or None, if there is no entry with the given key.
+        """
+        from dfibert.data import DataContainer
+
+        entry_path = self._entry_path(key)
+        try:
+            data_container = DataContainer.open(entry_path)
+            os.utime(os.path.join(entry_path, HEADER_FILE))  # mark as recently used
+        except OSError:
+            return None
+        except (ValueError, KeyError):  # an entry of an older version, which is replaced by the next put
+            shutil.rmtree(entry_path, ignore_errors=True)
+            return None
+        return data_container
+
+    def put(self, key: str, data_container, source: Optional[str] = None):
+        """
+        Stores the given DataContainer in the cache and evicts old entries if the cache is full.
+        A DataContainer larger than `max_size` isn't stored, a warning is issued instead.
+
+        Parameters
+        ----------
+        key
+            The key of the entry
+        data_container
+            The DataContainer to store
+        source
+            The path of the dataset the DataContainer was created from, used for `invalidate`
+        """
+        if self.max_size is not None and data_container.nbytes > self.max_size:
+            warnings.warn("The DataContainer ({} bytes) is larger than the cache ({} bytes), it isn't cached."
+                          .format(data_container.nbytes, self.max_size))
+            return
+        self.write(key, data_container.save, source=source)
+
+    def write(self, key: str, writer: Callable[[str, dict], object], source: Optional[str] = None):
+        """
+        Stores an entry written by the given function and evicts old entries if the cache is full.
+
+        Use it to write a DataContainer into the cache without holding it in memory,
+        e.g. with `DataPreprocessor.preprocess_to`. The written entry is never evicted by its own write;
+        if it is larger than `max_size` on its own, it is kept (with a warning) until the next write.
+
+        Parameters
+        ----------
+        key
+            The key of the entry
+        writer
+            A function `writer(path, metadata)` saving a DataContainer into the directory `path`,
+            like `DataContainer.save`
+        source
+            The path of the dataset the DataContainer was created from, used for `invalidate`
+
+        Returns
+        -------
+        DataContainer
+            The DataContainer of the entry, opened before any entry is evicted.
+        """
+        from dfibert.data import DataContainer
+
+        tmp_path = self._entry_path(key + ".tmp-" + uuid.uuid4().hex)
+        try:
+            writer(tmp_path, {"source": None if source is None else os.path.abspath(source)})
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError:  # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        # the memory maps stay valid, even if another process evicts the entry afterwards
+        data_container = DataContainer.open(self._entry_path(key))
+        self.evict(keep=key)
+        if self.max_size is not None and self.size() > self.max_size:
+            warnings.warn("The cache entry {} is larger than the cache ({} bytes), it is evicted by the next write."
+                          .format(key, self.max_size))
+        return data_container
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for key in os.listdir(self.path):
+            entry_path = self._entry_path(key)
+            header_path = os.path.join(entry_path, HEADER_FILE)
+            if ".tmp-" in key or not os.path.isfile(header_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_path, file)) for file in os.listdir(entry_path))
+            entries.append((os.path.getmtime(header_path), size, key))
+        return entries
+
+    def size(self) -> int:
+        """
+        Returns
+        -------
+        int
+            The current size of the cache in bytes.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Removes the least recently used entries until the cache is not larger than `max_size`.
+
+        Parameters
+        ----------
+        keep
+            The key of an entry which is never removed, e.g. the one just written
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, key in entries:
+            if size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            size -= entry_size
+
+    def invalidate(self, source: str):
+        """
+        Removes all entries which were created from the dataset at the given path.
+
+        Entries are invalidated automatically if the input files change,
+        use this if the results of the preprocessing steps themselves have changed.
+
+        Parameters
+        ----------
+        source
+            The path of the dataset
+        """
+        source = os.path.abspath(source)
+        for _, _, key in self._entries():
+            try:
+                if read_header(self._entry_path(key))["metadata"].get("source") != source:
+                    continue
+            except (OSError, ValueError, KeyError):  # entries of older versions are removed as well
+                pass
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+
+    def clear(self):
+        """
+        Removes all entries of the cache.
+        """
+        for _, _, key in self._entries():
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
@@ -0,0 +1,421 @@
+"""
+The interpolation submodule implements the trilinear interpolation used by the DataContainer.
+
+It is specialised on the uniform voxel grid of the DWI image: the integer part of a point selects
+the 8 corner voxels, the fractional part gives their weights. All channels of a corner voxel
+are gathered at once, so the work per point is 8 row gathers and a single weighted sum.
+"""
+import warnings
+from typing import Optional
+
+import numpy as np
+import torch
+
+# the corner offsets (dx, dy, dz) in the order of the interpolation weights
+_CORNERS = np.array([(dx, dy, dz) for dx in (0, 1) for dy in (0, 1) for dz in (0, 1)])
+
+
+def to_bricks(values: np.ndarray, brick_size: int = 8) -> np.ndarray:
+    """
+    Returns the given volume in a bricked layout: cubes of `brick_size`^3 voxels are stored contiguously,
+    so the voxels of a small neighbourhood are close in memory instead of being spread over the Y and X strides.
+
+    Parameters
+    ----------
+    values
+        The volume with the shape (X, Y, Z, ...)
+    brick_size
+        The edge length of the bricks in voxels
+
+    Returns
+    -------
+    np.ndarray
+        The bricked volume of the shape (X', Y', Z', B, B, B, ...), with X' = ceil(X / B) etc.
+        Bricks at the border are padded with zeros.
+    """
+    grid_shape = values.shape[:3]
+    channel_shape = values.shape[3:]
+    no_bricks = [-(-size // brick_size) for size in grid_shape]
+    bricks = np.zeros((*no_bricks, brick_size, brick_size, brick_size, *channel_shape), dtype=values.dtype)
+    slab = np.zeros((brick_size, no_bricks[1] * brick_size, no_bricks[2] * brick_size, *channel_shape),
+                    dtype=values.dtype)
+    # converted slab by slab of bricks, so only a slab is held in memory apart from the result
+    for brick_x in range(no_bricks[0]):
+        voxels = values[brick_x * brick_size:(brick_x + 1) * brick_size]
+        slab[len(voxels):] = 0
+        slab[:len(voxels), :grid_shape[1], :grid_shape[2]] = voxels
+        bricks[brick_x] = slab.reshape((brick_size, no_bricks[1], brick_size, no_bricks[2], brick_size,
+                                        *channel_shape)).transpose((1, 3, 0, 2, 4, *range(5, 5 + len(channel_shape))))
+    return bricks
+
+
+def from_bricks(bricks: np.ndarray, grid_shape: tuple) -> np.ndarray:
+    """
+    Returns the volume of the shape (*grid_shape, ...) stored in the given bricked layout, see `to_bricks`.
+    """
+    no_bricks = bricks.shape[:3]
+    brick_size = bricks.shape[3]
+    channel_shape = bricks.shape[6:]
+    values = np.empty((*grid_shape, *channel_shape), dtype=bricks.dtype)
+    for brick_x in range(no_bricks[0]):
+        slab = np.asarray(bricks[brick_x]).transpose((2, 0, 3, 1, 4, *range(5, 5 + len(channel_shape))))
+        slab = slab.reshape((brick_size, no_bricks[1] * brick_size, no_bricks[2] * brick_size, *channel_shape))
+        voxels = values[brick_x * brick_size:(brick_x + 1) * brick_size]
+        voxels[...] = slab[:len(voxels), :grid_shape[1], :grid_shape[2]]
+    return values
+
+
+def _as_slice(positions: np.ndarray):
+    """
+    Returns a slice equivalent to the given index array if possible, so that indexing returns a view.
+    """
+    if np.array_equal(positions, np.arange(positions[0], positions[0] + len(positions))):
+        return slice(int(positions[0]), int(positions[0]) + len(positions))
+    return positions
+
+
+class TrilinearInterpolator(object):
+    def __init__(self, values: np.ndarray, bounds_error: bool = True, chunk_size: int = 16384,
+                 scale: Optional[float] = None, index: Optional[np.ndarray] = None,
+                 grid_shape: Optional[tuple] = None, chunk_bytes: int = 2 ** 20):
+        """
+        Creates a trilinear interpolator on the voxel grid of the given volume.
+
+        It can be used as drop-in replacement of a `scipy.interpolate.RegularGridInterpolator`
+        built on the grid `(arange(X), arange(Y), arange(Z))`.
+
+        Parameters
+        ----------
+        values
+            The volume with the shape (X, Y, Z, ...). Trailing dimensions are interpolated together.
+        bounds_error
+            If True, a ValueError is raised for points outside of the volume,
+            otherwise those points are clamped to the volume border.
+        chunk_size
+            The maximum number of points interpolated at once, bounding the size of temporary arrays.
+        scale
+            An optional factor the values are multiplied with, e.g. for quantized volumes.
+            Values stored with less precision (float16, uint16) are only upcast after gathering
+            the corner voxels, so the volume itself stays in its compact dtype.
+        index
+            An optional integer volume of the shape (X, Y, Z) for volumes in a packed layout. Then `values`
+            has the shape (N, ...) and every voxel is the row `values[index[x, y, z]]`, e.g. row 0 holding
+            zeros for all voxels outside of a mask.
+        grid_shape
+            The shape (X, Y, Z) of the volume, if `values` is in the bricked layout of `to_bricks`
+            with the shape (X', Y', Z', B, B, B, ...). The rows of the corner voxels are then calculated
+            from their brick and their position inside of the brick.
+        chunk_bytes
+            The maximum number of bytes of the corner voxels gathered at once (in numpy), so they stay in the
+            CPU cache while they are weighted. For volumes with many channels, this limits the chunks
+            to fewer points than `chunk_size`.
+        """
+        self.values = values
+        self.bounds_error = bounds_error
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.scale = scale
+        self.index = index
+        self.bricked = grid_shape is not None
+        if self.bricked:
+            self.grid_shape = np.array(grid_shape)
+            self.channel_shape = values.shape[6:]
+        else:
+            self.grid_shape = np.array(values.shape[:3] if index is None else index.shape)
+            self.channel_shape = values.shape[3:] if index is None else values.shape[1:]
+        self.dtype = np.result_type(values.dtype, np.float32)
+        # uint16 values are passed to torch as int16, see `_get_torch_values`
+        self._unsigned = values.dtype == np.uint16
+
+        no_channels = int(np.prod(self.channel_shape, dtype=int))
+        flat = values.reshape(-1, no_channels) \
+            if values.flags.c_contiguous or index is not None or self.bricked else None
+        # volumes in other memory layouts are gathered with a (slower) index tuple instead of copying them
+        self._flat = flat
+        self._flat_index = None if index is None else np.ascontiguousarray(index).reshape(-1)
+
+        # linear offsets of the 8 corner voxels; axes of length 1 don't have a second corner
+        strides = np.array([self.grid_shape[1] * self.grid_shape[2], self.grid_shape[2], 1])
+        strides[self.grid_shape == 1] = 0
+        self._corner_offsets = _CORNERS @ strides
+        self._axis_rows = self._get_axis_rows(values.shape[:3] if self.bricked else None)
+        self._torch_values = {}
+        self._torch_index = {}
+        self._torch_axis_rows = {}
+
+    def _get_axis_rows(self, no_bricks):
+        """
+        Returns the row offset contributed by every position along each axis, so that the row of a voxel
+        is `rows[0][x] + rows[1][y] + rows[2][z]`. The tables have an additional clamped entry for the
+        upper corner of the last voxel.
+        """
+        positions = [np.minimum(np.arange(size + 1), size - 1) for size in self.grid_shape]
+        if no_bricks is None:
+            strides = [self.grid_shape[1] * self.grid_shape[2], self.grid_shape[2], 1]
+            return [position * stride for position, stride in zip(positions, strides)]
+        brick_size = self.values.shape[3]
+        brick_strides = [no_bricks[1] * no_bricks[2], no_bricks[2], 1]
+        voxel_strides = [brick_size ** 2, brick_size, 1]
+        return [(position // brick_size) * brick_stride * brick_size ** 3 + (position % brick_size) * voxel_stride
+                for position, brick_stride, voxel_stride in zip(positions, brick_strides, voxel_strides)]
+
+    def __call__(self, points):
+        """
+        Interpolates the volume at the given points.
+
+        Parameters
+        ----------
+        points
+            An array or tensor of the shape (..., 3) containing points in image coordinates (IJK).
+            If a `torch.Tensor` is given, the interpolation runs in torch on the device of the points.
+
+        Returns
+        -------
+        np.ndarray or torch.Tensor
+            The interpolated values of the shape (..., *values.shape[3:]).
+        """
+        if isinstance(points, torch.Tensor):
+            return self._interpolate_torch(points)
+        points = np.asarray(points)
+        out_shape = (*points.shape[:-1], *self.channel_shape)
+        points = points.reshape(-1, 3)
+        self._check_bounds(points)
+
+        result = np.empty((len(points), self._no_channels()), dtype=self.dtype)
+        chunk_size = self._get_chunk_size(8)
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            lower, weights = self._get_corners(chunk, np)
+            if self.scale is not None:
+                weights *= self.scale
+            corners = self._gather(self._get_corner_rows(lower, np)).astype(self.dtype, copy=False)  # (N, 8, C)
+            np.matmul(weights[:, None, :], corners, out=result[start:start + len(chunk), None, :])
+        return result.reshape(out_shape)
+
+    def nearest(self, points):
+        """
+        Returns the values of the voxels nearest to the given points, a single gather per point.
+
+        Parameters
+        ----------
+        points
+            An array or tensor of the shape (..., 3) containing points in image coordinates (IJK).
+            If a `torch.Tensor` is given, the voxels are gathered in torch on the device of the points.
+
+        Returns
+        -------
+        np.ndarray or torch.Tensor
+            The values of the shape (..., *values.shape[3:]). Arrays keep the dtype of the volume
+            unless a scale is set, tensors are returned as floats.
+        """
+        xp = torch if isinstance(points, torch.Tensor) else np
+        out_shape = (*points.shape[:-1], *self.channel_shape)
+        points = points.reshape(-1, 3)
+        self._check_bounds(points)
+        if xp is torch:
+            voxels = torch.floor(points + 0.5).long()
+            upper = torch.as_tensor(self.grid_shape - 1, device=points.device)
+            voxels = torch.minimum(torch.clamp(voxels, min=0), upper)
+            values = self._get_torch_values(points.device)
+            result = self._upcast_torch(values.index_select(0, self._get_torch_rows(self._get_voxel_rows(voxels, xp))))
+        else:
+            voxels = np.clip(np.floor(points + 0.5), 0, self.grid_shape - 1).astype(np.intp)
+            result = self._gather(self._get_voxel_rows(voxels, xp))
+        if self.scale is not None:
+            result = result * self.scale if xp is torch else result.astype(self.dtype) * self.dtype.type(self.scale)
+        return result.reshape(out_shape)
+
+    def interpolate_grid(self, origins: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Interpolates the volume on axis-aligned grids with integer voxel spacing.
+
+        All points of such a grid share the fractional offset of its origin, so the trilinear weights
+        are calculated once per grid. The voxel block covering the grid (e.g. 4x4x4 voxels for a 3x3x3 grid)
+        is gathered at once and reduced by three separable linear interpolations along x, y and z.
+
+        Points outside of the volume are clamped to the border, their values are meaningless.
+
+        Parameters
+        ----------
+        origins
+            The (N, 3) origins of the grids in image coordinates (IJK)
+        offsets
+            The integer offsets of the grid points relative to the origin, with the shape (A, B, C, 3).
+            The offsets have to be a cartesian product, i.e. `offsets[a, b, c] == (ox[a], oy[b], oz[c])`.
+
+        Returns
+        -------
+        np.ndarray
+            The interpolated values of the shape (N, A, B, C, *values.shape[3:]).
+        """
+        origins = np.asarray(origins).reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.intp)
+        axis_offsets = (offsets[:, 0, 0, 0], offsets[0, :, 0, 1], offsets[0, 0, :, 2])
+        # the voxels required along every axis, relative to the lower voxel of the origin
+        required = [np.union1d(axis_offset, axis_offset + 1) for axis_offset in axis_offsets]
+        lower_positions = [_as_slice(np.searchsorted(req, axis_offset))
+                           for req, axis_offset in zip(required, axis_offsets)]
+        upper_positions = [_as_slice(np.searchsorted(req, axis_offset + 1))
+                           for req, axis_offset in zip(required, axis_offsets)]
+
+        result = np.empty((len(origins), *offsets.shape[:3], self._no_channels()), dtype=self.dtype)
+        chunk_size = self._get_chunk_size(int(np.prod([len(req) for req in required])))
+        for start in range(0, len(origins), chunk_size):
+            chunk = origins[start:start + chunk_size]
+            lower = np.floor(chunk)
+            frac = (chunk - lower).astype(self.dtype)
+            lower = lower.astype(np.intp)
+            x, y, z = (np.clip(lower[:, dim, None] + required[dim], 0, self.grid_shape[dim] - 1) for dim in range(3))
+            indices = self._axis_rows[0][x][:, :, None, None] + self._axis_rows[1][y][:, None, :, None] \
+                + self._axis_rows[2][z][:, None, None, :]
+            block = self._gather(indices).astype(self.dtype, copy=False)  # (N, |x|, |y|, |z|, C)
+            for dim in range(3):
+                prefix = (slice(None),) * (dim + 1)
+                weight = frac[:, dim].reshape((-1,) + (1,) * (block.ndim - 1))
+                lower_values = block[prefix + (lower_positions[dim],)]
+                interpolated = block[prefix + (upper_positions[dim],)] - lower_values
+                interpolated *= weight
+                interpolated += lower_values
+                block = interpolated
+            if self.scale is not None:
+                block *= self.scale
+            result[start:start + len(chunk)] = block
+        return result.reshape((len(origins), *offsets.shape[:3], *self.channel_shape))
+
+    def _no_channels(self):
+        return int(np.prod(self.channel_shape, dtype=int))
+
+    def _get_chunk_size(self, no_voxels):
+        """
+        Returns the number of points interpolated at once, if `no_voxels` voxels are gathered per point.
+        """
+        voxel_bytes = self._no_channels() * self.dtype.itemsize
+        return max(1, min(self.chunk_size, self.chunk_bytes // voxel_bytes) // no_voxels)
+
+    def _check_bounds(self, points):
+        if not self.bounds_error:
+            return
+        if isinstance(points, torch.Tensor):
+            # only copied to the host if needed, this synchronizes with the device of the points
+            points = points.detach().cpu().numpy()
+        for dim in range(3):
+            if np.any(points[:, dim] < 0) or np.any(points[:, dim] > self.grid_shape[dim] - 1):
+                raise ValueError("One of the requested xi is out of bounds in dimension %d" % dim)
+
+    def _get_corners(self, points, xp):
+        """
+        Returns the (N, 3) integer coordinates of the lower corner voxel and the (N, 8) weights of all corners.
+        `xp` is the array module (numpy or torch) matching the given points.
+        """
+        if xp is np:
+            grid_shape = self.grid_shape
+            lower = np.floor(points)
+            lower = np.clip(lower, 0, np.maximum(grid_shape - 2, 0), out=lower)
+            frac = np.clip(points - lower, 0, 1).astype(self.dtype)
+            lower = lower.astype(np.intp)
+        else:
+            grid_shape = torch.as_tensor(self.grid_shape, device=points.device)
+            lower = torch.floor(points)
+            lower = torch.minimum(torch.clamp(lower, min=0), torch.clamp(grid_shape - 2, min=0))
+            frac = torch.clamp(points - lower, 0, 1).to(self._torch_dtype())
+            lower = lower.long()
+
+        wx = xp.stack((1 - frac[:, 0], frac[:, 0]), 1)
+        wy = xp.stack((1 - frac[:, 1], frac[:, 1]), 1)
+        wz = xp.stack((1 - frac[:, 2], frac[:, 2]), 1)
+        weights = (wx[:, :, None, None] * wy[:, None, :, None] * wz[:, None, None, :]).reshape(-1, 8)
+        return lower, weights
+
+    def _get_corner_rows(self, lower, xp):
+        """
+        Returns the (N, 8) linear voxel indices of the corners of the given lower corner voxels.
+        """
+        if not self.bricked:
+            base = (lower[:, 0] * int(self.grid_shape[1]) + lower[:, 1]) * int(self.grid_shape[2]) + lower[:, 2]
+            offsets = self._corner_offsets if xp is np else torch.as_tensor(self._corner_offsets, device=lower.device)
+            return base[:, None] + offsets
+        axis_rows = self._axis_rows if xp is np else self._get_torch_axis_rows(lower.device)
+        x, y, z = (axis_rows[dim][xp.stack((lower[:, dim], lower[:, dim] + 1), 1)] for dim in range(3))
+        return (x[:, :, None, None] + y[:, None, :, None] + z[:, None, None, :]).reshape(-1, 8)
+
+    def _get_voxel_rows(self, voxels, xp):
+        """
+        Returns the (N,) linear voxel indices of the given (N, 3) voxels.
+        """
+        if not self.bricked:
+            return (voxels[:, 0] * int(self.grid_shape[1]) + voxels[:, 1]) * int(self.grid_shape[2]) + voxels[:, 2]
+        axis_rows = self._axis_rows if xp is np else self._get_torch_axis_rows(voxels.device)
+        return axis_rows[0][voxels[:, 0]] + axis_rows[1][voxels[:, 1]] + axis_rows[2][voxels[:, 2]]
+
+    def _get_torch_axis_rows(self, device):
+        key = str(device)
+        if key not in self._torch_axis_rows:
+            self._torch_axis_rows[key] = [torch.as_tensor(rows, dtype=torch.int64, device=device)
+                                          for rows in self._axis_rows]
+        return self._torch_axis_rows[key]
+
+    def _gather(self, indices):
+        """
+        Returns the rows of the given linear voxel indices, with all channels of a voxel contiguous.
+        """
+        if self._flat_index is not None:
+            indices = np.take(self._flat_index, indices)
+        if self._flat is not None:
+            return np.take(self._flat, indices, axis=0)
+        i, j, k = np.unravel_index(indices, self.values.shape[:3])
+        return np.asarray(self.values[i, j, k]).reshape((*indices.shape, -1))
+
+    def _torch_dtype(self):
+        return torch.float32 if self.dtype == np.float32 else torch.float64
+
+    def _get_torch_values(self, device):
+        key = str(device)
+        if key not in self._torch_values:
+            values = np.ascontiguousarray(self.values).reshape(-1, self._no_channels()) if self._flat is None \
+                else np.ascontiguousarray(self._flat)
+            if values.dtype == np.uint16:
+                # torch has no complete uint16 support, the values are restored after gathering them
+                values = values.view(np.int16)
+            with warnings.catch_warnings():
+                # read-only (e.g. memory-mapped) volumes are never written by the interpolator
+                warnings.simplefilter("ignore", UserWarning)
+                flat = torch.from_numpy(values)
+            if values.dtype not in (np.float16, np.int16):
+                flat = flat.to(dtype=self._torch_dtype())
+            self._torch_values[key] = flat.to(device=device)
+        return self._torch_values[key]
+
+    def _get_torch_rows(self, linear_indices):
+        """
+        Returns the rows of the given linear voxel indices in the values of `_get_torch_values`.
+        """
+        if self._flat_index is None:
+            return linear_indices
+        key = str(linear_indices.device)
+        if key not in self._torch_index:
+            self._torch_index[key] = torch.from_numpy(self._flat_index.astype(np.int64)).to(linear_indices.device)
+        return self._torch_index[key].index_select(0, linear_indices)
+
+    def _upcast_torch(self, corners):
+        if self._unsigned:
+            corners = corners.to(torch.int32) & 0xFFFF
+        return corners.to(self._torch_dtype())
+
+    def _interpolate_torch(self, points):
+        out_shape = (*points.shape[:-1], *self.channel_shape)
+        points = points.reshape(-1, 3).to(torch.float64)
+        self._check_bounds(points)
+        values = self._get_torch_values(points.device)
+
+        results = []
+        for start in range(0, len(points), self.chunk_size):
+            chunk = points[start:start + self.chunk_size]
+            lower, weights = self._get_corners(chunk, torch)
+            if self.scale is not None:
+                weights = weights * self.scale
+            rows = self._get_torch_rows(self._get_corner_rows(lower, torch).reshape(-1))
+            corners = values.index_select(0, rows).reshape(len(chunk), 8, -1)
+            results.append((weights[:, :, None] * self._upcast_torch(corners)).sum(1))
+        result = torch.cat(results) if results else torch.empty((0, values.shape[1]), dtype=self._torch_dtype(),
+                                                                device=points.device)
+        return result.reshape(out_shape)
@@ -2,6 +2,7 @@
 The postprocessing submodule of the data module hosts different options
 of postprocessing the DWI data. Those can be passed to datasets for further use.
 """
+import hashlib
 from typing import Union
 import numpy as np
 from dipy.core.sphere import Sphere
@@ -12,12 +13,29 @@ from dfibert.util import get_2D_sphere
 
 
 class PostprocessingOption(object):
+    """
+    The base class of all postprocessing options.
+
+    Attributes
+    ----------
+    id: str
+        An ID representing the option and its parameters.
+    linear: bool
+        True if the option is a linear map of the DWI values of each single point.
+        Such options commute with the trilinear interpolation, so the DataContainer can apply them
+        once per voxel and interpolate in the resulting feature space instead.
+    """
+    id = "PostprocessingOption"
+    linear = False
+
     def process(self, data_container, points, dwi):
         raise NotImplementedError()
 
 
 class Raw(PostprocessingOption):
     """Does no resampling."""
+    id = "Raw"
+
     def process(self, data_container, points, dwi):
         return dwi
 
@@ -38,16 +56,51 @@ class SphericalHarmonics(PostprocessingOption):
         super().__init__()
         self.sh_order = sh_order
         self.smooth = smooth
+        self.linear = True
+        self.id = "SphericalHarmonics-order{}-smooth{}".format(sh_order, smooth)
+        self._projections = {}
 
-    def process(self, data_container, points, dwi):
-        raw_sphere = Sphere(xyz=data_container.bvecs)
+    def _get_basis(self, bvecs):
+        """
+        Returns the matrix mapping the DWI values measured at the given bvecs to the SH coefficients.
+        """
+        raw_sphere = Sphere(xyz=bvecs)
 
         real_sh, _, n = real_sym_sh_mrtrix(self.sh_order, raw_sphere.theta, raw_sphere.phi)
         l = -n * (n + 1)
         inv_b = smooth_pinv(real_sh, np.sqrt(self.smooth) * l)
-        data_sh = np.dot(dwi, inv_b.T)
+        return inv_b.T
 
-        return data_sh
+    def get_projection(self, bvecs, dtype=np.float64):
+        """
+        Returns the matrix applied to the DWI values by `process`.
+
+        The matrix only depends on the bvecs, so it is calculated once per gradient table and memoized.
+
+        Parameters
+        ----------
+        bvecs
+            The bvecs of the DWI data, with the shape (C, 3)
+        dtype
+            The dtype of the DWI data. Single precision data is processed with a single precision matrix.
+
+        Returns
+        -------
+        np.ndarray
+            The matrix of the shape (C, postprocessed size).
+        """
+        bvecs = np.ascontiguousarray(bvecs, dtype=np.float64)
+        dtype = np.result_type(dtype, np.float32)
+        key = (bvecs.tobytes(), dtype.str)
+        projection = self._projections.get(key)
+        if projection is None:
+            projection = self._get_basis(bvecs).astype(dtype)
+            projection.setflags(write=False)
+            self._projections[key] = projection
+        return projection
+
+    def process(self, data_container, points, dwi):
+        return np.dot(dwi, self.get_projection(data_container.bvecs, dwi.dtype))
 
 
 class Resample(SphericalHarmonics):
@@ -68,15 +121,15 @@ class Resample(SphericalHarmonics):
         super().__init__(sh_order=sh_order, smooth=smooth)
         if isinstance(sphere, Sphere):
             self.sphere = sphere
+            sphere = "custom" + hashlib.sha1(np.ascontiguousarray(sphere.vertices).tobytes()).hexdigest()[:8]
         else:  # get with name
             self.sphere = get_sphere(sphere)
+        self.id = "Resample-order{}-smooth{}-sphere-{}".format(sh_order, smooth, sphere)
         self.real_sh, _, _ = real_sym_sh_mrtrix(self.sh_order, self.sphere.theta, self.sphere.phi)
 
-    def process(self, data_container, points, dwi):
-        data_sh = super().process(data_container, points, dwi)
-        data_resampled = np.dot(data_sh, self.real_sh.T)
-
-        return data_resampled
+    def _get_basis(self, bvecs):
+        # fuses the SH fit and the resampling into a single matrix, so every batch is one matrix product
+        return super()._get_basis(bvecs) @ self.real_sh.T
 
 
 class Resample100(Resample):
@@ -0,0 +1,171 @@
+"""
+The profiling submodule records where the time and memory of preparing a subject go.
+
+Pass a `PreprocessingProfiler` to `DataPreprocessor.get_hcp`, `get_ismrm`, `preprocess` or `preprocess_to`
+to record an event for every file load and every preprocessing step. Every event contains the wall time,
+the CPU time (including finished worker processes), the change of the RSS, the peak RSS above the RSS at its
+start and the bytes of its output arrays. The events can be exported as JSON report or as Chrome trace,
+which can be opened in `chrome://tracing` or https://ui.perfetto.dev.
+"""
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+
+
+def _current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:  # not on Linux, the peak RSS is the best estimate we have
+        return _peak_rss()
+
+
+def _peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss() -> bool:
+    # supported by Linux since 4.0, otherwise the peak RSS of the process is used
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _cpu_time() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class PreprocessingProfiler(object):
+    def __init__(self):
+        """
+        Creates an empty profiler. Pass it to the loading and preprocessing methods of a `DataPreprocessor`
+        to record their events, a profiler can record the preparation of multiple subjects.
+
+        The RSS and the CPU time are measured for the whole process, so events running concurrently
+        (e.g. the file loads) include each other's memory and CPU time.
+        """
+        self.events = []
+        self._origin = time.perf_counter()
+        self._open = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def record(self, name: str, category: str = "preprocess", **args):
+        """
+        Records an event for the enclosed block.
+
+        Parameters
+        ----------
+        name
+            The name of the event, e.g. the preprocessing step
+        category
+            The category of the event, "load" or "preprocess"
+        args
+            Further JSON-serializable data stored with the event
+
+        Yields
+        ------
+        dict
+            The event, its "bytes" entry can be set to the number of bytes produced by the block.
+        """
+        event = OrderedDict(name=name, category=category, thread=threading.get_ident(), bytes=None, args=args)
+        with self._lock:
+            # the peak RSS is reset for every event, so it is passed to the enclosing events before
+            self._update_peaks()
+            event["rss_before"] = _current_rss()
+            event["peak_rss"] = event["rss_before"]
+            _reset_peak_rss()
+            self._open.append(event)
+        start, cpu_start = time.perf_counter(), _cpu_time()
+        try:
+            yield event
+        finally:
+            wall_time, cpu_time = time.perf_counter() - start, _cpu_time() - cpu_start
+            with self._lock:
+                self._update_peaks()
+                self._open.remove(event)
+                rss_before = event.pop("rss_before")
+                peak_rss = event.pop("peak_rss")
+                event.update(start=start - self._origin, wall_time=wall_time, cpu_time=cpu_time,
+                             rss_delta=_current_rss() - rss_before, peak_rss_delta=peak_rss - rss_before)
+                event.move_to_end("args")
+                self.events.append(event)
+
+    def _update_peaks(self):
+        peak_rss = _peak_rss()
+        for event in self._open:
+            event["peak_rss"] = max(event["peak_rss"], peak_rss)
+
+    def to_dict(self) -> dict:
+        """
+        Returns the report of all events, sorted by their start, plus the totals per event name.
+
+        Returns
+        -------
+        dict
+            The JSON-serializable report with the "events" and "totals" entries.
+            Times are given in seconds, memory in bytes.
+        """
+        events = sorted(self.events, key=lambda event: event["start"])
+        totals = OrderedDict()
+        for event in events:
+            total = totals.setdefault(event["name"], OrderedDict(category=event["category"], count=0, wall_time=0.,
+                                                                 cpu_time=0., peak_rss_delta=0))
+            total["count"] += 1
+            total["wall_time"] += event["wall_time"]
+            total["cpu_time"] += event["cpu_time"]
+            total["peak_rss_delta"] = max(total["peak_rss_delta"], event["peak_rss_delta"])
+        return {"events": [dict(event) for event in events], "totals": totals}
+
+    def save_json(self, path: str):
+        """
+        Saves the report returned by `to_dict` as JSON file.
+        """
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def to_chrome_trace(self) -> dict:
+        """
+        Returns the events in the Chrome trace event format, the memory and bytes are stored as arguments.
+        """
+        pid = os.getpid()
+        trace_events = []
+        for event in sorted(self.events, key=lambda event: event["start"]):
+            args = dict(event["args"], cpu_time=event["cpu_time"], rss_delta=event["rss_delta"],
+                        peak_rss_delta=event["peak_rss_delta"], bytes=event["bytes"])
+            trace_events.append({"name": event["name"], "cat": event["category"], "ph": "X", "pid": pid,
+                                 "tid": event["thread"], "ts": event["start"] * 1e6,
+                                 "dur": event["wall_time"] * 1e6, "args": args})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path: str):
+        """
+        Saves the events as Chrome trace, see `to_chrome_trace`.
+        """
+        with open(path, "w") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+    def __str__(self):
+        lines = ["{:40s} {:>10s} {:>9s} {:>9s} {:>12s} {:>12s}"
+                 .format("event", "category", "wall [s]", "cpu [s]", "peak [MiB]", "bytes [MiB]")]
+        for event in sorted(self.events, key=lambda event: event["start"]):
+            lines.append("{:40.40s} {:>10s} {:9.3f} {:9.3f} {:12.1f} {:>12s}".format(
+                event["name"], event["category"], event["wall_time"], event["cpu_time"],
+                event["peak_rss_delta"] / 1024 ** 2,
+                "" if event["bytes"] is None else "{:.1f}".format(event["bytes"] / 1024 ** 2)))
+        return "\n".join(lines)
@@ -0,0 +1,187 @@
+"""
+The registry submodule hands out the DataContainers of multiple subjects by their subject ID.
+
+Subjects are loaded on demand (from the preprocessing cache, if one is given) and the least recently used
+subjects are evicted as soon as the resident subjects exceed a byte budget, so training on many subjects
+doesn't require all of them to be in memory at once.
+"""
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class SubjectReference(object):
+    """
+    A lightweight reference to a subject of a `SubjectRegistry`, which can be passed to datasets
+    instead of a DataContainer. The DataContainer is requested from the registry on every access,
+    so it can be evicted while the dataset isn't used.
+
+    Attributes
+    ----------
+    registry: SubjectRegistry
+        The registry the subject is registered in
+    subject_id: str
+        The ID of the subject
+    id: str
+        An ID representing the subject, used in the IDs of datasets
+    """
+
+    def __init__(self, registry, subject_id: str):
+        self.registry = registry
+        self.subject_id = subject_id
+        self.id = "Subject[{}]".format(subject_id)
+
+    def get(self):
+        """
+        Returns the DataContainer of the subject, loading it if needed.
+        """
+        return self.registry.get(self.subject_id)
+
+
+class SubjectRegistry(object):
+    def __init__(self, preprocessor=None, cache=None, max_bytes: Optional[int] = None, **load_kwargs):
+        """
+        Creates a registry for the DataContainers of multiple subjects.
+
+        Registered subjects are loaded on first use with `preprocessor.get_hcp` (or `get_ismrm`).
+        If a `DataContainerCache` is given, the preprocessed subjects are read from (or stored in) it,
+        so loading an evicted subject again only maps the cached files.
+
+        Parameters
+        ----------
+        preprocessor
+            The DataPreprocessor applied to every subject, by default no preprocessing
+        cache
+            An optional DataContainerCache for the preprocessed subjects
+        max_bytes
+            The maximum number of bytes of all resident subjects (see `DataContainer.nbytes`).
+            If exceeded, the least recently used subjects are evicted. By default, subjects are never evicted.
+        load_kwargs
+            Further arguments of `get_hcp` / `get_ismrm`, e.g. `lazy` or `load_t1`
+        """
+        if preprocessor is None:
+            from dfibert.data import DataPreprocessor
+            preprocessor = DataPreprocessor()
+        self.preprocessor = preprocessor
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.load_kwargs = load_kwargs
+        self._subjects = {}
+        self._resident = OrderedDict()
+        self._lock = threading.RLock()
+
+    def register(self, subject_id: str, path: str, dataset: str = "hcp") -> SubjectReference:
+        """
+        Registers a subject without loading it.
+
+        Parameters
+        ----------
+        subject_id
+            The ID of the subject, e.g. the HCP subject number
+        path
+            The folder of the subject
+        dataset
+            The type of the dataset, "hcp" or "ismrm"
+
+        Returns
+        -------
+        SubjectReference
+            A reference to the subject, e.g. for datasets
+        """
+        if dataset not in ("hcp", "ismrm"):
+            raise ValueError("dataset has to be 'hcp' or 'ismrm', not {}".format(dataset))
+        with self._lock:
+            self._subjects[subject_id] = (path, dataset)
+            self._resident.pop(subject_id, None)
+        return self.reference(subject_id)
+
+    def reference(self, subject_id: str) -> SubjectReference:
+        """
+        Returns a reference to the registered subject with the given ID.
+        """
+        if subject_id not in self._subjects:
+            raise KeyError("Subject {} is not registered".format(subject_id))
+        return SubjectReference(self, subject_id)
+
+    def get(self, subject_id: str):
+        """
+        Returns the DataContainer of the registered subject with the given ID.
+
+        The subject is loaded if it isn't resident, then the least recently used subjects are evicted
+        until the budget is met again. The requested subject itself is never evicted by this call.
+
+        Parameters
+        ----------
+        subject_id
+            The ID of the subject
+
+        Returns
+        -------
+        DataContainer
+            The DataContainer of the subject
+        """
+        with self._lock:
+            if subject_id in self._resident:
+                self._resident.move_to_end(subject_id)
+                return self._resident[subject_id]
+            if subject_id not in self._subjects:
+                raise KeyError("Subject {} is not registered".format(subject_id))
+            path, dataset = self._subjects[subject_id]
+            load = self.preprocessor.get_hcp if dataset == "hcp" else self.preprocessor.get_ismrm
+            data_container = load(path, cache=self.cache, **self.load_kwargs)
+            self._resident[subject_id] = data_container
+            self._evict(keep=subject_id)
+            return data_container
+
+    def evict(self, subject_id: Optional[str] = None):
+        """
+        Evicts the subject with the given ID, or all subjects if no ID is given.
+        Evicted subjects are loaded again on their next use.
+        """
+        with self._lock:
+            if subject_id is None:
+                self._resident.clear()
+            else:
+                self._resident.pop(subject_id, None)
+
+    @property
+    def resident_bytes(self) -> int:
+        """The number of bytes of all resident subjects, see `DataContainer.nbytes`."""
+        with self._lock:
+            return sum(data_container.nbytes for data_container in self._resident.values())
+
+    @property
+    def resident_subjects(self) -> list:
+        """The IDs of the resident subjects, from the least to the most recently used one."""
+        with self._lock:
+            return list(self._resident)
+
+    def _evict(self, keep: str):
+        if self.max_bytes is None:
+            return
+        # the sizes are determined on every eviction, because postprocessed volumes are added on use
+        sizes = {subject_id: data_container.nbytes for subject_id, data_container in self._resident.items()}
+        total = sum(sizes.values())
+        for subject_id in list(self._resident):
+            if total <= self.max_bytes:
+                break
+            if subject_id != keep:
+                del self._resident[subject_id]
+                total -= sizes[subject_id]
+
+    def __getstate__(self):
+        # resident subjects aren't pickled, e.g. every DataLoader worker loads the subjects it uses on its own
+        state = self.__dict__.copy()
+        state["_resident"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __contains__(self, subject_id: str) -> bool:
+        return subject_id in self._subjects
+
+    def __len__(self) -> int:
+        return len(self._subjects)
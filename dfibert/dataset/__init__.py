@@ -1,13 +1,18 @@
 """
 The dataset module is handling the datasets usable for training and testing.
 """
+import copy
 import json
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from types import SimpleNamespace
 
 import torch
 import numpy as np
 
+from dfibert.data.registry import SubjectReference
+from .caching import ItemCache, UnboundedCache
 from .exceptions import WrongDatasetTypePassedError, FeatureShapesNotEqualError
 
 
@@ -205,7 +210,8 @@ class BaseDataset(MovableData):
     device: torch.device, optional
         The device the movable data currently is located on.
     data_container: DataContainer
-        The DataContainer the dataset is based on
+        The DataContainer the dataset is based on. If the dataset was created with a `SubjectReference`,
+        the DataContainer is requested from its `SubjectRegistry` on every access.
     id: str
         An ID representing this Dataset. This is not unique to any instance, but it consists of parameters and used dataset. 
 
@@ -230,8 +236,8 @@ class BaseDataset(MovableData):
         """
         Parameters
         ----------
-        data_container: DataContainer
-            The DataContainer the dataset uses
+        data_container: DataContainer or SubjectReference
+            The DataContainer the dataset uses, or a reference to a subject of a `SubjectRegistry`
         device : torch.device, optional
             The device which the `MovableData` should be moved to on load, by default cpu.
         """
@@ -241,6 +247,16 @@ class BaseDataset(MovableData):
         if data_container is not None:
             self.id = self.id + "[" + str(data_container.id) + "]"
 
+    @property
+    def data_container(self):
+        if isinstance(self._data_container, SubjectReference):
+            return self._data_container.get()
+        return self._data_container
+
+    @data_container.setter
+    def data_container(self, data_container):
+        self._data_container = data_container
+
 
 class IterableDataset(BaseDataset, torch.utils.data.Dataset):
     def __init__(self, data_container, device=None):
@@ -260,39 +276,165 @@ class SaveableDataset(IterableDataset):
     def __init__(self, data_container, device=None):
         IterableDataset.__init__(self,data_container, device=device)
     
-    def _get_variable_elements_data(self):
-        lengths = np.zeros(len(self), dtype=int)
-        for i, (inp, out) in enumerate(self):
-            assert len(inp) == len(out)
-            lengths[i] = len(inp)
-        return lengths, inp.shape[1:], out.shape[1:]
+    def _calculate_items(self, indices):
+        """
+        Returns the (input, output) tuples of the items with the given indices as float32 numpy arrays.
+        """
+        items = []
+        for index in indices:
+            inp, out = self[index]
+            items.append((_to_numpy(inp), _to_numpy(out)))
+        return items
+
+    def _for_writing(self):
+        """
+        Returns the dataset passed to the worker processes of `saveToPath`, e.g. a copy without cached items.
+        """
+        return self
+
+    def _get_forward_index(self, index):
+        """
+        Returns the index of the item whose input is the input of the given item in reverse order,
+        None if the input of the given item has to be calculated.
+        """
+        return None
+
+    def _calculate_outputs(self, indices):
+        """
+        Returns the outputs of the items with the given indices, which have a forward index.
+        """
+        raise NotImplementedError()
+
+    def saveToPath(self, path, workers=1, chunk_size=64, resume=True):
+        """
+        Saves all items of the dataset into the given directory, so they can be loaded as `LoadedDataset`.
 
-    def saveToPath(self, path):
+        Every item is computed once, in chunks of `chunk_size` items by `workers` processes.
+        Chunks of items with a forward index (e.g. reversed streamlines) are derived from the already written
+        inputs in this process instead, only their outputs are computed. Finished chunks are appended to
+        `input.npy` and `output.npy` in order, `lengths.npy` and `info.json` are written at the end.
+        The progress is stored after every chunk, so if the process is interrupted,
+        calling `saveToPath` again continues after the last written chunk.
 
+        Parameters
+        ----------
+        path : str
+            The directory to save the dataset in
+        workers : int, optional
+            The number of worker processes computing the items, by default the items are computed in this process
+        chunk_size : int, optional
+            The number of items computed at once per worker
+        resume : bool, optional
+            If False, an interrupted previous save is started over instead of being continued
+        """
         os.makedirs(path, exist_ok=True)
-        lengths, in_shape, out_shape = self._get_variable_elements_data()
-        print(lengths)
-        data_length = int(np.sum(lengths))
+        files = {name: os.path.join(path, name) for name in ('input.npy', 'output.npy', 'lengths.raw')}
+        progress_path = os.path.join(path, 'progress.json')
+        info_path = os.path.join(path, 'info.json')
+
+        progress = None
+        if resume and os.path.isfile(progress_path):
+            with open(progress_path) as progress_file:
+                progress = json.load(progress_file)
+            if progress["id"] != self.id or progress["length"] != len(self):
+                progress = None
+        if progress is None:
+            progress = {"id": self.id, "length": len(self), "next_index": 0, "sizes": [0, 0, 0],
+                        "input_shape": None, "output_shape": None}
+        # the saved dataset is only complete (and loadable) once info.json is written again
+        if os.path.isfile(info_path):
+            os.remove(info_path)
+        # data written after the last stored progress is discarded
+        for name, size in zip(files, progress["sizes"]):
+            with open(files[name], 'ab') as file:
+                file.truncate(size)
+        lengths = list(np.fromfile(files['lengths.raw'], dtype=np.int64))
+        offsets = list(np.cumsum([0] + lengths))
+
+        def is_derived(chunk):
+            forward_indices = [self._get_forward_index(index) for index in chunk]
+            return all(index is not None and index < chunk.start for index in forward_indices)
+
+        def derive(chunk):
+            # the inputs of the forward items are read back from input.npy and reversed
+            row_shape = progress["input_shape"]
+            row_bytes = 4 * int(np.prod(row_shape, dtype=int))
+            inputs = []
+            for index in chunk:
+                forward_index = self._get_forward_index(index)
+                inp = np.fromfile(files['input.npy'], dtype=np.float32, count=lengths[forward_index] * row_bytes // 4,
+                                  offset=offsets[forward_index] * row_bytes)
+                inputs.append(np.ascontiguousarray(inp.reshape([lengths[forward_index]] + row_shape)[::-1]))
+            return [(inp, _to_numpy(out)) for inp, out in zip(inputs, self._calculate_outputs(chunk))]
+
+        def write(start, items):
+            with open(files['input.npy'], 'ab') as inp_file, open(files['output.npy'], 'ab') as out_file, \
+                    open(files['lengths.raw'], 'ab') as lengths_file:
+                for inp, out in items:
+                    assert len(inp) == len(out)
+                    inp.tofile(inp_file)
+                    out.tofile(out_file)
+                    np.array([len(inp)], dtype=np.int64).tofile(lengths_file)
+                    lengths.append(len(inp))
+                    offsets.append(offsets[-1] + len(inp))
+                sizes = [inp_file.tell(), out_file.tell(), lengths_file.tell()]
+            if progress["input_shape"] is None and items:
+                progress["input_shape"], progress["output_shape"] = list(items[0][0].shape[1:]), \
+                                                                    list(items[0][1].shape[1:])
+            progress.update(next_index=start + len(items), sizes=sizes)
+            with open(progress_path + '.tmp', 'w') as progress_file:
+                json.dump(progress, progress_file)
+            os.replace(progress_path + '.tmp', progress_path)
+            print("{}/{}".format(progress["next_index"], len(self)), end="\r")
+
+        chunks = [range(start, min(start + chunk_size, len(self)))
+                  for start in range(progress["next_index"], len(self), chunk_size)]
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_writer,
+                                     initargs=(self._for_writing(),)) as executor:
+                # only a few chunks are computed ahead, so finished chunks don't pile up in memory
+                futures = deque()
+                for chunk in chunks:
+                    # derived chunks are written in order as well, after the chunks of their forward items
+                    futures.append((chunk, None if is_derived(chunk) else executor.submit(_calculate_chunk, chunk)))
+                    if len(futures) >= 2 * workers:
+                        written, future = futures.popleft()
+                        write(written.start, derive(written) if future is None else future.result())
+                while futures:
+                    written, future = futures.popleft()
+                    write(written.start, derive(written) if future is None else future.result())
+        else:
+            for chunk in chunks:
+                write(chunk.start, derive(chunk) if is_derived(chunk) else self._calculate_items(chunk))
 
-        in_shape=tuple([data_length] + list(in_shape))
-        out_shape=tuple([data_length] + list(out_shape))
-
-        inp_memmap = np.memmap(os.path.join(path, 'input.npy'), dtype='float32', shape=in_shape, mode='w+')
-        out_memmap = np.memmap(os.path.join(path, 'output.npy'), dtype='float32', shape=out_shape, mode='w+')
-        
-        idx = 0
-        assert (len(self) == len(lengths))
-        for i in range(len(self)):
-            inp,out = self[i]
-            print(i, ": ", inp.shape, " l " ,lengths[i],  " - ",lengths.shape)
-            assert(len(inp) == lengths[i])
-            inp_memmap[idx:(idx + lengths[i])] = inp.numpy()
-            out_memmap[idx:(idx + lengths[i])] = out.numpy()
-            idx = idx +  lengths[i] 
-            print("{}/{}".format(i, len(lengths)), end="\r")
+        lengths = np.array(lengths, dtype=np.int64)
+        data_length = int(np.sum(lengths))
+        in_shape = [data_length] + (progress["input_shape"] or [])
+        out_shape = [data_length] + (progress["output_shape"] or [])
         np.save(os.path.join(path, 'lengths.npy'), lengths)
-        with open(os.path.join(path, 'info.json'), 'w') as infofile:
-            json.dump({"id": self.id, "input_shape":in_shape, "output_shape":out_shape}, infofile)
+        with open(info_path, 'w') as infofile:
+            json.dump({"id": self.id, "input_shape": in_shape, "output_shape": out_shape}, infofile)
+        os.remove(files['lengths.raw'])
+        os.remove(progress_path)
+
+
+# the dataset of a worker process of `SaveableDataset.saveToPath`
+_writer_dataset = None
+
+
+def _init_writer(dataset):
+    global _writer_dataset
+    _writer_dataset = dataset
+
+
+def _calculate_chunk(indices):
+    return _writer_dataset._calculate_items(indices)
+
+
+def _to_numpy(tensor):
+    if isinstance(tensor, torch.Tensor):
+        tensor = tensor.detach().cpu().numpy()
+    return np.ascontiguousarray(tensor, dtype=np.float32)
 
 
 class LoadedDataset(IterableDataset):
@@ -358,6 +500,11 @@ class ConcatenatedDataset(SaveableDataset):
 
         return self.datasets[i][index - self.__lens[i]]
 
+    def _for_writing(self):
+        dataset = copy.copy(self)
+        dataset.datasets = [ds._for_writing() if isinstance(ds, SaveableDataset) else ds for ds in self.datasets]
+        return dataset
+
     def get_feature_shapes(self):
         # assert that each dataset has same dataset shape
         (inp, out) = self.datasets[0].get_feature_shapes()
@@ -396,21 +543,24 @@ class StreamlineDataset(SaveableDataset):
         self.id = self.id + "-{}-(".format(processing.id) + ")"
         self.options = SimpleNamespace()
         self.options.append_reverse = append_reverse
-        self.options.online_caching = online_caching
         self.options.processing = processing
-        if online_caching:
-            self.cache = [None] * len(self)
+        # online_caching is either a caching policy (see `dfibert.dataset.caching`) or a bool
+        if isinstance(online_caching, ItemCache):
+            self.cache = online_caching
+        elif online_caching:
+            self.cache = UnboundedCache(len(self))
+        else:
+            self.cache = None
+        self.options.online_caching = self.cache is not None
         self.feature_shapes = None
     
-    def _get_variable_elements_data(self):
-        lengths = np.zeros(len(self) , dtype=int)
-        for i, sl in enumerate(self.streamlines):
-            lengths[i] = len(sl)
-        if self.options.append_reverse:
-            lengths[len(self.streamlines):] = lengths[:len(self.streamlines)]
-        (inp, out) = self[0]
-        return lengths, inp.shape[1:], out.shape[1:]
-
+    def _for_writing(self):
+        # the workers don't cache the items they compute
+        dataset = copy.copy(self)
+        dataset.options = copy.copy(self.options)
+        dataset.options.online_caching = False
+        dataset.cache = None
+        return dataset
 
     def __len__(self):
         if self.options.append_reverse:
@@ -418,21 +568,63 @@ class StreamlineDataset(SaveableDataset):
         return len(self.streamlines)
 
     def __getitem__(self, index):
-        if self.options.online_caching and self.cache[index] is not None:
-            return self.cache[index]
-        (inp, output) = self._calculate_item(index)
-        inp = torch.from_numpy(inp).to(device=self.device, dtype=torch.float32) # TODO work on dtypes
-        output = torch.from_numpy(output).to(device=self.device, dtype=torch.float32)
+        return self.__getitems__([index])[0]
 
-        if self.options.online_caching:
-            self.cache[index] = (inp, output)
-            return self.cache[index]
-        else:
-            return (inp, output)
+    def __getitems__(self, indices):
+        """
+        Returns the items with the given indices, e.g. a batch of a `torch.utils.data.DataLoader`.
+        All items which aren't cached are calculated at once, see `Processing.calculate_streamlines`.
 
-    def _calculate_item(self, index):
-        streamline = self._get_streamline(index)
-        return self.options.processing.calculate_streamline(self.data_container, streamline)
+        If the processing has a reversible input (see `Processing.reversible_input`), the items of reversed
+        streamlines are derived from the items of their streamlines, which are calculated and cached instead.
+        """
+        # the indices of the items which are calculated or cached, and the reversed items derived from them
+        keys = []
+        derived = []
+        for position, index in enumerate(indices):
+            forward_index = self._get_forward_index(index)
+            if forward_index is None:
+                keys.append(index)
+            else:
+                keys.append(forward_index)
+                derived.append(position)
+
+        calculated_items = {}
+        if self.options.online_caching:
+            for key in dict.fromkeys(keys):
+                item = self.cache.get(key)
+                if item is not None:
+                    calculated_items[key] = tuple(tensor.to(device=self.device) for tensor in item)
+        missing = [key for key in dict.fromkeys(keys) if key not in calculated_items]
+        for key, (inp, output) in zip(missing, self._calculate_streamlines(missing)):
+            inp = torch.from_numpy(inp).to(device=self.device, dtype=torch.float32) # TODO work on dtypes
+            output = torch.from_numpy(output).to(device=self.device, dtype=torch.float32)
+            if self.options.online_caching:
+                self.cache.put(key, (inp, output))
+            calculated_items[key] = (inp, output)
+
+        items = [calculated_items[key] for key in keys]
+        for position, output in zip(derived, self._calculate_outputs([indices[position] for position in derived])):
+            output = torch.from_numpy(output).to(device=self.device, dtype=torch.float32)
+            items[position] = (torch.flip(items[position][0], [0]), output)
+        return items
+
+    def _calculate_items(self, indices):
+        return [(_to_numpy(inp), _to_numpy(out)) for inp, out in self.__getitems__(list(indices))]
+
+    def _get_forward_index(self, index):
+        if (self.options.append_reverse and index >= len(self.streamlines)
+                and self.options.processing.reversible_input):
+            return index - len(self.streamlines)
+        return None
+
+    def _calculate_outputs(self, indices):
+        return [self.options.processing.calculate_output(self.data_container, self._get_streamline(index))
+                for index in indices]
+
+    def _calculate_streamlines(self, indices):
+        streamlines = [self._get_streamline(index) for index in indices]
+        return self.options.processing.calculate_streamlines(self.data_container, streamlines)
 
     def _get_streamline(self, index):
         reverse = False
@@ -460,54 +652,26 @@ class StreamlineDataset(SaveableDataset):
         return self.feature_shapes
 
     def cuda(self, device=None, non_blocking=False, memory_format=torch.preserve_format):
-        if not self.options.online_caching:
-            return
-        dwi = None
-        for index, el in enumerate(self.cache):
-            if el is None:
-                continue
-            dwi, next_dir = el
-            dwi = dwi.cuda(device=device, non_blocking=non_blocking,
-                           memory_format=memory_format)
-            next_dir = next_dir.cuda(device=device, non_blocking=non_blocking,
-                                     memory_format=memory_format)
-            self.cache[index] = (dwi, next_dir)
-            if self.device == dwi.device:  # move is unnecessary
-                return
-        if dwi is not None:
-            self.device = dwi.device
-        return self
+        return self._move_cache(lambda tensor: tensor.cuda(device=device, non_blocking=non_blocking,
+                                                            memory_format=memory_format))
 
     def cpu(self, memory_format=torch.preserve_format):
-        if not self.options.online_caching:
-            return
-        dwi = None
-        for index, el in enumerate(self.cache):
-            if el is None:
-                continue
-            dwi, next_dir = el
-            dwi = dwi.cpu(memory_format=memory_format)
-            next_dir = next_dir.cpu(memory_format=memory_format)
-            self.cache[index] = (dwi, next_dir)
-            if self.device == dwi.device:  # move is unnecessary
-                return
-        if dwi is not None:
-            self.device = dwi.device
-        return self
+        return self._move_cache(lambda tensor: tensor.cpu(memory_format=memory_format))
 
     def to(self, *args, **kwargs):
+        return self._move_cache(lambda tensor: tensor.to(*args, **kwargs))
+
+    def _move_cache(self, move):
         if not self.options.online_caching:
             return
-        dwi = None
-        for index, el in enumerate(self.cache):
-            if el is None:
-                continue
-            dwi, next_dir = el
-            dwi = dwi.to(*args, **kwargs)
-            next_dir = next_dir.to(*args, **kwargs)
-            self.cache[index] = (dwi, next_dir)
-            if self.device == dwi.device: # move is unnecessary
-                return
-        if dwi is not None:
-            self.device = dwi.device
+        devices = []
+
+        def move_item(item):
+            item = tuple(move(tensor) for tensor in item)
+            devices.append(item[0].device)
+            return item
+
+        self.cache.apply(move_item)
+        if devices:
+            self.device = devices[0]
         return self
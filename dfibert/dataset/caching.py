@@ -0,0 +1,281 @@
+"""
+The caching submodule contains the policies caching the computed items of a dataset,
+see the `online_caching` parameter of `StreamlineDataset`.
+
+Every policy counts its hits, misses and evictions, `stats()` returns them together with the
+number of cached items and bytes, so the cache can be sized per node.
+"""
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+
+
+def get_item_nbytes(item: tuple) -> int:
+    """
+    Returns the number of bytes of the tensors of the given item.
+    """
+    return sum(tensor.element_size() * tensor.nelement() for tensor in item)
+
+
+class ItemCache(object):
+    """
+    The base class of the caching policies of datasets, mapping item indices to tuples of tensors.
+
+    Attributes
+    ----------
+    hits: int
+        The number of requested items which were cached
+    misses: int
+        The number of requested items which weren't cached
+    evictions: int
+        The number of items removed to stay within the budget
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, index: int) -> Optional[tuple]:
+        """
+        Returns the cached item with the given index, None if it isn't cached.
+        """
+        item = self._get(index)
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def put(self, index: int, item: tuple):
+        """
+        Caches the given item under the given index, possibly evicting other items.
+        """
+        raise NotImplementedError()
+
+    def apply(self, function: Callable[[tuple], tuple]):
+        """
+        Replaces every cached item by the result of the given function, e.g. to move all items to another device.
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """
+        Removes all cached items, the counters are kept.
+        """
+        raise NotImplementedError()
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes of the items held in memory."""
+        raise NotImplementedError()
+
+    def stats(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            The hits, misses, evictions, hit rate, number of cached items and number of bytes held in memory.
+        """
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0., "items": len(self), "nbytes": self.nbytes}
+
+    def _get(self, index: int) -> Optional[tuple]:
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class UnboundedCache(ItemCache):
+    def __init__(self, size: int):
+        """
+        Creates a cache keeping every item forever, the former behaviour of `online_caching=True`.
+
+        Parameters
+        ----------
+        size
+            The number of items of the dataset
+        """
+        super().__init__()
+        self._items = [None] * size
+        self._nbytes = 0
+
+    def _get(self, index):
+        return self._items[index]
+
+    def put(self, index, item):
+        if self._items[index] is not None:
+            self._nbytes -= get_item_nbytes(self._items[index])
+        self._items[index] = item
+        self._nbytes += get_item_nbytes(item)
+
+    def apply(self, function):
+        for index, item in enumerate(self._items):
+            if item is not None:
+                self._items[index] = function(item)
+
+    def clear(self):
+        self._items = [None] * len(self._items)
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return sum(item is not None for item in self._items)
+
+
+class LRUCache(ItemCache):
+    def __init__(self, max_bytes: int):
+        """
+        Creates a cache evicting the least recently used items as soon as its items exceed the byte budget.
+
+        Parameters
+        ----------
+        max_bytes
+            The maximum number of bytes of the cached tensors, items larger than that aren't cached
+        """
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._nbytes = 0
+
+    def _get(self, index):
+        item = self._items.get(index)
+        if item is not None:
+            self._items.move_to_end(index)
+        return item
+
+    def put(self, index, item):
+        self._remove(index)
+        nbytes = get_item_nbytes(item)
+        if nbytes > self.max_bytes:
+            self._evicted(index, item)
+            return
+        self._items[index] = item
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            evicted_index, evicted_item = self._items.popitem(last=False)
+            self._nbytes -= get_item_nbytes(evicted_item)
+            self._evicted(evicted_index, evicted_item)
+
+    def _remove(self, index):
+        item = self._items.pop(index, None)
+        if item is not None:
+            self._nbytes -= get_item_nbytes(item)
+
+    def _evicted(self, index, item):
+        self.evictions += 1
+
+    def apply(self, function):
+        for index, item in self._items.items():
+            self._items[index] = function(item)
+
+    def clear(self):
+        self._items.clear()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SpillingLRUCache(LRUCache):
+    def __init__(self, max_bytes: int, path: Optional[str] = None):
+        """
+        Creates a LRU cache with a byte budget, which writes evicted items to disk instead of dropping them.
+
+        Spilled items are appended to a single file and read back as memory-mapped tensors (on the CPU)
+        without counting against the budget, so repeated epochs read them from the page cache
+        instead of computing them again.
+
+        Parameters
+        ----------
+        max_bytes
+            The maximum number of bytes of the items held in memory
+        path
+            The directory of the spill file, by default a temporary directory removed with the cache
+        """
+        super().__init__(max_bytes)
+        if path is None:
+            path = tempfile.mkdtemp(prefix="dfibert-spill-")
+            weakref.finalize(self, shutil.rmtree, path, True)
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.spill_hits = 0
+        self._spill_file = self._get_spill_file()
+        self._spill_size = 0
+        # (file, offset, dtype, shape) of every tensor of the spilled items by their index
+        self._spilled = {}
+
+    def _get_spill_file(self) -> str:
+        # every process (e.g. DataLoader worker) appends to a file of its own
+        return os.path.join(self.path, "items-{}-{}.raw".format(os.getpid(), id(self)))
+
+    def _get(self, index):
+        item = super()._get(index)
+        if item is None and index in self._spilled:
+            self.spill_hits += 1
+            item = tuple(torch.from_numpy(_read_tensor(*description)) for description in self._spilled[index])
+        return item
+
+    def put(self, index, item):
+        self._spilled.pop(index, None)
+        super().put(index, item)
+
+    def _evicted(self, index, item):
+        super()._evicted(index, item)
+        descriptions = []
+        with open(self._spill_file, 'ab') as spill_file:
+            for tensor in item:
+                array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+                descriptions.append((self._spill_file, self._spill_size, array.dtype, array.shape))
+                array.tofile(spill_file)
+                self._spill_size += array.nbytes
+        self._spilled[index] = descriptions
+
+    def clear(self):
+        super().clear()
+        self._spilled.clear()
+        if os.path.isfile(self._spill_file):
+            os.remove(self._spill_file)
+        self._spill_size = 0
+
+    def __setstate__(self, state):
+        # items spilled before pickling stay readable, new ones are written to a file of this copy
+        self.__dict__.update(state)
+        self._spill_file = self._get_spill_file()
+        self._spill_size = 0
+
+    @property
+    def spilled_bytes(self) -> int:
+        """The number of bytes written to the spill file."""
+        return self._spill_size
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(spill_hits=self.spill_hits, spilled_items=len(self._spilled), spilled_bytes=self._spill_size)
+        return stats
+
+    def __len__(self):
+        return super().__len__() + len(self._spilled)
+
+
+def _read_tensor(file: str, offset: int, dtype: np.dtype, shape: tuple) -> np.ndarray:
+    if int(np.prod(shape, dtype=int)) == 0:  # empty arrays can't be mapped
+        return np.empty(shape, dtype=dtype)
+    # copy-on-write, so the tensor is writeable without modifying the file
+    return np.memmap(file, dtype=dtype, mode='c', offset=offset, shape=shape)
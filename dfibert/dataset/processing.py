@@ -34,8 +34,18 @@ class Processing:
 
     The methods can work together, but they do not have to. 
     The existence of both must be guaranteed to be able to use every dataset.
+
+    `calculate_streamlines(data_container, streamlines)` calculates the tuples of many streamlines at once,
+    override it if the processing can be vectorized over streamlines.
+
+    If the input of a reversed streamline is the input of the streamline in reverse order, set `reversible_input`
+    and implement `calculate_output(data_container, streamline)`. Datasets then derive the items of reversed
+    streamlines from the items of the streamlines instead of interpolating the DWI again.
     """
 
+    # True if the input of a reversed streamline is the input of the streamline in reverse order
+    reversible_input = False
+
     # TODO - Live Calculation for Tracker
     def calculate_streamline(self, data_container, streamline):
         """Calculates the (input, output) tuple for a whole streamline.
@@ -60,6 +70,40 @@ class Processing:
         """
         raise NotImplementedError
 
+    def calculate_streamlines(self, data_container, streamlines):
+        """Calculates the (input, output) tuples for a list of streamlines.
+
+        Arguments
+        ---------
+        data_container : DataContainer
+            The DataContainer the streamlines are associated with
+        streamlines: list
+            The streamlines the input and output data should be calculated for
+
+        Returns
+        -------
+        list
+            The (input, output) data for every streamline.
+        """
+        return [self.calculate_streamline(data_container, streamline) for streamline in streamlines]
+
+    def calculate_output(self, data_container, streamline):
+        """Calculates only the output of the (input, output) tuple for a whole streamline.
+
+        Arguments
+        ---------
+        data_container : DataContainer
+            The DataContainer the streamline is associated with
+        streamline: Tensor
+            The streamline the output data should be calculated for
+
+        Returns
+        -------
+        numpy.ndarray
+            The output data for the requested item.
+        """
+        return self.calculate_streamline(data_container, streamline)[1]
+
     def calculate_item(self, data_container : DataContainer, previous_sl, next_dir):
         """Calculates the (input, output) tuple for a single streamline point.
 
@@ -105,6 +149,8 @@ class RegressionProcessing(Processing):
     -------
     calculate_streamline(data_container, streamline)
         Calculates the (input, output) tuple for a complete streamline
+    calculate_streamlines(data_container, streamlines)
+        Calculates the (input, output) tuples for many streamlines in a few vectorized calls
     calculate_item(data_container, point, next_direction)
         Calculates the (input, output) tuple for a single streamline point
 
@@ -161,6 +207,11 @@ class RegressionProcessing(Processing):
                                                                                              grid_spacing,
                                                                                              postprocessing.id)
 
+    @property
+    def reversible_input(self):
+        # without rotation, the grid of every point doesn't depend on the direction of the streamline
+        return not self.options.rotate
+
     def calculate_item(self, data_container, previous_sl, next_dir):
         """Calculates the (input, output) tuple for the last streamline point.
 
@@ -185,11 +236,8 @@ class RegressionProcessing(Processing):
 
         next_dir = next_dirs[-1]
         rot_matrix = None if rot_matrix is None else rot_matrix[np.newaxis, -1]
-        dwi, _ = self._get_dwi(data_container, previous_sl[np.newaxis, -1], rot_matrix=rot_matrix)
-        if self.options.postprocessing is not None:
-            dwi = self.options.postprocessing(dwi, data_container.b0,
-                                              data_container.bvecs,
-                                              data_container.bvals)
+        dwi, _ = self._get_dwi(data_container, previous_sl[np.newaxis, -1], rot_matrix=rot_matrix,
+                               postprocessing=self.options.postprocessing)
         dwi = dwi.squeeze(axis=0)
         if self.options.normalize:
             next_dir = (next_dir - self.options.normalize_mean) / self.options.normalize_std
@@ -215,34 +263,95 @@ class RegressionProcessing(Processing):
         next_dir, rot_matrix = self._apply_rot_matrix(next_dir)
         dwi, _ = self._get_dwi(data_container, streamline, rot_matrix=rot_matrix,
                                postprocessing=self.options.postprocessing)
-        if self.options.postprocessing is not None:
-            dwi = self.options.postprocessing(dwi, data_container.b0,
-                                              data_container.bvecs,
-                                              data_container.bvals)
         if self.options.normalize:
             next_dir = (next_dir - self.options.normalize_mean) / self.options.normalize_std
         return (dwi, next_dir)
 
+    def calculate_streamlines(self, data_container, streamlines):
+        """Calculates the (input, output) tuples for a list of streamlines.
+
+        The points of all streamlines are concatenated, so the directions, rotations, grid points and
+        the interpolation are computed once for all streamlines instead of once per streamline.
+        The results are equal to those of `calculate_streamline`.
+
+        Arguments
+        ---------
+        data_container : DataContainer
+            The DataContainer the streamlines are associated with
+        streamlines: list
+            The streamlines the input and output data should be calculated for
+
+        Returns
+        -------
+        list
+            The (input, output) data for every streamline.
+        """
+        if len(streamlines) == 0:
+            return []
+        starts = np.cumsum([0] + [len(streamline) for streamline in streamlines])[:-1]
+        points = np.concatenate(streamlines)
+        next_dir = self._get_next_direction(points, starts)
+        next_dir, rot_matrix = self._apply_rot_matrix(next_dir, starts)
+        dwi, _ = self._get_dwi(data_container, points, rot_matrix=rot_matrix,
+                               postprocessing=self.options.postprocessing)
+        if self.options.normalize:
+            next_dir = (next_dir - self.options.normalize_mean) / self.options.normalize_std
+        return list(zip(np.split(dwi, starts[1:]), np.split(next_dir, starts[1:])))
+
+    def calculate_output(self, data_container, streamline):
+        """Calculates only the (rotated and normalized) next directions of a whole streamline.
+
+        Arguments
+        ---------
+        data_container : DataContainer
+            The DataContainer the streamline is associated with
+        streamline: Tensor
+            The streamline the output data should be calculated for
+
+        Returns
+        -------
+        numpy.ndarray
+            The output data for the requested item.
+        """
+        next_dir = self._get_next_direction(streamline)
+        next_dir, _ = self._apply_rot_matrix(next_dir)
+        if self.options.normalize:
+            next_dir = (next_dir - self.options.normalize_mean) / self.options.normalize_std
+        return next_dir
+
     def _get_dwi(self, data_container, streamline, rot_matrix=None, postprocessing=None):
         points = self._get_grid_points(streamline, rot_matrix=rot_matrix)
         dwi = data_container.get_interpolated_dwi(points, postprocessing=postprocessing)
         return dwi, points
 
-    def _get_next_direction(self, streamline):
-        next_dir = streamline[1:] - streamline[:-1]
+    def _get_next_direction(self, streamline, starts=(0,)):
+        # the points of multiple streamlines can be concatenated, starting at the given indices
+        last = np.zeros(len(streamline), dtype=bool)
+        last[np.asarray(starts)[1:] - 1] = True
+        last[-1] = True
+        inner = np.flatnonzero(~last)
+        next_dir = streamline[inner + 1] - streamline[inner]
         next_dir = next_dir / np.linalg.norm(next_dir, axis=1)[:, None]
-        next_dir = np.concatenate((next_dir, np.array([[0, 0, 0]])))
-        return next_dir
+        # the last direction of every streamline is zero
+        directions = np.zeros((len(streamline), 3), dtype=np.result_type(next_dir, np.int64))
+        directions[inner] = next_dir
+        return directions
 
-    def _apply_rot_matrix(self, next_dir):
+    def _apply_rot_matrix(self, next_dir, starts=(0,)):
         if not self.options.rotate:
             return next_dir, None
         reference = get_reference_orientation()
         rot_matrix = np.empty([len(next_dir), 3, 3])
         # rot_mat (N, 3, 3)
         # next dir (N, 3)
-        rot_matrix[0] = np.eye(3)
-        rotation_from_vectors_p(rot_matrix[1:, :, :], reference[None, :], next_dir[:-1])
+        # the first point of every streamline isn't rotated, the others are rotated along the previous direction
+        rot_matrix[np.asarray(starts)] = np.eye(3)
+        rotated = np.ones(len(next_dir), dtype=bool)
+        rotated[np.asarray(starts)] = False
+        rotated = np.flatnonzero(rotated)
+        rotations = np.empty([len(rotated), 3, 3])
+        rotation_from_vectors_p(rotations, reference[None, :], next_dir[rotated - 1])
+        rot_matrix[rotated] = rotations
 
         rot_next_dir = (rot_matrix.transpose((0, 2, 1)) @ next_dir[:, :, None]).squeeze(2)
         return rot_next_dir, rot_matrix
@@ -275,6 +384,8 @@ class ClassificationProcessing(RegressionProcessing):
     -------
     calculate_streamline(data_container, streamline)
         Calculates the (input, output) tuple for a complete streamline
+    calculate_streamlines(data_container, streamlines)
+        Calculates the (input, output) tuples for many streamlines in a few vectorized calls
     calculate_item(data_container, point, next_direction)
         Calculates the (input, output) tuple for a single streamline point
     """
@@ -333,6 +444,42 @@ class ClassificationProcessing(RegressionProcessing):
         classification_output = direction_to_classification(self.sphere, next_dir, include_stop=True, last_is_stop=True)
         return dwi, classification_output
 
+    def calculate_streamlines(self, data_container, streamlines):
+        """Calculates the classification (input, output) tuples for a list of streamlines.
+
+        Arguments
+        ---------
+        data_container : DataContainer
+            The DataContainer the streamlines are associated with
+        streamlines: list
+            The streamlines the input and output data should be calculated for
+
+        Returns
+        -------
+        list
+            The (input, output) data for every streamline.
+        """
+        return [(dwi, direction_to_classification(self.sphere, next_dir, include_stop=True, last_is_stop=True))
+                for dwi, next_dir in RegressionProcessing.calculate_streamlines(self, data_container, streamlines)]
+
+    def calculate_output(self, data_container, streamline):
+        """Calculates only the classification output of a whole streamline.
+
+        Arguments
+        ---------
+        data_container : DataContainer
+            The DataContainer the streamline is associated with
+        streamline: Tensor
+            The streamline the output data should be calculated for
+
+        Returns
+        -------
+        numpy.ndarray
+            The output data for the requested item.
+        """
+        next_dir = RegressionProcessing.calculate_output(self, data_container, streamline)
+        return direction_to_classification(self.sphere, next_dir, include_stop=True, last_is_stop=True)
+
     def calculate_item(self, data_container, previous_sl, next_dir):
         """Calculates the classification (input, output) tuple for the last streamline point.
 
@@ -350,7 +497,7 @@ class ClassificationProcessing(RegressionProcessing):
         tuple
             The (input, output) data for the requested item.
         """
-        dwi, next_dir = RegressionProcessing.calculate_item(data_container, previous_sl, next_dir)
+        dwi, next_dir = RegressionProcessing.calculate_item(self, data_container, previous_sl, next_dir)
         classification_output = direction_to_classification(self.sphere, next_dir[None, ...], include_stop=True,
                                                             last_is_stop=True).squeeze(axis=0)
         return dwi, classification_output
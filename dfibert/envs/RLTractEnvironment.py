@@ -3,7 +3,6 @@ import os
 import gym
 import numpy as np
 import torch
-import dipy.reconst.dti as dti
 from dipy.core.interpolation import trilinear_interpolate4d
 from dipy.core.sphere import HemiSphere, Sphere
 from dipy.core.sphere import disperse_charges
@@ -15,10 +14,10 @@ from dipy.reconst.csdeconv import (mask_for_response_ssst,
 from dipy.reconst.shm import order_from_ncoef, sph_harm_lookup
 from dipy.tracking import utils
 from gym.spaces import Discrete, Box
-from scipy.interpolate import RegularGridInterpolator
 from tqdm import trange
 
 from dfibert.data import DataPreprocessor, PointOutsideOfDWIError
+from dfibert.data.interpolation import TrilinearInterpolator
 from dfibert.data.postprocessing import Resample
 from dfibert.util import get_grid
 from ._state import TractographyState
@@ -30,7 +29,8 @@ from .neuroanatomical_utils import FiberBundleDataset, interpolate3dAt
 class RLTractEnvironment(gym.Env):
     def __init__(self, device, seeds=None, step_width=0.8, dataset='100307', grid_dim=(3, 3, 3),
                  max_l2_dist_to_state=0.1, tracking_in_RAS=True, fa_threshold=0.1, b_val=1000, 
-                 odf_state=True, odf_mode="CSD", action_space=100, pFolderBundles = "data/gt_bundles/"):
+                 odf_state=True, odf_mode="CSD", action_space=100, pFolderBundles = "data/gt_bundles/",
+                 cache=None, odf_dtype=np.float32, tracking_mask=False):
         self.state_history = None
         self.reference_seed_point_ijk = None
         self.points_visited = None
@@ -48,9 +48,9 @@ class RLTractEnvironment(gym.Env):
         self.device = device
         preprocessor = DataPreprocessor().normalize().crop(b_val).fa_estimate()
         if dataset == 'ISMRM':
-            self.dataset = preprocessor.get_ismrm(f"data/ISMRM2015/")
+            self.dataset = preprocessor.get_ismrm(f"data/ISMRM2015/", cache=cache, load_t1=False)
         else:
-            self.dataset = preprocessor.get_hcp(f"data/HCP/{dataset}/")
+            self.dataset = preprocessor.get_hcp(f"data/HCP/{dataset}/", cache=cache, load_t1=False)
 
         self.step_width = step_width
         self.dtype = torch.FloatTensor  # vs. torch.cuda.FloatTensor
@@ -59,6 +59,10 @@ class RLTractEnvironment(gym.Env):
         self.odf_interpolator = None
         self.sh_coefficient = None
         self.odf_mode = odf_mode
+        self.odf_dtype = odf_dtype  # e.g. np.float16 to halve the memory of the ODF volume
+        # if True, tracking stops outside of the precomputed mask of brain voxels above the FA threshold,
+        # tested at the nearest voxel (see DataContainer.continue_tracking) instead of the trilinear FA
+        self.tracking_mask = tracking_mask
 
         np.random.seed(42)
         action_space = action_space 
@@ -96,10 +100,8 @@ class RLTractEnvironment(gym.Env):
             if self.dti_fit is None:
                 self._init_odf()
 
-            dti_model = dti.TensorModel(self.dataset.gtab, fit_method='LS')
-            dti_fit = dti_model.fit(self.dataset.dwi, mask=self.dataset.binary_mask)
-
-            fa_img = dti_fit.fa
+            # the FA of the tensor fit done during preprocessing
+            fa_img = self.dataset.fa
             seed_mask = fa_img.copy()
             seed_mask[seed_mask >= 0.2] = 1
             seed_mask[seed_mask < 0.2] = 0
@@ -127,27 +129,24 @@ class RLTractEnvironment(gym.Env):
         # fit DTI model to data
         if self.odf_mode == "DTI":
             print("DTI-based ODF computation")
-            self.dti_model = dti.TensorModel(self.dataset.gtab, fit_method='LS')
-            self.dti_fit = self.dti_model.fit(self.dataset.dwi, mask=self.dataset.binary_mask)
+            self.dti_fit = self.dataset.get_tensor_fit()
+            self.dti_model = self.dti_fit.model
             # compute ODF
             odf = self.dti_fit.odf(self.sphere_odf)
         elif self.odf_mode == "CSD":
             print("CSD-based ODF computation")
-            mask = mask_for_response_ssst(self.dataset.gtab, self.dataset.dwi, roi_radii=10, fa_thr=0.7)
+            dwi = self.dataset.get_dwi()
+            mask = mask_for_response_ssst(self.dataset.gtab, dwi, roi_radii=10, fa_thr=0.7)
             num_voxels = np.sum(mask)
             print(num_voxels)
-            response, ratio = response_from_mask_ssst(self.dataset.gtab, self.dataset.dwi, mask)
+            response, ratio = response_from_mask_ssst(self.dataset.gtab, dwi, mask)
             print(response)
             self.dti_model = ConstrainedSphericalDeconvModel(self.dataset.gtab, response)
-            self.dti_fit = self.dti_model.fit(self.dataset.dwi)
+            self.dti_fit = self.dti_model.fit(dwi)
             odf = self.dti_fit.odf(self.sphere_odf)
 
-        # -- set up interpolator for odf evaluation
-        x_range = np.arange(odf.shape[0])
-        y_range = np.arange(odf.shape[1])
-        z_range = np.arange(odf.shape[2])
-
-        self.odf_interpolator = RegularGridInterpolator((x_range, y_range, z_range), odf)
+        # -- set up interpolator for odf evaluation, only the gathered voxels are upcast to single precision
+        self.odf_interpolator = TrilinearInterpolator(np.ascontiguousarray(odf, dtype=self.odf_dtype))
 
         # print("Computing pmf")
         # self.pmf = odf.clip(min=0)
@@ -188,13 +187,15 @@ class RLTractEnvironment(gym.Env):
         if self.stepCounter >= self.maxSteps:
             return self.get_observation_from_state(self.state), 0., True, {}
 
+        coordinate = self.state.getCoordinate().view(-1, 3)
+        if self.tracking_mask:
+            # II. fa below threshold or III. leaving brain mask? stop tracking
+            # (a single gather in the precomputed tracking mask, on the device of the state)
+            if not bool(self.dataset.continue_tracking(coordinate, self.fa_threshold).all()):
+                return self.get_observation_from_state(self.state), 0., True, {}
         # II. fa below threshold? stop tracking
-        if self.dataset.get_fa(self.state.getCoordinate().cpu()) < self.fa_threshold:
+        elif bool((self.dataset.get_fa(coordinate, mode="trilinear") < self.fa_threshold).any()):
             return self.get_observation_from_state(self.state), 0., True, {}
-        
-        #@todo: III. leaving brain mask
-        #if self.dataset.get_fa(self.state.getCoordinate()) < self.fa_threshold:
-        #    return self.get_observation_from_state(self.state), 0., True, {}
 
         # -- Tracking --
         cur_tangent = self.directions[action].view(-1, 3) # action space = Hemisphere
@@ -437,7 +438,7 @@ class RLTractEnvironment(gym.Env):
         print("Initialising spherical harmonics")
         self.dti_model = dti.TensorModel(self.dataset.gtab, fit_method='LS')
 
-        peaks = peaks_from_model(model=self.dti_model, data=self.dataset.dwi, sphere=self.sphere,
+        peaks = peaks_from_model(model=self.dti_model, data=self.dataset.get_dwi(), sphere=self.sphere,
                                  relative_peak_threshold=.2, min_separation_angle=25, mask=self.dataset.binary_mask,
                                  npeaks=2)
 
@@ -61,18 +61,19 @@ def get_csd_streamlines(data_container, random_seeds=False, seeds_count=30000, s
     """
     seeds = _get_seeds(data_container, random_seeds, seeds_count, seeds_per_voxel)
 
-    response, _ = auto_response_ssst(data_container.gtab, data_container.dwi, roi_radii=roi_r, fa_thr=auto_response_fa_threshold)
+    dwi = data_container.get_dwi()
+    response, _ = auto_response_ssst(data_container.gtab, dwi, roi_radii=roi_r, fa_thr=auto_response_fa_threshold)
     csd_model = ConstrainedSphericalDeconvModel(data_container.gtab, response)
 
     direction_getter = peaks_from_model(model=csd_model,
-                                        data=data_container.dwi,
+                                        data=dwi,
                                         sphere=get_sphere('symmetric724'),
                                         mask=data_container.binary_mask,
                                         relative_peak_threshold=relative_peak_threshold,
                                         min_separation_angle=min_separation_angle,
                                         parallel=False)
 
-    dti_fit = dti.TensorModel(data_container.gtab, fit_method='LS').fit(data_container.dwi, mask=data_container.binary_mask)
+    dti_fit = dti.TensorModel(data_container.gtab, fit_method='LS').fit(dwi, mask=data_container.binary_mask)
     classifier = ThresholdStoppingCriterion(dti_fit.fa, fa_threshold)
 
     streamlines_generator = LocalTracking(direction_getter, classifier, seeds, data_container.aff, step_size=step_width)
@@ -109,7 +110,7 @@ def get_dti_streamlines(data_container, random_seeds=False, seeds_count=30000, s
     """
     seeds = _get_seeds(data_container, random_seeds, seeds_count, seeds_per_voxel)
 
-    dti_fit = TensorModel(data_container.gtab).fit(data_container.dwi, mask=data_container.binary_mask)
+    dti_fit = TensorModel(data_container.gtab).fit(data_container.get_dwi(), mask=data_container.binary_mask)
     dti_fit_odf = dti_fit.odf(sphere=default_sphere)
 
     direction_getter = DeterministicMaximumDirectionGetter.from_pmf(dti_fit_odf,
@@ -0,0 +1,46 @@
+"""Compares `RegressionProcessing.calculate_streamline` per streamline with `calculate_streamlines` in chunks.
+
+Generates the rotated 3x3x3 grid inputs for random streamlines of different lengths in a synthetic subject,
+as done while generating a `StreamlineDataset`, and reports the time per epoch.
+
+Usage: python batched_streamlines.py [chunk_size]
+"""
+import os
+import sys
+import time
+
+from dfibert.data.postprocessing import Raw
+from dfibert.dataset.processing import RegressionProcessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import quantization  # noqa: E402
+
+NO_STREAMLINES = 2000
+
+
+def main():
+    """Main method"""
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    quantization.NO_STREAMLINES = NO_STREAMLINES
+    data_container = quantization._create_data_container()
+    processing = RegressionProcessing(postprocessing=Raw())
+    data_container.get_postprocessed_volume(processing.options.postprocessing)
+    for length in (10, 30, 100):
+        quantization.STREAMLINE_LENGTH = length
+        streamlines = list(quantization._get_streamlines())
+
+        start = time.perf_counter()
+        for streamline in streamlines:
+            processing.calculate_streamline(data_container, streamline)
+        single_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for chunk in range(0, len(streamlines), chunk_size):
+            processing.calculate_streamlines(data_container, streamlines[chunk:chunk + chunk_size])
+        batched_time = time.perf_counter() - start
+        print("{:4d} points | per streamline {:6.2f}s | chunks of {} {:6.2f}s | speedup {:4.1f}x"
+              .format(length, single_time, chunk_size, batched_time, single_time / batched_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compares the linear (X, Y, Z, C) layout with the bricked layout of `DataPreprocessor.brick`.
+
+Interpolates random volumes with different numbers of channels, e.g. 1 for the FA, 16 for int16
+features or 100 for Resample100, with two access patterns: points spread uniformly over the volume
+and points along random straight streamlines. Both single points and 3x3x3 grids around the points
+(as used by `RegressionProcessing`) are timed, the best of several runs is reported.
+
+Usage: python bricked_layout.py [brick size]
+"""
+import sys
+import time
+
+import numpy as np
+
+from dfibert.data.interpolation import TrilinearInterpolator, to_bricks
+
+SHAPE = (128, 144, 112)
+CHANNELS = (1, 16, 100)
+NO_POINTS = 200000
+STREAMLINE_LENGTH = 100
+REPEATS = 3
+
+
+def _get_points(rng):
+    uniform = 1 + rng.random((NO_POINTS, 3)) * (np.array(SHAPE) - 3)
+    no_streamlines = NO_POINTS // STREAMLINE_LENGTH
+    seeds = 10 + rng.random((no_streamlines, 3)) * (np.array(SHAPE) - 20)
+    directions = rng.normal(size=(no_streamlines, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    steps = 0.5 * np.arange(STREAMLINE_LENGTH)[None, :, None] * directions[:, None, :]
+    streamlines = np.clip(seeds[:, None, :] + steps, 1, np.array(SHAPE) - 2.001).reshape(-1, 3)
+    return {"random": uniform, "streamline": streamlines}
+
+
+def _time(function):
+    function()  # warm up
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    """Main method"""
+    brick_size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rng = np.random.default_rng(0)
+    patterns = _get_points(rng)
+    grid = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing='ij'), axis=-1)
+    for no_channels in CHANNELS:
+        values = rng.random((*SHAPE, no_channels), dtype=np.float32)
+        layouts = [("linear", TrilinearInterpolator(values)),
+                   ("bricked", TrilinearInterpolator(to_bricks(values, brick_size), grid_shape=SHAPE))]
+        for pattern, points in patterns.items():
+            for name, interpolator in layouts:
+                point_time = _time(lambda: interpolator(points))
+                grid_time = _time(lambda: interpolator.interpolate_grid(points[:NO_POINTS // 8], grid))
+                print("C={:3d} {:10s} {:7s} points {:6.3f}s | 3x3x3 grids {:6.3f}s"
+                      .format(no_channels, pattern, name, point_time, grid_time))
+        del values, layouts
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compares denoising a synthetic phantom at once with the tiled Local PCA denoiser of `DataPreprocessor.denoise`.
+
+Every mode is measured in a fresh process (Linux only). Reports the wall-clock time,
+the growth of the peak RSS relative to the size of the raw DWI, and the maximum deviation
+from denoising the whole volume at once.
+
+Afterwards, dipy's `pca_noise_estimate` is compared with the slab-wise noise estimate of the denoiser
+on a phantom elongated along x, reporting the peak of the arrays allocated (traced by `tracemalloc`,
+as freed memory isn't always returned to the OS) relative to the size of the raw DWI.
+
+Usage: python denoising.py [tile_size] [workers]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from dipy.core.gradients import gradient_table
+from dipy.denoise.localpca import localpca
+from dipy.denoise.pca_noise_estimate import pca_noise_estimate
+
+from dfibert.data import DataContainer, DataPreprocessor, _estimate_noise
+
+SHAPE = (48, 48, 32)
+NOISE_ESTIMATE_SHAPE = (192, 48, 32)
+BVALS = np.array([5.0] * 6 + [1000.0] * 40)
+PATCH_RADIUS = 2
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _create_data_container(shape=SHAPE):
+    rng = np.random.default_rng(42)
+    bvecs = rng.normal(size=(len(BVALS), 3))
+    bvecs = bvecs / np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[BVALS < 10] = 0
+    # a single fibre population along x with Gaussian noise
+    tensor = np.diag([1.7e-3, 0.3e-3, 0.3e-3])
+    signal = 1000 * np.exp(-BVALS * np.einsum('ni,ij,nj->n', bvecs, tensor, bvecs))
+    dwi = (signal + rng.normal(scale=30, size=(*shape, len(BVALS)))).astype(np.float32)
+    mask = np.ones(shape, dtype=np.uint8)
+    return DataContainer(BVALS, bvecs, gradient_table(BVALS, bvecs), mask, dwi, np.eye(4), mask,
+                         dwi[..., BVALS < 10].mean(axis=-1), None)
+
+
+def _measure(mode, tile_size, workers, queue):
+    data_container = _create_data_container()
+    before = _current_rss()
+    start = time.perf_counter()
+    if mode == "at once":
+        sigma = pca_noise_estimate(data_container.dwi, data_container.gtab, correct_bias=True, smooth=3)
+        dwi = localpca(data_container.dwi, sigma=sigma, patch_radius=PATCH_RADIUS)
+    else:
+        preprocessor = DataPreprocessor().denoise(patch_radius=PATCH_RADIUS, tile_size=tile_size, workers=workers)
+        dwi = preprocessor.preprocess(data_container).dwi
+    queue.put((time.perf_counter() - start, _peak_rss() - before, data_container.dwi.nbytes, dwi))
+
+
+def _run(mode, tile_size=None, workers=None):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(mode, tile_size, workers, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _traced_peak(function):
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak
+
+
+def _compare_noise_estimates(slab_size):
+    data_container = _create_data_container(NOISE_ESTIMATE_SHAPE)
+    dwi_bytes = data_container.dwi.nbytes
+    reference, reference_peak = _traced_peak(
+        lambda: pca_noise_estimate(data_container.dwi, data_container.gtab, correct_bias=True, smooth=3))
+    print("noise estimate {}, pca_noise_estimate   | peak allocations {:.2f}x raw DWI"
+          .format(NOISE_ESTIMATE_SHAPE, reference_peak / dwi_bytes))
+    sigma, peak = _traced_peak(lambda: _estimate_noise(data_container.dwi, data_container.gtab, 3, slab_size))
+    print("noise estimate {}, slabs of {:3d}      | peak allocations {:.2f}x raw DWI | max rel. deviation {:.1e}"
+          .format(NOISE_ESTIMATE_SHAPE, slab_size, peak / dwi_bytes,
+                  np.abs(sigma - reference).max() / reference.max()))
+
+
+def main():
+    """Main method"""
+    tile_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    reference_time, reference_rss, dwi_bytes, reference = _run("at once")
+    print("at once                 {:7.2f}s | peak RSS growth {:.2f}x raw DWI"
+          .format(reference_time, reference_rss / dwi_bytes))
+    for mode_workers in sorted({1, workers}):
+        tiled_time, tiled_rss, _, dwi = _run("tiled", tile_size, mode_workers)
+        print("tiled {:3d}^3, {:2d} workers {:7.2f}s | peak RSS growth {:.2f}x raw DWI | max deviation {:.1e}"
+              .format(tile_size, mode_workers, tiled_time, tiled_rss / dwi_bytes, np.abs(dwi - reference).max()))
+    _compare_noise_estimates(tile_size)
+
+
+if __name__ == "__main__":
+    main()
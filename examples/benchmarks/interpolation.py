@@ -0,0 +1,64 @@
+"""Compares the RegularGridInterpolator with the TrilinearInterpolator of the DataContainer.
+
+Interpolates a synthetic DWI volume at 1e6 random points,
+and on unrotated 3x3x3 grids around random centres with the shared-weight grid path.
+
+Usage: python interpolation.py [no_channels]
+"""
+import sys
+import time
+
+import numpy as np
+import torch
+from scipy.interpolate import RegularGridInterpolator
+
+from dfibert.data.interpolation import TrilinearInterpolator
+from dfibert.util import get_grid
+
+SHAPE = (96, 96, 64)
+NO_POINTS = 1000000
+NO_GRIDS = NO_POINTS // 27
+
+
+def _time(function, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    """Main method"""
+    no_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    rng = np.random.default_rng(42)
+    dwi = rng.random((*SHAPE, no_channels), dtype=np.float32)
+    points = rng.random((NO_POINTS, 3)) * (np.array(SHAPE) - 1)
+
+    grid = tuple(np.arange(size) for size in SHAPE)
+    scipy_time, reference = _time(lambda: RegularGridInterpolator(grid, dwi)(points), repeat=1)
+    print("RegularGridInterpolator      {:7.3f}s".format(scipy_time))
+
+    interpolator = TrilinearInterpolator(dwi)
+    numpy_time, result = _time(lambda: interpolator(points))
+    print("TrilinearInterpolator numpy  {:7.3f}s  speedup {:5.1f}x  max error {:.2e}"
+          .format(numpy_time, scipy_time / numpy_time, np.abs(result - reference).max()))
+
+    torch_points = torch.from_numpy(points)
+    torch_time, result = _time(lambda: interpolator(torch_points))
+    print("TrilinearInterpolator torch  {:7.3f}s  speedup {:5.1f}x  max error {:.2e}"
+          .format(torch_time, scipy_time / torch_time, np.abs(result.numpy() - reference).max()))
+
+    offsets = get_grid(np.array([3, 3, 3])).astype(int)
+    origins = 1 + rng.random((NO_GRIDS, 3)) * (np.array(SHAPE) - 3)
+    grid_points = origins[:, None, None, None, :] + offsets
+    point_time, reference = _time(lambda: interpolator(grid_points))
+    print("3x3x3 grids, per point       {:7.3f}s".format(point_time))
+    grid_time, result = _time(lambda: interpolator.interpolate_grid(origins, offsets))
+    print("3x3x3 grids, shared weights  {:7.3f}s  speedup {:5.1f}x  max error {:.2e}"
+          .format(grid_time, point_time / grid_time, np.abs(result - reference).max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Reports the load time and peak RSS of a single-shell chain on a synthetic three-shell HCP subject.
+
+Compares loading all volumes and cropping afterwards with the crop pushed down into loading,
+where only the b=1000 and b0 volumes are read. Every mode is measured in a fresh process (Linux only).
+
+Usage: python loading.py [directory]
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import nibabel as nb
+import numpy as np
+
+from dfibert.data import DataPreprocessor
+
+SHAPE = (96, 96, 64)
+BVALS = np.array([5.0] * 18 + [1000.0] * 90 + [2000.0] * 90 + [3000.0] * 90)
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _create_subject(path):
+    rng = np.random.default_rng(42)
+    bvecs = rng.normal(size=(len(BVALS), 3))
+    bvecs = bvecs / np.linalg.norm(bvecs, axis=1)[:, None]
+    np.savetxt(os.path.join(path, "bvals"), BVALS[None], fmt="%d")
+    np.savetxt(os.path.join(path, "bvecs"), bvecs.T)
+    aff = np.diag([1.25, 1.25, 1.25, 1])
+    dwi = rng.integers(100, 1000, size=(*SHAPE, len(BVALS)), dtype=np.int16)
+    nb.save(nb.Nifti1Image(dwi, aff), os.path.join(path, "data.nii.gz"))
+    nb.save(nb.Nifti1Image(np.ones(SHAPE, dtype=np.float32), aff),
+            os.path.join(path, "T1w_acpc_dc_restore_1.25.nii.gz"))
+    nb.save(nb.Nifti1Image(np.ones(SHAPE, dtype=np.uint8), aff), os.path.join(path, "nodif_brain_mask.nii.gz"))
+
+
+def _measure(mode, path, queue):
+    before = _current_rss()
+    start = time.perf_counter()
+    if mode == "crop after load":
+        data_container = DataPreprocessor().get_hcp(path)
+        data_container = DataPreprocessor().normalize().crop().preprocess(data_container, inplace=True)
+    else:
+        data_container = DataPreprocessor().normalize().crop().get_hcp(path)
+    queue.put((time.perf_counter() - start, _peak_rss() - before, data_container.dwi.shape[-1]))
+
+
+def main():
+    """Main method"""
+    path = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+    os.makedirs(path, exist_ok=True)
+    if not os.path.isfile(os.path.join(path, "data.nii.gz")):
+        _create_subject(path)
+    for mode in ("crop after load", "crop pushed down"):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure, args=(mode, path, queue))
+        process.start()
+        load_time, rss, no_volumes = queue.get()
+        process.join()
+        print("{:16s} {:6.2f}s | peak RSS growth {:7.1f} MiB | {} volumes"
+              .format(mode, load_time, rss / 1024 ** 2, no_volumes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compares the dense DWI layout with the packed layout of `DataPreprocessor.pack_to_mask`.
+
+Uses a synthetic normalized subject with an ellipsoid brain mask covering about a third of the volume,
+similar to uncropped scans. Generates the rotated 3x3x3 grid inputs of `RegressionProcessing`
+for random streamlines inside of the mask, as done while generating a `StreamlineDataset`.
+Reports the memory of the DWI and Resample100 volumes, the time per epoch of inputs and the
+error against the dense layout.
+
+Usage: python masked_layout.py
+"""
+import time
+
+import numpy as np
+from dipy.core.gradients import gradient_table
+
+from dfibert.data import DataContainer, DataPreprocessor
+from dfibert.data.postprocessing import Resample100
+from dfibert.dataset.processing import RegressionProcessing
+
+SHAPE = (96, 96, 64)
+NO_STREAMLINES = 200
+STREAMLINE_LENGTH = 100
+
+
+def _create_data_container():
+    rng = np.random.default_rng(42)
+    bvals = np.concatenate((np.full(18, 5.), np.full(90, 1000.)))
+    bvecs = rng.normal(size=(len(bvals), 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[bvals < 10] = 0
+    # smooth tensor signal, normalized by the b0 value
+    direction = np.stack(np.meshgrid(*[np.linspace(0, np.pi, size) for size in SHAPE], indexing='ij'), -1)
+    direction = np.cos(direction)
+    direction /= np.linalg.norm(direction, axis=-1, keepdims=True)
+    signal = np.exp(-1000 * (0.3e-3 + 1.4e-3 * (direction.reshape(-1, 3) @ bvecs.T) ** 2))
+    signal[:, bvals < 10] = 1
+    dwi = (signal.reshape((*SHAPE, len(bvals))) * (0.95 + 0.05 * rng.random((*SHAPE, len(bvals))))).astype(np.float32)
+    # an ellipsoid mask with semi-axes of 43% of the volume
+    relative = np.stack(np.meshgrid(*[np.linspace(-1, 1, size) for size in SHAPE], indexing='ij'), -1)
+    mask = (np.sum((relative / 0.86) ** 2, axis=-1) <= 1).astype(np.uint8)
+    return DataContainer(bvals, bvecs, gradient_table(bvals, bvecs), None, dwi, np.eye(4), mask,
+                         np.ones(SHAPE, dtype=np.float32), None)
+
+
+def _get_streamlines():
+    rng = np.random.default_rng(0)
+    steps = rng.normal(size=(NO_STREAMLINES, 3))
+    steps /= np.linalg.norm(steps, axis=1)[:, None]
+    seeds = np.array(SHAPE) / 2 + (rng.random((NO_STREAMLINES, 3)) - 0.5) * np.array(SHAPE) * 0.4
+    bend = 0.1 * rng.normal(size=(NO_STREAMLINES, STREAMLINE_LENGTH, 3))
+    return seeds[:, None, :] + 0.1 * np.cumsum(steps[:, None, :] + bend, axis=1)
+
+
+def _generate(data_container, processing, streamlines):
+    start = time.perf_counter()
+    inputs = []
+    for streamline in streamlines:
+        next_dir = processing._get_next_direction(streamline)
+        _, rot_matrix = processing._apply_rot_matrix(next_dir)
+        inputs.append(processing._get_dwi(data_container, streamline, rot_matrix=rot_matrix,
+                                          postprocessing=processing.options.postprocessing)[0])
+    return time.perf_counter() - start, np.stack(inputs)
+
+
+def main():
+    """Main method"""
+    data_container = _create_data_container()
+    streamlines = _get_streamlines()
+    processing = RegressionProcessing(postprocessing=Resample100())
+    print("mask covers {:.0%} of the volume".format(np.mean(data_container.binary_mask)))
+    layouts = [("dense", DataPreprocessor()), ("packed", DataPreprocessor().pack_to_mask()),
+               ("packed+uint16", DataPreprocessor().pack_to_mask().quantize("uint16"))]
+    reference = None
+    for name, preprocessor in layouts:
+        preprocessed = preprocessor.preprocess(data_container)
+        start = time.perf_counter()
+        features = preprocessed.get_postprocessed_volume(processing.options.postprocessing)
+        feature_time = time.perf_counter() - start
+        index_size = 0 if preprocessed.dwi_index is None else preprocessed.dwi_index.nbytes
+        _generate(preprocessed, processing, streamlines[:5])  # warm up
+        epoch_time, inputs = _generate(preprocessed, processing, streamlines)
+        if reference is None:
+            reference = inputs
+        print("{:14s} DWI {:6.1f} MiB | Resample100 {:6.1f} MiB (computed in {:5.2f}s) | index {:4.1f} MiB | "
+              "epoch {:5.2f}s | max error {:.1e}"
+              .format(name, preprocessed.dwi.nbytes / 1024 ** 2, features.nbytes / 1024 ** 2, feature_time,
+                      index_size / 1024 ** 2, epoch_time, np.abs(inputs - reference).max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compares the online caching policies of `StreamlineDataset` over shuffled epochs.
+
+Generates the 3x3x3 grid inputs of `RegressionProcessing` for random streamlines (plus the reversed ones)
+in a synthetic subject and reports the time per epoch, the peak RSS growth and the cache counters of
+no caching, the unbounded cache, a LRU cache with a byte budget and a LRU cache spilling evicted items to disk.
+Every policy is measured in a fresh process (Linux only).
+
+Usage: python online_caching.py [budget in MiB]
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+from dfibert.data.postprocessing import Raw
+from dfibert.dataset import StreamlineDataset
+from dfibert.dataset.caching import LRUCache, SpillingLRUCache
+from dfibert.dataset.processing import RegressionProcessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from quantization import _create_data_container, _get_streamlines  # noqa: E402
+
+NO_EPOCHS = 3
+
+
+def _peak_rss():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+
+def _reset_peak_rss():
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+
+
+def _current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _measure(policy, budget, queue):
+    data_container = _create_data_container()
+    data_container.id = "synthetic"  # used in the id of the dataset
+    streamlines = _get_streamlines()
+    online_caching = {"none": False, "unbounded": True, "lru": LRUCache(budget),
+                      "spilling lru": SpillingLRUCache(budget)}[policy]
+    dataset = StreamlineDataset(streamlines, data_container, RegressionProcessing(postprocessing=Raw()),
+                                online_caching=online_caching)
+    # the feature volume is precomputed before, it is shared by all policies
+    data_container.get_postprocessed_volume(dataset.options.processing.options.postprocessing)
+    rng = np.random.default_rng(0)
+    _reset_peak_rss()
+    before = _current_rss()
+    epoch_times = []
+    for _ in range(NO_EPOCHS):
+        start = time.perf_counter()
+        for index in rng.permutation(len(dataset)):
+            dataset[index]
+        epoch_times.append(time.perf_counter() - start)
+    stats = dataset.cache.stats() if dataset.cache is not None else {}
+    queue.put((epoch_times, _peak_rss() - before, stats))
+
+
+def main():
+    """Main method"""
+    budget = int(sys.argv[1] if len(sys.argv) > 1 else 128) * 1024 ** 2
+    for policy in ("none", "unbounded", "lru", "spilling lru"):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure, args=(policy, budget, queue))
+        process.start()
+        epoch_times, rss, stats = queue.get()
+        process.join()
+        print("{:12s} epochs {} | peak RSS growth {:7.1f} MiB | hit rate {:4.0%} | evictions {:5d} | "
+              "cached {:6.1f} MiB in memory, {:6.1f} MiB on disk"
+              .format(policy, " ".join("{:5.2f}s".format(epoch_time) for epoch_time in epoch_times),
+                      rss / 1024 ** 2, stats.get("hit_rate", 0.), stats.get("evictions", 0),
+                      stats.get("nbytes", 0) / 1024 ** 2, stats.get("spilled_bytes", 0) / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Compares per-query postprocessing with interpolation in a precomputed feature volume.
+
+Uses a synthetic subject with an HCP-like b=1000 shell (18 b0 and 90 diffusion weighted volumes)
+and interpolates the DWI on 3x3x3 grids around random points, as `StreamlineDataset` and
+`RLTractEnvironment` do.
+
+Usage: python postprocessing.py
+"""
+import time
+
+import numpy as np
+from dipy.core.gradients import gradient_table
+
+from dfibert.data import DataContainer
+from dfibert.data.postprocessing import SphericalHarmonics, Resample100
+from dfibert.util import get_grid
+
+SHAPE = (80, 80, 48)
+NO_POINTS = 20000
+
+
+def _time(function, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    """Main method"""
+    rng = np.random.default_rng(42)
+    bvals = np.concatenate((np.zeros(18), np.full(90, 1000.)))
+    bvecs = rng.normal(size=(len(bvals), 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[bvals == 0] = 0
+    dwi = rng.random((*SHAPE, len(bvals)), dtype=np.float32)
+    aff = np.diag([1.25, 1.25, 1.25, 1.])
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    data_container = DataContainer(bvals, bvecs, gradient_table(bvals, bvecs), None, dwi, aff, mask,
+                                   dwi[..., 0], None)
+
+    centres = data_container.to_ras(2 + rng.random((NO_POINTS, 3)) * (np.array(SHAPE) - 5))
+    points = centres[:, None, None, None, :] + get_grid(np.array([3, 3, 3])) * 1.25
+
+    for postprocessing in (SphericalHarmonics(), Resample100()):
+        data_container.precompute_postprocessing = False
+        query_time, reference = _time(lambda: data_container.get_interpolated_dwi(points, postprocessing))
+        data_container.precompute_postprocessing = True
+        start = time.perf_counter()
+        data_container.get_postprocessed_volume(postprocessing)
+        volume_time = time.perf_counter() - start
+        feature_time, result = _time(lambda: data_container.get_interpolated_dwi(points, postprocessing))
+        print("{:48s} per query {:6.3f}s  feature volume {:6.3f}s ({:5.1f}x, computed once in {:5.2f}s)"
+              "  max rel. error {:.1e}".format(postprocessing.id, query_time, feature_time,
+                                               query_time / feature_time, volume_time,
+                                               np.abs(result - reference).max() / np.abs(reference).max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Reports the per-call overhead of the postprocessing options for small batches.
+
+Compares the memoized, fused projection of `SphericalHarmonics` and `Resample100`
+with rebuilding the basis on every call, for batch sizes as issued by `RLTractEnvironment.step`
+(a single 3x3x3 grid) up to those of `StreamlineDataset`.
+
+Usage: python postprocessing_overhead.py
+"""
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from dipy.core.sphere import Sphere
+from dipy.reconst.shm import real_sym_sh_mrtrix, smooth_pinv
+
+from dfibert.data.postprocessing import SphericalHarmonics, Resample100
+
+BATCH_SIZES = (1, 27, 270, 2700)
+
+
+def _rebuild_every_call(option, bvecs, dwi):
+    """The postprocessing as it was calculated before memoizing the basis."""
+    raw_sphere = Sphere(xyz=bvecs)
+    real_sh, _, n = real_sym_sh_mrtrix(option.sh_order, raw_sphere.theta, raw_sphere.phi)
+    laplace_beltrami = -n * (n + 1)
+    inv_b = smooth_pinv(real_sh, np.sqrt(option.smooth) * laplace_beltrami)
+    data = np.dot(dwi, inv_b.T)
+    if hasattr(option, "real_sh"):
+        data = np.dot(data, option.real_sh.T)
+    return data
+
+
+def _time(function, min_time=0.2):
+    function()
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        function()
+        calls += 1
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    """Main method"""
+    rng = np.random.default_rng(42)
+    bvecs = np.zeros((108, 3))
+    bvecs[18:] = rng.normal(size=(90, 3))
+    bvecs[18:] /= np.linalg.norm(bvecs[18:], axis=1)[:, None]
+    data_container = SimpleNamespace(bvecs=bvecs)
+
+    for option in (SphericalHarmonics(), Resample100()):
+        print(option.id)
+        for batch_size in BATCH_SIZES:
+            dwi = rng.random((batch_size, len(bvecs)), dtype=np.float32)
+            rebuilt_time = _time(lambda: _rebuild_every_call(option, bvecs, dwi))
+            memoized_time = _time(lambda: option.process(data_container, None, dwi))
+            error = np.abs(option.process(data_container, None, dwi) - _rebuild_every_call(option, bvecs, dwi)).max()
+            print("  batch {:5d}  rebuilt {:8.1f}us  memoized {:8.1f}us  speedup {:6.1f}x  max error {:.1e}"
+                  .format(batch_size, rebuilt_time * 1e6, memoized_time * 1e6, rebuilt_time / memoized_time, error))
+
+
+if __name__ == "__main__":
+    main()
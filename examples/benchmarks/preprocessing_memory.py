@@ -0,0 +1,68 @@
+"""Reports the peak RSS of normalizing and cropping a synthetic subject with `DataPreprocessor.preprocess`.
+
+Every mode is measured in a fresh process (Linux only), the reported value is the growth of
+the peak RSS above the RSS after creating the subject, relative to the size of the raw DWI.
+The size of the preprocessed DataContainer (`DataContainer.nbytes`) is reported as well.
+
+Usage: python preprocessing_memory.py [copy|inplace] ...
+"""
+import multiprocessing
+import resource
+import sys
+
+import numpy as np
+from dipy.core.gradients import gradient_table
+
+from dfibert.data import DataContainer, DataPreprocessor
+
+SHAPE = (80, 80, 48)
+BVALS = np.array([5.0] * 10 + [1000.0] * 90 + [2000.0] * 90 + [3000.0] * 90)
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _create_data_container():
+    rng = np.random.default_rng(42)
+    bvecs = rng.normal(size=(len(BVALS), 3))
+    bvecs = bvecs / np.linalg.norm(bvecs, axis=1)[:, None]
+    dwi = rng.random((*SHAPE, len(BVALS)), dtype=np.float32)
+    dwi *= 1000
+    b0 = dwi[..., BVALS < 10].mean(axis=-1)
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    return DataContainer(BVALS, bvecs, gradient_table(BVALS, bvecs), mask, dwi, np.eye(4), mask, b0, None)
+
+
+def _measure(mode, queue):
+    data_container = _create_data_container()
+    before = _current_rss()
+    preprocessor = DataPreprocessor().normalize().crop()
+    if mode == "copy":
+        result = preprocessor.preprocess(data_container)
+    else:
+        result = preprocessor.preprocess(data_container, inplace=True)
+    queue.put((before, _peak_rss(), data_container.dwi.nbytes, result.nbytes))
+
+
+def main():
+    """Main method"""
+    modes = sys.argv[1:] or ["copy", "inplace"]
+    for mode in modes:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure, args=(mode, queue))
+        process.start()
+        before, after, dwi_bytes, result_bytes = queue.get()
+        process.join()
+        print("{:8s} raw DWI {:7.1f} MiB | peak RSS growth {:7.1f} MiB ({:.2f}x raw DWI) | result {:7.1f} MiB"
+              .format(mode, dwi_bytes / 1024 ** 2, (after - before) / 1024 ** 2, (after - before) / dwi_bytes,
+                      result_bytes / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
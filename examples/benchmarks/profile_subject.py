@@ -0,0 +1,27 @@
+"""Profiles the preparation of a HCP subject with the default chain of the examples, step by step.
+
+Writes the JSON report (wall time, CPU time, RSS and bytes per file load and step, see `dfibert.data.profiling`)
+and a Chrome trace, which can be compared across releases or opened in https://ui.perfetto.dev.
+
+Usage: python profile_subject.py subject_directory [report.json] [trace.json]
+"""
+import sys
+
+from dfibert.data import DataPreprocessor
+from dfibert.data.profiling import PreprocessingProfiler
+
+
+def main():
+    """Main method"""
+    path = sys.argv[1]
+    report_path = sys.argv[2] if len(sys.argv) > 2 else "preprocessing_profile.json"
+    trace_path = sys.argv[3] if len(sys.argv) > 3 else "preprocessing_trace.json"
+    profiler = PreprocessingProfiler()
+    DataPreprocessor().normalize().crop().fa_estimate().get_hcp(path, profiler=profiler)
+    print(profiler)
+    profiler.save_json(report_path)
+    profiler.save_chrome_trace(trace_path)
+
+
+if __name__ == "__main__":
+    main()
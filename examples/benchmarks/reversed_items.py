@@ -0,0 +1,69 @@
+"""Compares deriving the items of reversed streamlines with calculating them like every other item.
+
+Iterates over a `StreamlineDataset` with `append_reverse=True` and unrotated processing in batches, once with
+items cached and once without, then saves it with `saveToPath`. Each mode is run with the reversed items derived
+from their streamlines (the default) and with `reversible_input` disabled, which calculates them from scratch.
+
+Usage: python reversed_items.py [batch_size]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dfibert.data.postprocessing import Raw
+from dfibert.dataset import StreamlineDataset
+from dfibert.dataset.processing import RegressionProcessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import quantization  # noqa: E402
+
+NO_STREAMLINES = 2000
+STREAMLINE_LENGTH = 50
+
+
+class _CalculatedRegressionProcessing(RegressionProcessing):
+    reversible_input = False
+
+
+def _epoch(dataset, batch_size):
+    start = time.perf_counter()
+    for index in range(0, len(dataset), batch_size):
+        dataset.__getitems__(list(range(index, min(index + batch_size, len(dataset)))))
+    return time.perf_counter() - start
+
+
+def main():
+    """Main method"""
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    quantization.NO_STREAMLINES = NO_STREAMLINES
+    quantization.STREAMLINE_LENGTH = STREAMLINE_LENGTH
+    data_container = quantization._create_data_container()
+    data_container.id = "synthetic"
+    streamlines = list(quantization._get_streamlines())
+    for processing_class in (RegressionProcessing, _CalculatedRegressionProcessing):
+        processing = processing_class(postprocessing=Raw(), rotate=False)
+        data_container.get_postprocessed_volume(processing.options.postprocessing)
+
+        dataset = StreamlineDataset(streamlines, data_container, processing, online_caching=False)
+        uncached_time = _epoch(dataset, batch_size)
+        dataset = StreamlineDataset(streamlines, data_container, processing)
+        cached_time = _epoch(dataset, batch_size)
+        cached_bytes = dataset.cache.nbytes
+
+        path = tempfile.mkdtemp(prefix="dfibert-reversed-")
+        try:
+            dataset = StreamlineDataset(streamlines, data_container, processing, online_caching=False)
+            start = time.perf_counter()
+            dataset.saveToPath(path, chunk_size=batch_size)
+            save_time = time.perf_counter() - start
+        finally:
+            shutil.rmtree(path)
+        print("\n{:8s} | epoch {:6.2f}s | first cached epoch {:6.2f}s ({:6.1f} MiB cached) | saveToPath {:6.2f}s"
+              .format("derived" if processing.reversible_input else "computed", uncached_time, cached_time,
+                      cached_bytes / 1024 ** 2, save_time))
+
+
+if __name__ == "__main__":
+    main()
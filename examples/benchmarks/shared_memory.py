@@ -0,0 +1,104 @@
+"""Compares the memory of DataLoader workers using private copies of a DataContainer with workers
+using a DataContainer in shared memory (`DataContainer.share_memory`).
+
+The workers are started with the spawn method (required for CUDA, the default on macOS and Windows),
+so every worker receives the pickled dataset. Every worker interpolates the Resample100 features
+of random streamlines in a synthetic subject, then the proportional set size (PSS, shared pages are
+divided between the processes mapping them) of every worker is reported.
+
+Usage: python shared_memory.py [number of workers]
+"""
+import pickle
+import sys
+import time
+
+import numpy as np
+import torch
+from dipy.core.gradients import gradient_table
+
+from dfibert.data import DataContainer
+from dfibert.data.postprocessing import Resample100
+
+SHAPE = (96, 96, 64)
+NO_ITEMS = 400
+STREAMLINE_LENGTH = 100
+
+
+def _create_data_container():
+    rng = np.random.default_rng(42)
+    bvals = np.concatenate((np.full(18, 5.), np.full(90, 1000.)))
+    bvecs = rng.normal(size=(len(bvals), 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[bvals < 10] = 0
+    dwi = rng.random((*SHAPE, len(bvals)), dtype=np.float32)
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    return DataContainer(bvals, bvecs, gradient_table(bvals, bvecs), None, dwi, np.eye(4), mask,
+                         np.ones(SHAPE, dtype=np.float32), None)
+
+
+def _get_memory():
+    """Returns the PSS and the private memory of this process in MiB."""
+    values = {}
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return values["Pss"], values["Private_Clean"] + values["Private_Dirty"]
+
+
+class _StreamlineFeatures(torch.utils.data.Dataset):
+    """Returns the features along a random streamline and the memory of the worker."""
+
+    def __init__(self, data_container):
+        self.data_container = data_container
+        self.postprocessing = Resample100()
+
+    def __len__(self):
+        return NO_ITEMS
+
+    def __getitem__(self, index):
+        rng = np.random.default_rng(index)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        seed = 30 + rng.random(3) * (np.array(SHAPE) - 60)
+        streamline = seed + 0.2 * np.arange(STREAMLINE_LENGTH)[:, None] * direction
+        features = self.data_container.get_interpolated_dwi(streamline, postprocessing=self.postprocessing)
+        worker = torch.utils.data.get_worker_info()
+        return torch.from_numpy(features), worker.id, torch.tensor(_get_memory())
+
+
+def _run(data_container, no_workers):
+    loader = torch.utils.data.DataLoader(_StreamlineFeatures(data_container), batch_size=None,
+                                         num_workers=no_workers, multiprocessing_context="spawn")
+    memory = {}
+    start = time.perf_counter()
+    for _, worker, worker_memory in loader:
+        memory[worker] = worker_memory.tolist()
+    return time.perf_counter() - start, memory
+
+
+def main():
+    """Main method"""
+    no_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    data_container = _create_data_container()
+    data_container.get_postprocessed_volume(Resample100())
+    print("DWI {:.0f} MiB, Resample100 {:.0f} MiB, {} workers"
+          .format(data_container.dwi.nbytes / 1024 ** 2,
+                  data_container.get_postprocessed_volume(Resample100()).nbytes / 1024 ** 2, no_workers))
+    for mode in ("private", "shared"):
+        if mode == "shared":
+            data_container = data_container.share_memory()
+        start = time.perf_counter()
+        pickled = pickle.dumps(data_container)
+        pickle_time = time.perf_counter() - start
+        epoch_time, memory = _run(data_container, no_workers)
+        pss = sum(values[0] for values in memory.values())
+        private = sum(values[1] for values in memory.values())
+        print("{:8s} pickle {:8.2f} MiB in {:.3f}s | epoch {:5.2f}s (incl. start-up) | "
+              "workers: PSS {:7.1f} MiB, private {:7.1f} MiB"
+              .format(mode, len(pickled) / 1024 ** 2, pickle_time, epoch_time, pss, private))
+
+
+if __name__ == "__main__":
+    main()
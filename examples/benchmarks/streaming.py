@@ -0,0 +1,95 @@
+"""Reports the time and peak memory of normalizing, cropping and estimating the FA of a synthetic HCP subject.
+
+Compares the eager preprocessing of the loaded volumes with the streaming preprocessing, which reads
+the memory-mapped input and writes the memory-mapped output slab by slab (`get_hcp(streaming=True)`).
+Every mode is measured in a fresh process (Linux only), the images are converted for lazy loading beforehand.
+Besides the growth of the peak RSS, the peak of the anonymous RSS is reported: pages of memory-mapped files
+are counted in the RSS as well, but they are clean (or written back) and can be reclaimed at any time.
+
+Usage: python streaming.py [directory] [slab_size]
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from dfibert.data import DataPreprocessor
+from dfibert.data.cache import DataContainerCache
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loading import _create_subject  # noqa: E402
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _anonymous_rss():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _get_preprocessor():
+    return DataPreprocessor().normalize().crop().fa_estimate()
+
+
+def _measure(mode, path, slab_size, queue):
+    lazy_cache_path = os.path.join(path, "lazy")
+    before, anonymous_before = _current_rss(), _anonymous_rss()
+    peak_anonymous = [anonymous_before]
+    running = True
+
+    def sample():
+        while running:
+            peak_anonymous[0] = max(peak_anonymous[0], _anonymous_rss())
+            time.sleep(0.005)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    start = time.perf_counter()
+    if mode == "eager":
+        data_container = _get_preprocessor().get_hcp(path, load_t1=False)
+    else:
+        cache = DataContainerCache(tempfile.mkdtemp(dir=path))
+        data_container = _get_preprocessor().get_hcp(path, load_t1=False, streaming=True, slab_size=slab_size,
+                                                     lazy_cache_path=lazy_cache_path, cache=cache)
+        cache.clear()
+    elapsed = time.perf_counter() - start
+    running = False
+    sampler.join()
+    queue.put((elapsed, _peak_rss() - before, peak_anonymous[0] - anonymous_before, data_container.dwi.nbytes))
+
+
+def main():
+    """Main method"""
+    path = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+    slab_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    os.makedirs(path, exist_ok=True)
+    if not os.path.isfile(os.path.join(path, "data.nii.gz")):
+        _create_subject(path)
+    # converts the gzipped images once, so the streaming run only measures the preprocessing
+    _get_preprocessor().get_hcp(path, load_t1=False, lazy=True, lazy_cache_path=os.path.join(path, "lazy"))
+    for mode in ("eager", "streaming"):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure, args=(mode, path, slab_size, queue))
+        process.start()
+        elapsed, rss, anonymous_rss, dwi_bytes = queue.get()
+        process.join()
+        print("{:10s} {:6.2f}s | peak RSS growth {:7.1f} MiB | peak anonymous RSS growth {:7.1f} MiB "
+              "| preprocessed DWI {:7.1f} MiB"
+              .format(mode, elapsed, rss / 1024 ** 2, anonymous_rss / 1024 ** 2, dwi_bytes / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+import torch
+
+from dfibert.data.interpolation import TrilinearInterpolator
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint16])
+def test_torch_matches_numpy_for_16_bit_integers(dtype):
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype)
+    values = rng.integers(info.min, info.max, size=(6, 7, 8, 5), endpoint=True).astype(dtype)
+    interpolator = TrilinearInterpolator(values, scale=1 / 100)
+    points = rng.random((50, 3)) * (np.array(values.shape[:3]) - 1)
+
+    np.testing.assert_allclose(interpolator(torch.from_numpy(points)).numpy(), interpolator(points), atol=1e-3)
+    np.testing.assert_allclose(interpolator.nearest(torch.from_numpy(points)).numpy(), interpolator.nearest(points))